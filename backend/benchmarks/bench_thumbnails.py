@@ -0,0 +1,112 @@
+"""
+Thumbnails per second for the full-resolution decode generate_thumbnail used to do
+(open, copy, thumbnail) against the scaled decode of image_processor.save_thumbnail.
+
+Usage, from the backend directory:
+    python benchmarks/bench_thumbnails.py [IMAGE_DIR] [--size 400] [--rounds 3] [--ladder]
+
+Without IMAGE_DIR a corpus of large synthetic JPEGs and PNGs is generated in a
+temporary directory. Thumbnails are written to a temporary directory as well.
+With --ladder the scaled decode also writes the THUMBNAIL_LADDER sizes and the
+full decode decodes the image again for each of them, as separate generation would.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image as PILImage, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import config
+import image_processor
+import pack_store
+
+SYNTHETIC_CORPUS = [("jpg", "JPEG", (6000, 4000), 12), ("png", "PNG", (4000, 3000), 4)]
+
+
+def make_corpus(directory: str) -> list:
+    # Blurred noise over a gradient, so the files are about the size of camera JPEGs rather than flat colour.
+    paths = []
+    for extension, image_format, (width, height), count in SYNTHETIC_CORPUS:
+        gradient = PILImage.linear_gradient("L").resize((width, height))
+        noise = PILImage.effect_noise((width, height), 40).filter(ImageFilter.GaussianBlur(1))
+        base = PILImage.merge("RGB", (gradient, noise, gradient.transpose(PILImage.Transpose.FLIP_LEFT_RIGHT)))
+        for index in range(count):
+            path = os.path.join(directory, f"synthetic_{index}.{extension}")
+            base.rotate(index * 7).save(path, image_format, quality=90)
+            paths.append(path)
+    return paths
+
+
+def thumbnail_full_decode(path: str, output_filename_base: str, size: int):
+    # What generate_thumbnail did before: decode every pixel, copy the bitmap, then scale.
+    for ladder_size in [size] + [s for s in config.THUMBNAIL_LADDER if s != size]:
+        image = PILImage.open(path)
+        thumbnail = image.copy()
+        thumbnail.thumbnail((ladder_size, ladder_size))
+        thumbnail.save(os.path.join(config.THUMBNAILS_DIR, f"{output_filename_base}_thumb_{ladder_size}.webp"), "webp")
+        image.close()
+
+
+def thumbnail_scaled_decode(path: str, output_filename_base: str, size: int):
+    with PILImage.open(path) as image:
+        image_processor.save_thumbnail(image, output_filename_base, size, ladder=True)
+
+
+def run(paths: list, generate, size: int, rounds: int) -> float:
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for index, path in enumerate(paths):
+            generate(path, f"bench_{index}", size)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(paths) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image_dir", nargs="?", help="Directory of images to use instead of the synthetic corpus.")
+    parser.add_argument("--size", type=int, default=config.THUMBNAIL_SIZE, help="Thumbnail size in pixels.")
+    parser.add_argument("--rounds", type=int, default=3, help="Rounds per variant, the fastest one counts.")
+    parser.add_argument("--ladder", action="store_true", help="Generate every THUMBNAIL_LADDER size, not just --size.")
+    args = parser.parse_args()
+    if not args.ladder:
+        config.THUMBNAIL_LADDER = []
+
+    with tempfile.TemporaryDirectory() as corpus_dir, tempfile.TemporaryDirectory() as thumbnails_dir:
+        config.THUMBNAILS_DIR = thumbnails_dir
+        # Thumbnails are written as files, and the pack store, which save_derivative still asks to
+        # drop older packed versions, is an empty one, so the library's packs are never touched.
+        config.PACKED_THUMBNAILS = False
+        image_processor.pack_store = pack_store.pack_store = pack_store.PackStore(directory=os.path.join(thumbnails_dir, "packs"))
+        if args.image_dir:
+            paths = sorted(
+                str(path) for path in Path(args.image_dir).iterdir()
+                if path.suffix.lower() in (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+            )
+        else:
+            print("Generating synthetic corpus...")
+            paths = make_corpus(corpus_dir)
+        if not paths:
+            sys.exit("No images found.")
+
+        by_format = {}
+        for path in paths:
+            with PILImage.open(path) as image:
+                by_format.setdefault(image.format, []).append(path)
+
+        sizes = sorted(set(config.THUMBNAIL_LADDER) | {args.size})
+        print(f"{len(paths)} images, thumbnails of {', '.join(map(str, sizes))} px, best of {args.rounds} rounds")
+        print(f"{'format':<8} {'files':>5} {'full decode':>14} {'scaled decode':>14} {'speedup':>8}")
+        for image_format, format_paths in sorted(by_format.items()) + [("all", paths)]:
+            before = run(format_paths, thumbnail_full_decode, args.size, args.rounds)
+            after = run(format_paths, thumbnail_scaled_decode, args.size, args.rounds)
+            print(f"{image_format:<8} {len(format_paths):>5} {before:>10.2f} t/s {after:>10.2f} t/s {after / before:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import config
+import models
+
+# Every checksum is stored as a fixed-width binary key. 16-byte digests (xxh3) are
+# padded with zero bytes, other strings are kept as they are.
+KEY_SIZE = 32
+_HEX_DIGEST_LENGTHS = (KEY_SIZE * 2, KEY_SIZE)
+_PREFIX_FORMAT = struct.Struct(f'>Q{KEY_SIZE - 8}x')
+
+# Pending additions and removals are merged into the sorted array once there are this many.
+MERGE_THRESHOLD = 65536
+
+# Bloom filter size and number of probes, for a false positive rate of about 1%.
+BLOOM_BITS_PER_KEY = 10
+BLOOM_PROBES = 7
+
+# The sorted keys, and the first 8 bytes of each key as integers for a binary search in C.
+SortedKeys = Tuple[bytes, array]
+
+
+def _to_key(checksum: str) -> Optional[bytes]:
+    # Returns None for anything that is not a hex digest, which is kept as a string instead.
+    if len(checksum) not in _HEX_DIGEST_LENGTHS:
+        return None
+    try:
+        return bytes.fromhex(checksum).ljust(KEY_SIZE, b'\0')
+    except ValueError:
+        return None
+
+def _sorted_keys(keys: bytes) -> SortedKeys:
+    return keys, array('Q', (prefix for prefix, in _PREFIX_FORMAT.iter_unpack(keys)))
+
+def _bisect(sorted_keys: SortedKeys, key: bytes) -> int:
+    # Index of the first key in the sorted array that is not less than key.
+    keys, prefixes = sorted_keys
+    prefix = int.from_bytes(key[:8], 'big')
+    index = bisect_left(prefixes, prefix)
+    end = bisect_right(prefixes, prefix, index)
+    # Keys sharing the prefix, almost never more than one
+    while index < end and keys[index * KEY_SIZE:(index + 1) * KEY_SIZE] < key:
+        index += 1
+    return index
+
+def _contains_sorted(sorted_keys: SortedKeys, key: bytes) -> bool:
+    index = _bisect(sorted_keys, key)
+    return sorted_keys[0][index * KEY_SIZE:(index + 1) * KEY_SIZE] == key
+
+
+class _BloomFilter:
+    def __init__(self, capacity: int):
+        self.size = max(64, capacity * BLOOM_BITS_PER_KEY)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: bytes):
+        # Digests are uniformly distributed, so their first 16 bytes serve as two independent hashes.
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(BLOOM_PROBES))
+
+    def add(self, key: bytes):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, key: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class ChecksumIndex:
+    """
+    Set of known content hashes, as compact as a Python set of hex strings is not.
+
+    Hashes are kept as 32-byte binary keys in one sorted, immutable bytes object,
+    next to an array of their first 8 bytes for the binary search (about 40 bytes
+    per item instead of about 150). Additions and removals go to small pending sets
+    first and are merged into a new sorted array in bulk, which is swapped in, so
+    lookups from other threads never need the lock. An optional Bloom filter answers
+    most lookups of unknown content without the binary search.
+
+    It supports the set operations the scanner and watcher use: in, add and discard.
+    """
+
+    def __init__(self, use_bloom_filter: bool = config.CHECKSUM_BLOOM_FILTER):
+        self._lock = threading.Lock()
+        self._sorted: SortedKeys = _sorted_keys(b'')
+        self._added: Set[bytes] = set()
+        self._removed: Set[bytes] = set()
+        self._other: Set[str] = set() # Hashes that are not hex digests
+        self.use_bloom_filter = use_bloom_filter
+        self._bloom: Optional[_BloomFilter] = None
+        self._bloom_capacity = 0
+
+    def build(self, checksums: Iterable[str]):
+        """Replaces the contents. Sorted input, as read with ORDER BY, is taken as is without sorting."""
+        parts: List[bytes] = []
+        other = set()
+        previous = b''
+        is_sorted = True
+        for checksum in checksums:
+            key = _to_key(checksum)
+            if key is None:
+                other.add(checksum)
+                continue
+            if key <= previous:
+                is_sorted = False
+            previous = key
+            parts.append(key)
+        if not is_sorted:
+            parts = sorted(set(parts))
+        sorted_keys = _sorted_keys(b''.join(parts))
+        with self._lock:
+            self._sorted = sorted_keys
+            self._added = set()
+            self._removed = set()
+            self._other = other
+            self._rebuild_bloom()
+
+    def build_from_db(self, db: Session, batch_size: int = 10000):
+        """Loads every content hash, streamed in key order so no large list of strings is held."""
+        result = db.execute(
+            select(models.ImageContent.content_hash).order_by(models.ImageContent.content_hash).execution_options(yield_per=batch_size)
+        )
+        self.build(row[0] for row in result)
+
+    def __contains__(self, checksum: str) -> bool:
+        key = _to_key(checksum)
+        if key is None:
+            return checksum in self._other
+        if self._bloom is not None and not self._bloom.might_contain(key):
+            return False
+        if key in self._added:
+            return True
+        return key not in self._removed and _contains_sorted(self._sorted, key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sorted[1]) + len(self._added) - len(self._removed) + len(self._other)
+
+    def add(self, checksum: str):
+        key = _to_key(checksum)
+        with self._lock:
+            if key is None:
+                self._other.add(checksum)
+                return
+            if self._bloom is not None:
+                self._bloom.add(key)
+            self._removed.discard(key)
+            if not _contains_sorted(self._sorted, key):
+                self._added.add(key)
+            self._maybe_merge()
+
+    def discard(self, checksum: str):
+        key = _to_key(checksum)
+        with self._lock:
+            if key is None:
+                self._other.discard(checksum)
+                return
+            self._added.discard(key)
+            if _contains_sorted(self._sorted, key):
+                self._removed.add(key)
+            self._maybe_merge()
+
+    def _maybe_merge(self):
+        # Called with the lock held.
+        if len(self._added) + len(self._removed) < MERGE_THRESHOLD:
+            return
+        keys = self._sorted[0]
+        # (index, order, key): insert a new key before the key at index, or skip the key at index.
+        events = [(_bisect(self._sorted, key), 0, key) for key in self._added]
+        events += [(_bisect(self._sorted, key), 1, key) for key in self._removed]
+        events.sort()
+        parts = []
+        previous = 0
+        for index, order, key in events:
+            parts.append(keys[previous * KEY_SIZE:index * KEY_SIZE])
+            if order == 0:
+                parts.append(key)
+                previous = index
+            else:
+                previous = index + 1
+        parts.append(keys[previous * KEY_SIZE:])
+        # Swap in the new array before clearing the pending sets, so no key is missing in between.
+        self._sorted = _sorted_keys(b''.join(parts))
+        self._added = set()
+        self._removed = set()
+        if self._bloom is not None and len(self._sorted[1]) > self._bloom_capacity:
+            self._rebuild_bloom()
+
+    def _rebuild_bloom(self):
+        # Called with the lock held. Sized for twice the current keys, so it is rebuilt rarely.
+        if not self.use_bloom_filter:
+            self._bloom = None
+            return
+        count = len(self._sorted[1]) + len(self._added)
+        self._bloom_capacity = max(MERGE_THRESHOLD, count * 2)
+        bloom = _BloomFilter(self._bloom_capacity)
+        keys = self._sorted[0]
+        for offset in range(0, len(keys), KEY_SIZE):
+            bloom.add(keys[offset:offset + KEY_SIZE])
+        for key in self._added:
+            bloom.add(key)
+        self._bloom = bloom
+
+
+_index: Optional[ChecksumIndex] = None
+_index_lock = threading.Lock()
+
+def get_checksum_index(db: Session) -> ChecksumIndex:
+    """
+    Returns the index shared by the scanner, the file watcher and the hash migration.
+    It is built from the database on first use and kept up to date by its users.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = ChecksumIndex()
+            index.build_from_db(db)
+            print(f"Checksum index built with {len(index)} content hashes.")
+            _index = index
+        return _index
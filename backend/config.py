@@ -43,7 +43,59 @@ def generate_default_config():
         '# Max dimension (width or height) for generated thumbnails in pixels.': None,
         'THUMBNAIL_SIZE': '400',
         '# Max dimension for generated previews in pixels.': None,
-        'PREVIEW_SIZE': '1024'
+        'PREVIEW_SIZE': '1024',
+        '# Additional thumbnail sizes in pixels, comma separated. Clients pick one per display density. Only THUMBNAIL_SIZE is generated when media is added, the others from one decode when a client first asks for one.': None,
+        'THUMBNAIL_LADDER': '200,400,800,1600',
+        '# Store thumbnails and previews in a few large pack files instead of one file each, and serve them from memory maps.': None,
+        'PACKED_THUMBNAILS': 'False',
+        '# Size in MB at which a pack file is closed and a new one started.': None,
+        'THUMBNAIL_PACK_SIZE_MB': '1024',
+        '# Number of threads generating the thumbnails users are waiting for.': None,
+        'THUMBNAIL_WORKERS': '4',
+        '# Maximum number of thumbnails queued or being generated. Requests beyond it get the placeholder.': None,
+        'THUMBNAIL_QUEUE_SIZE': '256',
+        '# Generate thumbnails for new files in the background right after they are found, instead of when first viewed.': None,
+        'EAGER_THUMBNAILS': 'False',
+        '# Number of low priority threads generating thumbnails ahead of time.': None,
+        'THUMBNAIL_PREGEN_WORKERS': '1',
+        '# Seconds each of those threads pauses after a thumbnail.': None,
+        'THUMBNAIL_PREGEN_DELAY': '0.05'
+    }
+
+    # --- Scanner Section ---
+    default_config['Scanner'] = {
+        '# Number of threads used to hash files during a scan.': None,
+        'SCAN_HASH_WORKERS': '4',
+        '# Number of processes used to read image/video metadata during a scan. Use 0 to read metadata on the hashing threads.': None,
+        'SCAN_META_WORKERS': '2',
+        '# Number of new rows the scanner writes per database transaction.': None,
+        'INGEST_BATCH_SIZE': '500',
+        '# Maximum number of seconds the scanner holds rows before writing them.': None,
+        'INGEST_FLUSH_INTERVAL': '2',
+        '# Seconds between saved scan positions. An interrupted scan resumes from the last one.': None,
+        'SCAN_CHECKPOINT_INTERVAL': '30',
+        '# Seconds between scan progress updates pushed to admin clients.': None,
+        'SCAN_PROGRESS_INTERVAL': '2',
+        '# Treat a file whose size and sampled head/middle/tail match exactly one known item as that item, without hashing the whole file.': None,
+        '# Faster for re-scans of moved or re-stamped files, but an edit outside the sampled blocks goes unnoticed.': None,
+        'TRUST_SAMPLE_HASH': 'False',
+        '# Algorithm for content hashes: sha256, blake2b, or xxh3 (needs the xxhash package).': None,
+        '# sha256 is fastest on CPUs with SHA extensions, blake2b on those without. Changing it re-keys the library in the background.': None,
+        'CONTENT_HASH_ALGORITHM': 'sha256',
+        '# Files of at least this many MB on local disks are hashed through mmap. Use 0 to always use buffered reads.': None,
+        'HASH_MMAP_THRESHOLD_MB': '64',
+        '# Drop hashed files from the OS page cache so a large import does not push out thumbnails that are being served.': None,
+        'HASH_DROP_PAGE_CACHE': 'True',
+        '# Put a Bloom filter in front of the in-memory index of known content hashes. Costs about 2.5 bytes per item.': None,
+        'CHECKSUM_BLOOM_FILTER': 'False',
+        '# Add new files right away and read their metadata (EXIF, width, height) afterwards in the background.': None,
+        'DEFER_METADATA': 'True',
+        '# Number of threads reading metadata for files added without it.': None,
+        'METADATA_WORKERS': '2',
+        '# Minimum seconds between image refreshes pushed to clients while metadata is filled in.': None,
+        'METADATA_REFRESH_INTERVAL': '5',
+        '# New images up to this many MB are read once for their hash, metadata and thumbnail. Use 0 to read them separately.': None,
+        'READ_ONCE_MAX_MB': '32'
     }
 
     with open(USER_CONFIG_FILE, 'w') as configfile:
@@ -126,11 +178,13 @@ FRONTEND_BUILD_DIR = PROJECT_ROOT / FRONTEND_DIR_NAME / FRONTEND_BUILD_DIR_NAME
 GENERATED_MEDIA_DIR_NAME = "generated_media"
 THUMBNAILS_DIR_NAME = "thumbnails"
 PREVIEWS_DIR_NAME = "previews"
+PACKS_DIR_NAME = "packs"
 
 # Absolute paths for generated media storage
 GENERATED_MEDIA_ROOT = STATIC_DIR / GENERATED_MEDIA_DIR_NAME
 THUMBNAILS_DIR = GENERATED_MEDIA_ROOT / THUMBNAILS_DIR_NAME
 PREVIEWS_DIR = GENERATED_MEDIA_ROOT / PREVIEWS_DIR_NAME
+PACKS_DIR = GENERATED_MEDIA_ROOT / PACKS_DIR_NAME
 
 # Sizes for generated images
 thumb_size_from_config = config.getint('Media', 'THUMBNAIL_SIZE', fallback=400)
@@ -139,6 +193,76 @@ THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", thumb_size_from_config))
 preview_size_from_config = config.getint('Media', 'PREVIEW_SIZE', fallback=1024)
 PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", preview_size_from_config))
 
+thumbnail_ladder_from_config = config.get('Media', 'THUMBNAIL_LADDER', fallback='200,400,800,1600')
+THUMBNAIL_LADDER = sorted({int(size) for size in os.getenv("THUMBNAIL_LADDER", thumbnail_ladder_from_config).split(',') if size.strip()})
+
+packed_thumbnails_from_config = config.getboolean('Media', 'PACKED_THUMBNAILS', fallback=False)
+PACKED_THUMBNAILS = os.getenv("PACKED_THUMBNAILS", str(packed_thumbnails_from_config)).lower() in ('1', 'true', 'yes', 'on')
+
+thumbnail_pack_size_mb_from_config = config.getint('Media', 'THUMBNAIL_PACK_SIZE_MB', fallback=1024)
+THUMBNAIL_PACK_SIZE_MB = int(os.getenv("THUMBNAIL_PACK_SIZE_MB", thumbnail_pack_size_mb_from_config))
+
+thumbnail_workers_from_config = config.getint('Media', 'THUMBNAIL_WORKERS', fallback=4)
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", thumbnail_workers_from_config))
+
+thumbnail_queue_size_from_config = config.getint('Media', 'THUMBNAIL_QUEUE_SIZE', fallback=256)
+THUMBNAIL_QUEUE_SIZE = int(os.getenv("THUMBNAIL_QUEUE_SIZE", thumbnail_queue_size_from_config))
+
+eager_thumbnails_from_config = config.getboolean('Media', 'EAGER_THUMBNAILS', fallback=False)
+EAGER_THUMBNAILS = os.getenv("EAGER_THUMBNAILS", str(eager_thumbnails_from_config)).lower() in ('1', 'true', 'yes', 'on')
+
+thumbnail_pregen_workers_from_config = config.getint('Media', 'THUMBNAIL_PREGEN_WORKERS', fallback=1)
+THUMBNAIL_PREGEN_WORKERS = int(os.getenv("THUMBNAIL_PREGEN_WORKERS", thumbnail_pregen_workers_from_config))
+
+thumbnail_pregen_delay_from_config = config.getfloat('Media', 'THUMBNAIL_PREGEN_DELAY', fallback=0.05)
+THUMBNAIL_PREGEN_DELAY = float(os.getenv("THUMBNAIL_PREGEN_DELAY", thumbnail_pregen_delay_from_config))
+
+# --- Scanner Configuration ---
+scan_hash_workers_from_config = config.getint('Scanner', 'SCAN_HASH_WORKERS', fallback=4)
+SCAN_HASH_WORKERS = int(os.getenv("SCAN_HASH_WORKERS", scan_hash_workers_from_config))
+
+scan_meta_workers_from_config = config.getint('Scanner', 'SCAN_META_WORKERS', fallback=2)
+SCAN_META_WORKERS = int(os.getenv("SCAN_META_WORKERS", scan_meta_workers_from_config))
+
+ingest_batch_size_from_config = config.getint('Scanner', 'INGEST_BATCH_SIZE', fallback=500)
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", ingest_batch_size_from_config))
+
+ingest_flush_interval_from_config = config.getfloat('Scanner', 'INGEST_FLUSH_INTERVAL', fallback=2.0)
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", ingest_flush_interval_from_config))
+
+scan_checkpoint_interval_from_config = config.getfloat('Scanner', 'SCAN_CHECKPOINT_INTERVAL', fallback=30.0)
+SCAN_CHECKPOINT_INTERVAL = float(os.getenv("SCAN_CHECKPOINT_INTERVAL", scan_checkpoint_interval_from_config))
+
+scan_progress_interval_from_config = config.getfloat('Scanner', 'SCAN_PROGRESS_INTERVAL', fallback=2.0)
+SCAN_PROGRESS_INTERVAL = float(os.getenv("SCAN_PROGRESS_INTERVAL", scan_progress_interval_from_config))
+
+trust_sample_hash_from_config = config.getboolean('Scanner', 'TRUST_SAMPLE_HASH', fallback=False)
+TRUST_SAMPLE_HASH = os.getenv("TRUST_SAMPLE_HASH", str(trust_sample_hash_from_config)).lower() in ('1', 'true', 'yes', 'on')
+
+content_hash_algorithm_from_config = config.get('Scanner', 'CONTENT_HASH_ALGORITHM', fallback='sha256')
+CONTENT_HASH_ALGORITHM = os.getenv("CONTENT_HASH_ALGORITHM", content_hash_algorithm_from_config).lower()
+
+hash_mmap_threshold_mb_from_config = config.getint('Scanner', 'HASH_MMAP_THRESHOLD_MB', fallback=64)
+HASH_MMAP_THRESHOLD_MB = int(os.getenv("HASH_MMAP_THRESHOLD_MB", hash_mmap_threshold_mb_from_config))
+
+hash_drop_page_cache_from_config = config.getboolean('Scanner', 'HASH_DROP_PAGE_CACHE', fallback=True)
+HASH_DROP_PAGE_CACHE = os.getenv("HASH_DROP_PAGE_CACHE", str(hash_drop_page_cache_from_config)).lower() in ('1', 'true', 'yes', 'on')
+
+checksum_bloom_filter_from_config = config.getboolean('Scanner', 'CHECKSUM_BLOOM_FILTER', fallback=False)
+CHECKSUM_BLOOM_FILTER = os.getenv("CHECKSUM_BLOOM_FILTER", str(checksum_bloom_filter_from_config)).lower() in ('1', 'true', 'yes', 'on')
+
+defer_metadata_from_config = config.getboolean('Scanner', 'DEFER_METADATA', fallback=True)
+DEFER_METADATA = os.getenv("DEFER_METADATA", str(defer_metadata_from_config)).lower() in ('1', 'true', 'yes', 'on')
+
+metadata_workers_from_config = config.getint('Scanner', 'METADATA_WORKERS', fallback=2)
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", metadata_workers_from_config))
+
+metadata_refresh_interval_from_config = config.getfloat('Scanner', 'METADATA_REFRESH_INTERVAL', fallback=5.0)
+METADATA_REFRESH_INTERVAL = float(os.getenv("METADATA_REFRESH_INTERVAL", metadata_refresh_interval_from_config))
+
+read_once_max_mb_from_config = config.getint('Scanner', 'READ_ONCE_MAX_MB', fallback=32)
+READ_ONCE_MAX_MB = int(os.getenv("READ_ONCE_MAX_MB", read_once_max_mb_from_config))
+
 # URL path where generated media will be served by FastAPI
 # All contents of STATIC_DIR will be served under this prefix
 STATIC_FILES_URL_PREFIX = "/static_assets"
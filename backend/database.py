@@ -1,6 +1,6 @@
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from typing import Optional
 import asyncio
 import re
@@ -18,6 +18,40 @@ Base = declarative_base()
 # A global variable to hold the main asyncio event loop, captured at startup.
 main_event_loop: Optional[asyncio.AbstractEventLoop] = None
 
+def add_missing_columns(metadata):
+    """
+    create_all only creates missing tables, so columns added to existing models are
+    added here with ALTER TABLE. Indexes declared on the models are created if missing.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                column_default = ""
+                if column.default is not None and column.default.is_scalar:
+                    value = column.default.arg
+                    column_default = f" DEFAULT {int(value) if isinstance(value, bool) else repr(value)}"
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}{column_default}'))
+                print(f"Added missing column '{column.name}' to table '{table.name}'.")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+def begin_transaction(db: Session):
+    """
+    Opens the SQLite transaction of db, unless one is open already. pysqlite only begins one
+    by itself before an INSERT, UPDATE or DELETE, so a SAVEPOINT issued first would start the
+    transaction, and releasing it would commit everything written so far. Call this before
+    db.begin_nested() when the savepoint must roll back into an enclosing transaction.
+    """
+    if not db.connection().connection.driver_connection.in_transaction:
+        db.execute(text("BEGIN"))
+
 def get_db():
     db = SessionLocal()
     try:
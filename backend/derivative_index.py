@@ -0,0 +1,281 @@
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import config
+
+# Derivative kinds: a thumbnail of a size in pixels, the preview, or a thumbnail from before
+# thumbnails were keyed by their size, made at whatever thumb_size was set then.
+THUMBNAIL = None
+PREVIEW = "preview"
+Derivative = Union[None, int, str]
+
+_THUMBNAIL_NAME = re.compile(r'^(.+)_thumb(?:_(\d+))?\.webp$')
+_PREVIEW_NAME = re.compile(r'^(.+)_preview\.webp$')
+
+
+def _file_name(content_hash: str, derivative: Derivative) -> str:
+    if derivative == PREVIEW:
+        return f"{content_hash}_preview.webp"
+    if derivative is None:
+        return f"{content_hash}_thumb.webp"
+    return f"{content_hash}_thumb_{derivative}.webp"
+
+def _directory(derivative: Derivative) -> str:
+    return str(config.PREVIEWS_DIR if derivative == PREVIEW else config.THUMBNAILS_DIR)
+
+def derivative_path(content_hash: str, derivative: Derivative = THUMBNAIL) -> str:
+    """
+    Where a generated file of content_hash is written: two directory levels named after
+    the first two pairs of hash characters, e.g. thumbnails/ab/cd/abcd..._thumb.webp,
+    so no directory holds more than a few hundred entries even for millions of items.
+    """
+    if len(content_hash) < 4:
+        return flat_derivative_path(content_hash, derivative)
+    return os.path.join(_directory(derivative), content_hash[:2], content_hash[2:4], _file_name(content_hash, derivative))
+
+def flat_derivative_path(content_hash: str, derivative: Derivative = THUMBNAIL) -> str:
+    """Where the file was written before the sharded layout, straight in the thumbnail or preview directory."""
+    return os.path.join(_directory(derivative), _file_name(content_hash, derivative))
+
+def parse_derivative_name(name: str, derivative_directory: str) -> Optional[Tuple[str, Derivative]]:
+    """The content hash and derivative a file name in the thumbnail or preview directory stands for, or None."""
+    if derivative_directory == str(config.PREVIEWS_DIR):
+        match = _PREVIEW_NAME.match(name)
+        return (match.group(1), PREVIEW) if match else None
+    match = _THUMBNAIL_NAME.match(name)
+    if not match:
+        return None
+    return match.group(1), int(match.group(2)) if match.group(2) else THUMBNAIL
+
+def remove_derivative(content_hash: str, derivative: Derivative):
+    """Removes a derivative from the pack store and from both file layouts, and from the index."""
+    import pack_store # Imports this module for the derivative kinds
+    derivative_index.discard(content_hash, derivative)
+    pack_store.pack_store.delete(content_hash, derivative)
+    for path in (derivative_path(content_hash, derivative), flat_derivative_path(content_hash, derivative)):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(f"Could not remove {path}: {e}")
+
+def _key(content_hash: str) -> Union[bytes, str]:
+    # Hex digests are kept as bytes, half the size of the string, anything else as it is.
+    try:
+        return bytes.fromhex(content_hash)
+    except ValueError:
+        return content_hash
+
+
+class DerivativeIndex:
+    """
+    Which generated files exist for which content hash, kept in memory.
+
+    The listing and thumbnail routes would otherwise stat a file per image and per
+    thumbnail size, on directories that can hold millions of entries. The index is
+    loaded once from a single pass over the thumbnail and preview directories and
+    the pack store, and kept current by whatever writes or removes derivatives. Each
+    content hash maps to a bit mask of the derivatives it has, and a second mask of
+    those still in the flat layout, until layout_migration has moved them. Until the first load finishes,
+    lookups fall back to the filesystem, and changes made meanwhile are replayed onto
+    the result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._masks: Dict[Union[bytes, str], int] = {}
+        self._flat: Dict[Union[bytes, str], int] = {}
+        self._bits: Dict[Derivative, int] = {THUMBNAIL: 1, PREVIEW: 2}
+        self._journal: Optional[List[Tuple[bool, Union[bytes, str], int]]] = None
+        self._thread: Optional[threading.Thread] = None
+        self.loaded = False
+
+    def _bit(self, derivative: Derivative) -> int:
+        # Called with the lock held. Ladder sizes get a bit the first time they are seen.
+        bit = self._bits.get(derivative)
+        if bit is None:
+            bit = self._bits[derivative] = 1 << len(self._bits)
+        return bit
+
+    def load(self):
+        """(Re)builds the index from the thumbnail and preview directories and the pack store."""
+        import pack_store # Imports this module for the derivative kinds
+        start_time = time.perf_counter()
+        pack_store.pack_store.wait() # First, so packed derivatives are found while the directories are read
+        with self._lock:
+            self._journal = []
+        masks: Dict[Union[bytes, str], int] = {}
+        flat: Dict[Union[bytes, str], int] = {}
+        count = 0
+        for directory in (str(config.THUMBNAILS_DIR), str(config.PREVIEWS_DIR)):
+            # The flat layout is read first. A file moved into a shard meanwhile is then found there.
+            for shard, name in self._walk(directory):
+                parsed = parse_derivative_name(name, directory)
+                if not parsed:
+                    continue
+                content_hash, derivative = parsed
+                key = _key(content_hash)
+                with self._lock:
+                    bit = self._bit(derivative)
+                masks[key] = masks.get(key, 0) | bit
+                if shard:
+                    flat[key] = flat.get(key, 0) & ~bit
+                else:
+                    flat[key] = flat.get(key, 0) | bit
+                count += 1
+        for content_hash, derivative in pack_store.pack_store.derivatives():
+            key = _key(content_hash)
+            with self._lock:
+                bit = self._bit(derivative)
+            masks[key] = masks.get(key, 0) | bit
+            flat[key] = flat.get(key, 0) & ~bit
+            count += 1
+        with self._lock:
+            # Apply what was generated or removed while the directories were read.
+            for added, key, bit in self._journal:
+                mask = masks.get(key, 0)
+                masks[key] = mask | bit if added else mask & ~bit
+                flat[key] = flat.get(key, 0) & ~bit
+            self._journal = None
+            self._masks = {key: mask for key, mask in masks.items() if mask}
+            self._flat = {key: mask for key, mask in flat.items() if mask}
+            self.loaded = True
+        print(
+            f"Derivative index loaded: {count} files of {len(self._masks)} items in {time.perf_counter() - start_time:.2f} seconds"
+            f"{f', {len(self._flat)} items still in the flat layout' if self._flat else ''}."
+        )
+
+    @staticmethod
+    def _walk(directory: str) -> Iterator[Tuple[bool, str]]:
+        # Yields (in_shard, file name) for the flat directory, then for every shard below it.
+        shards = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shards.append(entry.path)
+                    else:
+                        yield False, entry.name
+        except OSError as e:
+            print(f"Could not read {directory} for the derivative index: {e}")
+            return
+        for top in shards:
+            try:
+                with os.scandir(top) as entries:
+                    second = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+                for shard in second:
+                    with os.scandir(shard) as entries:
+                        for entry in entries:
+                            yield True, entry.name
+            except OSError as e:
+                print(f"Could not read {top} for the derivative index: {e}")
+
+    def load_in_background(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.load, name="derivative-index", daemon=True)
+            self._thread.start()
+
+    def wait(self):
+        """Blocks until the index is loaded, loading it on this thread if no load was started."""
+        if self._thread is not None:
+            self._thread.join()
+        if not self.loaded:
+            self.load()
+
+    def add(self, content_hash: str, derivative: Derivative = THUMBNAIL):
+        """Records a derivative written to (or moved into) the sharded layout."""
+        self._update(True, content_hash, derivative)
+
+    def discard(self, content_hash: str, derivative: Derivative = THUMBNAIL):
+        self._update(False, content_hash, derivative)
+
+    def _update(self, added: bool, content_hash: str, derivative: Derivative):
+        key = _key(content_hash)
+        with self._lock:
+            bit = self._bit(derivative)
+            if self._journal is not None:
+                self._journal.append((added, key, bit))
+            mask = self._masks.get(key, 0)
+            mask = mask | bit if added else mask & ~bit
+            if mask:
+                self._masks[key] = mask
+            else:
+                self._masks.pop(key, None)
+            flat = self._flat.get(key, 0) & ~bit
+            if flat:
+                self._flat[key] = flat
+            else:
+                self._flat.pop(key, None)
+
+    def has(self, content_hash: str, derivative: Derivative = THUMBNAIL) -> bool:
+        """Whether the derivative exists, without touching the filesystem once the index is loaded."""
+        if not self.loaded:
+            import pack_store
+            if (content_hash, derivative) in pack_store.pack_store:
+                return True
+            return os.path.exists(derivative_path(content_hash, derivative)) or os.path.exists(flat_derivative_path(content_hash, derivative))
+        bit = self._bits.get(derivative)
+        return bit is not None and bool(self._masks.get(_key(content_hash), 0) & bit)
+
+    def derivatives(self, content_hash: str) -> List[Derivative]:
+        """Every derivative that exists for content_hash."""
+        if not self.loaded:
+            with self._lock:
+                kinds = set(self._bits) | set(config.THUMBNAIL_LADDER)
+            return [derivative for derivative in kinds if self.has(content_hash, derivative)]
+        mask = self._masks.get(_key(content_hash), 0)
+        with self._lock:
+            return [derivative for derivative, bit in self._bits.items() if mask & bit]
+
+    def has_thumbnail(self, content_hash: str) -> bool:
+        """Whether any thumbnail exists for content_hash, of whichever size."""
+        if not self.loaded:
+            return any(derivative != PREVIEW for derivative in self.derivatives(content_hash))
+        return bool(self._masks.get(_key(content_hash), 0) & ~self._bits[PREVIEW])
+
+    def path(self, content_hash: str, derivative: Derivative = THUMBNAIL) -> str:
+        """Where the derivative is, in the sharded layout or, if it was not moved yet, the flat one."""
+        if not self.loaded:
+            sharded = derivative_path(content_hash, derivative)
+            if os.path.exists(sharded):
+                return sharded
+            flat = flat_derivative_path(content_hash, derivative)
+            return flat if os.path.exists(flat) else sharded
+        bit = self._bits.get(derivative)
+        if bit is not None and self._flat.get(_key(content_hash), 0) & bit:
+            return flat_derivative_path(content_hash, derivative)
+        return derivative_path(content_hash, derivative)
+
+    def relocate(self, content_hash: str, derivative: Derivative = THUMBNAIL) -> Optional[str]:
+        """
+        Looks the derivative up on disk after its indexed path turned out to be stale, e.g.
+        because it was moved or deleted meanwhile, and corrects the index. Returns its path or None.
+        """
+        sharded = derivative_path(content_hash, derivative)
+        if os.path.exists(sharded):
+            self.add(content_hash, derivative)
+            return sharded
+        flat = flat_derivative_path(content_hash, derivative)
+        if os.path.exists(flat):
+            key = _key(content_hash)
+            with self._lock:
+                bit = self._bit(derivative)
+                self._masks[key] = self._masks.get(key, 0) | bit
+                self._flat[key] = self._flat.get(key, 0) | bit
+            return flat
+        self.discard(content_hash, derivative)
+        return None
+
+    def flat_items(self) -> int:
+        """Number of items with files left in the flat layout."""
+        return len(self._flat)
+
+    def __len__(self) -> int:
+        return len(self._masks)
+
+
+# The one index the generators and the routes share
+derivative_index = DerivativeIndex()
@@ -8,6 +8,7 @@ from sqlalchemy.orm import Session
 from watchdog.events import FileSystemEvent, FileSystemEventHandler
 from watchdog.observers import Observer
 
+import checksum_index
 import database
 import image_processor
 import models
@@ -55,8 +56,8 @@ class ImageChangeEventHandler(FileSystemEventHandler):
                     print(f"File Watcher: Skipping file in untracked path: {event.src_path}")
                     return
 
-                # Get existing checksums to avoid redundant DB queries in add_file_to_db
-                existing_checksums = {row[0] for row in db.query(models.ImageContent.content_hash).all()}
+                # Known checksums, shared with the scanner, to avoid redundant DB queries in add_file_to_db
+                existing_checksums = checksum_index.get_checksum_index(db)
                 
                 # Add the file to the DB. Pass the loop and path entry so it can handle the broadcast.
                 image_processor.add_file_to_db(
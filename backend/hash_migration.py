@@ -0,0 +1,165 @@
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import insert, select, update, delete, literal, or_
+from sqlalchemy.orm import Session
+
+import checksum_index
+import config
+from derivative_index import Derivative, derivative_index, derivative_path, remove_derivative
+import hashing
+import models
+from pack_store import pack_store
+
+# Only one migration may re-key content at a time.
+_migration_lock = threading.Lock()
+
+def _link_derivatives(old_hash: str, new_hash: str) -> List[Derivative]:
+    """
+    Makes the generated files of old_hash available under new_hash as well, so both
+    names resolve while the database switches over. Returns the derivatives created.
+    """
+    created = []
+    for derivative in derivative_index.derivatives(old_hash):
+        data = pack_store.get(old_hash, derivative)
+        if data is not None:
+            if (new_hash, derivative) not in pack_store and pack_store.put(new_hash, derivative, data):
+                derivative_index.add(new_hash, derivative)
+                created.append(derivative)
+            continue
+        old_path, new_path = derivative_index.path(old_hash, derivative), derivative_path(new_hash, derivative)
+        if not os.path.exists(old_path) or os.path.exists(new_path):
+            continue
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.link(old_path, new_path)
+        except OSError:
+            shutil.copy2(old_path, new_path)
+        derivative_index.add(new_hash, derivative)
+        created.append(derivative)
+    return created
+
+def _remove_derivatives(content_hash: str, derivatives: List[Derivative]):
+    for derivative in derivatives:
+        remove_derivative(content_hash, derivative)
+
+def contents_needing_migration(db: Session, algorithm: str = None) -> int:
+    """Counts ImageContent rows whose hash was made with a different algorithm than the configured one."""
+    algorithm = algorithm or config.CONTENT_HASH_ALGORITHM
+    return db.query(models.ImageContent).filter(
+        or_(models.ImageContent.hash_algorithm != algorithm, models.ImageContent.hash_algorithm.is_(None))
+    ).count()
+
+def rekey_content(db: Session, old_hash: str, new_hash: str, algorithm: str):
+    """
+    Moves content from old_hash to new_hash in one transaction: the ImageContent row,
+    its locations and its tags. Thumbnails and previews are linked to the new name
+    before the commit and the old names removed after it, so a request never sees a
+    missing file. If new_hash already exists, because the same file was ingested with
+    the new algorithm meanwhile, the two are merged.
+    """
+    content_table = models.ImageContent.__table__
+
+    if old_hash == new_hash:
+        db.execute(update(content_table).where(content_table.c.content_hash == old_hash).values(hash_algorithm=algorithm))
+        db.commit()
+        return
+
+    new_exists = db.query(models.ImageContent.content_hash).filter(models.ImageContent.content_hash == new_hash).scalar()
+    if not new_exists:
+        copied_columns = [c for c in content_table.columns if c.name not in ('content_hash', 'hash_algorithm')]
+        db.execute(insert(content_table).from_select(
+            ['content_hash', 'hash_algorithm'] + [c.name for c in copied_columns],
+            select(literal(new_hash), literal(algorithm), *copied_columns).where(content_table.c.content_hash == old_hash)
+        ))
+
+    location_table = models.ImageLocation.__table__
+    db.execute(update(location_table).where(location_table.c.content_hash == old_hash).values(content_hash=new_hash))
+
+    image_tags = models.image_tags
+    db.execute(insert(image_tags).prefix_with("OR IGNORE").from_select(
+        ['image_id', 'tag_id'],
+        select(literal(new_hash), image_tags.c.tag_id).where(image_tags.c.image_id == old_hash)
+    ))
+    db.execute(delete(image_tags).where(image_tags.c.image_id == old_hash))
+    db.execute(delete(content_table).where(content_table.c.content_hash == old_hash))
+
+    created = _link_derivatives(old_hash, new_hash)
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        _remove_derivatives(new_hash, created)
+        raise
+    index = checksum_index.get_checksum_index(db)
+    index.add(new_hash)
+    index.discard(old_hash)
+    _remove_derivatives(old_hash, derivative_index.derivatives(old_hash))
+
+def migrate_content_hashes_task(db_session_factory, batch_size: int = 100, pause: float = 0.05):
+    """
+    A background task that re-keys all content hashed with another algorithm than
+    config.CONTENT_HASH_ALGORITHM. Each item is re-hashed from one of its files and
+    committed on its own, and the task pauses between batches, so the API keeps
+    working while it runs. Content with no readable file is left as it is.
+    """
+    if not _migration_lock.acquire(blocking=False):
+        print("Hash migration: A migration is already running.")
+        return
+
+    db = db_session_factory()
+    try:
+        algorithm = config.CONTENT_HASH_ALGORITHM
+        remaining = contents_needing_migration(db, algorithm)
+        if not remaining:
+            return
+        print(f"[{datetime.now().isoformat()}] Hash migration: Re-keying {remaining} items to {algorithm}...")
+        derivative_index.wait() # Packed thumbnails are only found, and linked to the new hashes, once it is loaded
+        start_time = time.time()
+        migrated = 0
+        skipped = 0
+        last_hash = ""
+
+        while True:
+            # Migrated rows drop out of the filter, skipped ones are stepped over by last_hash.
+            batch: List[Tuple[str]] = db.query(models.ImageContent.content_hash).filter(
+                or_(models.ImageContent.hash_algorithm != algorithm, models.ImageContent.hash_algorithm.is_(None)),
+                models.ImageContent.content_hash > last_hash
+            ).order_by(models.ImageContent.content_hash).limit(batch_size).all()
+            if not batch:
+                break
+
+            for (old_hash,) in batch:
+                last_hash = old_hash
+                locations = db.query(models.ImageLocation.path, models.ImageLocation.filename).filter(
+                    models.ImageLocation.content_hash == old_hash
+                ).all()
+                new_hash = None
+                for location in locations:
+                    full_path = os.path.join(location.path, location.filename)
+                    if os.path.isfile(full_path):
+                        new_hash = hashing.get_file_checksum(full_path, algorithm=algorithm)
+                        if new_hash:
+                            break
+                if not new_hash:
+                    skipped += 1
+                    continue
+                try:
+                    rekey_content(db, old_hash, new_hash, algorithm)
+                    migrated += 1
+                except Exception as e:
+                    print(f"Hash migration: Error re-keying {old_hash}: {e}")
+                    skipped += 1
+
+            print(f"Hash migration: {migrated} re-keyed, {skipped} skipped so far.")
+            time.sleep(pause) # Let other writers take the database lock
+
+        duration = time.time() - start_time
+        print(f"[{datetime.now().isoformat()}] Hash migration finished: {migrated} re-keyed, {skipped} skipped in {duration:.2f} seconds.")
+    finally:
+        db.close()
+        _migration_lock.release()
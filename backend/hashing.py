@@ -0,0 +1,277 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import config
+
+try:
+    import xxhash # Optional, only needed for the 'xxh3' content hash
+except ImportError:
+    xxhash = None
+
+# Size of each of the head, middle and tail blocks read for a sample hash.
+SAMPLE_BLOCK_SIZE = 65536
+
+# Block sizes for full-file hashing grow with the file between these bounds.
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+
+# While hashing, pages behind the read position are dropped from the page cache in steps of this size.
+DROP_CACHE_INTERVAL = 32 * 1024 * 1024
+
+# A mapped file that shrinks kills the process with SIGBUS, so files modified this recently
+# (probably still being written) and files on network file systems are read instead.
+MMAP_MIN_AGE_SECONDS = 5
+_REMOTE_FS_TYPES = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs', 'fuse.sshfs', 'fuse.rclone'}
+
+# Per-thread read buffer, reused for every file the thread hashes.
+_thread_buffers = threading.local()
+# st_dev -> whether the device is a local file system.
+_local_devices: Dict[int, bool] = {}
+
+# Content hash algorithms, by the name used in CONTENT_HASH_ALGORITHM and ImageContent.hash_algorithm.
+# Each entry creates a hashlib-style object with update() and hexdigest().
+HASH_ALGORITHMS: Dict[str, Callable] = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh3'] = xxhash.xxh3_128
+
+def new_content_hasher(algorithm: Optional[str] = None):
+    """Returns a hasher for the configured content hash algorithm, or the given one."""
+    algorithm = algorithm or config.CONTENT_HASH_ALGORITHM
+    if algorithm not in HASH_ALGORITHMS:
+        if algorithm == 'xxh3':
+            raise ValueError("CONTENT_HASH_ALGORITHM 'xxh3' requires the 'xxhash' package. Install it with: pip install xxhash")
+        raise ValueError(f"Unknown CONTENT_HASH_ALGORITHM '{algorithm}'. Choose one of: {', '.join(HASH_ALGORITHMS)}")
+    return HASH_ALGORITHMS[algorithm]()
+
+def get_file_checksum(filepath: str, block_size: Optional[int] = None, algorithm: Optional[str] = None):
+    # Calculates the content hash of a file with the configured algorithm.
+    hasher = new_content_hasher(algorithm)
+    try:
+        _hash_file(filepath, hasher, block_size=block_size)
+        return hasher.hexdigest()
+    except Exception as e:
+        print(f"Error calculating checksum for {filepath}: {e}")
+        return None
+
+def _block_size_for(file_size: int) -> int:
+    # Aims for about 64 blocks per file, so small files do not get a huge buffer and large
+    # ones are hashed in few calls. Hashers release the GIL while they work on a block.
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and block_size * 64 < file_size:
+        block_size *= 2
+    return block_size
+
+def _get_buffer(size: int) -> memoryview:
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = bytearray(size)
+        _thread_buffers.buffer = buffer
+    return memoryview(buffer)[:size]
+
+def _advise(fd: int, offset: int, length: int, advice_name: str):
+    # posix_fadvise is a hint and does not exist on every platform, so failures are ignored.
+    advice = getattr(os, advice_name, None)
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def _is_local_file_system(filepath: str, st: os.stat_result) -> bool:
+    if st.st_dev in _local_devices:
+        return _local_devices[st.st_dev]
+    is_local = True
+    try:
+        # The mount with the longest matching mount point holds the file.
+        real_path = os.path.realpath(filepath)
+        best_match = ''
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                prefix = mount_point.rstrip('/') + '/'
+                if (real_path.startswith(prefix) or mount_point == '/') and len(mount_point) >= len(best_match):
+                    best_match = mount_point
+                    is_local = fields[2] not in _REMOTE_FS_TYPES
+    except OSError:
+        pass # No /proc/mounts (not Linux), assume local
+    _local_devices[st.st_dev] = is_local
+    return is_local
+
+def _should_mmap(filepath: str, st: os.stat_result) -> bool:
+    if config.HASH_MMAP_THRESHOLD_MB <= 0 or st.st_size < config.HASH_MMAP_THRESHOLD_MB * 1024 * 1024:
+        return False
+    if time.time() - st.st_mtime < MMAP_MIN_AGE_SECONDS:
+        return False
+    return _is_local_file_system(filepath, st)
+
+def _capture_samples(ranges: List[Tuple[int, int]], samples: List[bytearray], block: memoryview, offset: int):
+    # Copies the parts of the sample ranges that fall inside this block.
+    block_end = offset + len(block)
+    for (start, end), sample in zip(ranges, samples):
+        if start < block_end and end > offset:
+            sample += block[max(start, offset) - offset:min(end, block_end) - offset]
+
+def _hash_file(filepath: str, hasher, ranges: Optional[List[Tuple[int, int]]] = None, block_size: Optional[int] = None) -> Tuple[int, List[bytearray]]:
+    """
+    Feeds a whole file to hasher and returns the number of bytes hashed together with
+    the sample ranges copied out along the way. Large local files are mapped, others
+    are read with readinto() into a reusable per-thread buffer, so no bytes object is
+    allocated per block. Hashed pages are dropped from the page cache if
+    HASH_DROP_PAGE_CACHE is set.
+    """
+    ranges = ranges or []
+    samples = [bytearray() for _ in ranges]
+    with open(filepath, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        st = os.fstat(fd)
+        block_size = block_size or _block_size_for(st.st_size)
+        _advise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+        if _should_mmap(filepath, st):
+            bytes_read = _hash_mapped(fd, st.st_size, hasher, ranges, samples, block_size)
+        else:
+            bytes_read = _hash_read(f, hasher, ranges, samples, block_size)
+        if config.HASH_DROP_PAGE_CACHE:
+            _advise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
+    return bytes_read, samples
+
+def _hash_read(f, hasher, ranges, samples, block_size: int) -> int:
+    fd = f.fileno()
+    buffer = _get_buffer(block_size)
+    offset = 0
+    dropped = 0
+    try:
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            block = buffer[:length]
+            hasher.update(block)
+            if ranges:
+                _capture_samples(ranges, samples, block, offset)
+            block.release()
+            offset += length
+            if config.HASH_DROP_PAGE_CACHE and offset - dropped >= DROP_CACHE_INTERVAL:
+                _advise(fd, dropped, offset - dropped, 'POSIX_FADV_DONTNEED')
+                dropped = offset
+    finally:
+        buffer.release()
+    return offset
+
+def _hash_mapped(fd: int, file_size: int, hasher, ranges, samples, block_size: int) -> int:
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        dropped = 0
+        try:
+            for offset in range(0, len(mapped), block_size):
+                block = view[offset:offset + block_size]
+                hasher.update(block)
+                if ranges:
+                    _capture_samples(ranges, samples, block, offset)
+                block.release()
+                block_end = offset + block_size
+                if config.HASH_DROP_PAGE_CACHE and block_end - dropped >= DROP_CACHE_INTERVAL:
+                    # Unmap the pages from this process first, the page cache only drops unmapped pages.
+                    if hasattr(mmap, 'MADV_DONTNEED'):
+                        mapped.madvise(mmap.MADV_DONTNEED, dropped, min(block_end, len(mapped)) - dropped)
+                    _advise(fd, dropped, block_end - dropped, 'POSIX_FADV_DONTNEED')
+                    dropped = block_end
+        finally:
+            view.release()
+        return len(mapped)
+
+def _sample_ranges(file_size: int) -> List[Tuple[int, int]]:
+    # Byte ranges of the head, middle and tail samples. They overlap for small files.
+    middle_start = max(0, file_size // 2 - SAMPLE_BLOCK_SIZE // 2)
+    return [
+        (0, min(file_size, SAMPLE_BLOCK_SIZE)),
+        (middle_start, min(file_size, middle_start + SAMPLE_BLOCK_SIZE)),
+        (max(0, file_size - SAMPLE_BLOCK_SIZE), file_size),
+    ]
+
+def _sample_digest(file_size: int, samples: List[bytes]) -> str:
+    # Sample hashes are always SHA256 so they stay comparable when the content hash algorithm changes.
+    sample_hash = hashlib.sha256(file_size.to_bytes(8, 'little'))
+    for sample in samples:
+        sample_hash.update(sample)
+    return sample_hash.hexdigest()
+
+def get_file_sample_hash(filepath: str, file_size: int) -> Optional[str]:
+    """Hashes the file size and its head, middle and tail blocks, reading at most three blocks."""
+    try:
+        samples = []
+        with open(filepath, 'rb') as f:
+            for start, end in _sample_ranges(file_size):
+                f.seek(start)
+                samples.append(f.read(end - start))
+        return _sample_digest(file_size, samples)
+    except Exception as e:
+        print(f"Error calculating sample hash for {filepath}: {e}")
+        return None
+
+def get_file_checksums(filepath: str, file_size: int, block_size: Optional[int] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Calculates the content hash and the sample hash of a file in a single read.
+    The sample blocks are picked out of the stream as it passes.
+    """
+    hasher = new_content_hasher()
+    ranges = _sample_ranges(file_size)
+    try:
+        bytes_read, samples = _hash_file(filepath, hasher, ranges, block_size)
+        if bytes_read != file_size:
+            # The file changed size since it was stat'ed, the samples would not match a later read.
+            return hasher.hexdigest(), None
+        return hasher.hexdigest(), _sample_digest(file_size, samples)
+    except Exception as e:
+        print(f"Error calculating checksum for {filepath}: {e}")
+        return None, None
+
+def read_file_checksums(filepath: str, file_size: int, block_size: Optional[int] = None) -> Tuple[Optional[str], Optional[str], Optional[bytearray]]:
+    """
+    Reads a whole file into memory and returns its content hash, its sample hash and its
+    data. Each block is hashed as it arrives, so the file is read once for hashing and
+    for decoding. Only meant for small files, see READ_ONCE_MAX_MB. If the file changed
+    size since it was stat'ed, only the content hash is returned.
+    """
+    hasher = new_content_hasher()
+    data = bytearray(file_size)
+    view = memoryview(data)
+    block_size = block_size or _block_size_for(file_size)
+    try:
+        with open(filepath, 'rb', buffering=0) as f:
+            fd = f.fileno()
+            _advise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            offset = 0
+            while offset < file_size:
+                length = f.readinto(view[offset:offset + block_size])
+                if not length:
+                    break
+                hasher.update(view[offset:offset + length])
+                offset += length
+            grown = _hash_read(f, hasher, [], [], block_size) if offset == file_size else 0
+            if config.HASH_DROP_PAGE_CACHE:
+                _advise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
+    except Exception as e:
+        print(f"Error calculating checksum for {filepath}: {e}")
+        return None, None, None
+    finally:
+        view.release()
+    if offset != file_size or grown:
+        return hasher.hexdigest(), None, None
+    samples = [data[start:end] for start, end in _sample_ranges(file_size)]
+    return hasher.hexdigest(), _sample_digest(file_size, samples), data
+
+# Fail at startup rather than on every file if the configured algorithm is unusable.
+new_content_hasher()
@@ -1,24 +1,46 @@
 import os
 from PIL import Image as PILImage
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from pathlib import Path
-import hashlib
 import mimetypes
+import io
 from datetime import datetime, timezone
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func, not_
+from sqlalchemy import func, or_, exists, insert, select
 import json, time
-from typing import Tuple, Optional
+import re
+from contextlib import nullcontext
+from collections import defaultdict
+from typing import Callable, Tuple, Optional, List, Iterator
 import threading
+import multiprocessing
 import subprocess
 import asyncio # Import asyncio
 from websocket_manager import manager # Import the WebSocket manager
 
 import models
+import checksum_index
+from derivative_index import PREVIEW, THUMBNAIL, Derivative, derivative_index, derivative_path, remove_derivative
+from pack_store import pack_store
+import metadata_enrichment
+import thumbnail_pregeneration
 import database
 import config
 import schemas
+import hashing
+from ingest_writer import IngestWriter
+from scan_checkpoints import ScanCheckpoints, path_order_key, walk_order_key
+import scan_progress
+from scan_progress import ProgressTracker
+
+# Maximum number of values bound into one IN (...) clause.
+SQL_CHUNK_SIZE = 500
+
+# Encoder settings of every thumbnail and preview. Derivatives are keyed by size only, so
+# changing these does not make existing ones stale: they would have to be removed to be redone.
+DERIVATIVE_FORMAT = "webp"
+DERIVATIVE_SAVE_OPTIONS = {"quality": 80} # Pillow's default, written out
 
 # Define supported image and video MIME types
 # This list can be expanded based on your needs
@@ -42,8 +64,9 @@ def _sanitize_for_json(obj):
         return obj.decode('utf-8', errors='replace')
     return obj
 
-def get_meta(filepath: str) -> Tuple[dict, Optional[int], Optional[int]]:
-    if not os.path.exists(filepath):
+def get_meta(filepath: str, check_exists: bool = True) -> Tuple[dict, Optional[int], Optional[int]]:
+    # The scanner already holds a stat result for the file and passes check_exists=False.
+    if check_exists and not os.path.exists(filepath):
         return {}, None, None
 
     mime_type, _ = mimetypes.guess_type(filepath)
@@ -51,21 +74,27 @@ def get_meta(filepath: str) -> Tuple[dict, Optional[int], Optional[int]]:
 
     if is_video:
         try:
-            # Use ffprobe for video dimensions
+            # Use ffprobe for video dimensions, codec and duration
             ffprobe_command = [
                 'ffprobe',
                 '-v', 'error',
                 '-select_streams', 'v:0',
-                '-show_entries', 'stream=width,height',
+                '-show_entries', 'stream=width,height,codec_name:format=duration',
                 '-of', 'json',
                 filepath
             ]
             result = subprocess.run(ffprobe_command, check=True, capture_output=True, text=True)
             video_info = json.loads(result.stdout)
-            width = video_info['streams'][0].get('width')
-            height = video_info['streams'][0].get('height')
-            # Videos don't have EXIF in the same way, return empty dict
-            return {}, width, height
+            stream = video_info['streams'][0]
+            # Videos don't have EXIF in the same way, only the stream details are kept
+            meta = {}
+            if stream.get('codec_name'):
+                meta['codec'] = stream['codec_name']
+            try:
+                meta['duration'] = float(video_info.get('format', {})['duration'])
+            except (KeyError, TypeError, ValueError):
+                pass
+            return meta, stream.get('width'), stream.get('height')
         except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError, IndexError) as e:
             print(f"Error getting video metadata with ffprobe for {filepath}: {e}")
             # Fallback or fail gracefully
@@ -74,46 +103,289 @@ def get_meta(filepath: str) -> Tuple[dict, Optional[int], Optional[int]]:
     else: # For images
         try:
             # Use Pillow for image dimensions and EXIF
-            image = PILImage.open(filepath)
-            exif = dict(image.info)
-            width = image.width
-            height = image.height
-            image.close()
-            return _sanitize_for_json(exif), width, height
+            with PILImage.open(filepath) as image:
+                return get_image_meta(image)
         except Exception as e:
             print(f"Error getting image metadata for {filepath}: {e}")
             return {}, None, None
 
     return {}, None, None # Default return if no other condition is met
+
+def read_video(filepath: str, thumb_size: int) -> Tuple[dict, Optional[int], Optional[int], Optional[PILImage.Image]]:
+    """
+    Reads a video's codec, duration and dimensions together with its first frame, scaled
+    to fit thumb_size, from a single ffmpeg process. ffmpeg describes its input on stderr
+    and pipes the frame to stdout as BMP, which Pillow opens from memory, so neither an
+    ffprobe call nor a temporary image file is needed. Returns (meta, width, height, poster),
+    where meta and the dimensions match what get_meta returns for the video.
+    """
+    ffmpeg_command = [
+        'ffmpeg',
+        '-hide_banner',
+        '-nostdin',
+        '-i', filepath,
+        '-map', '0:v:0',
+        '-frames:v', '1',
+        '-vf', f"scale='min({thumb_size},iw)':'min({thumb_size},ih)':force_original_aspect_ratio=decrease",
+        '-f', 'image2pipe',
+        '-c:v', 'bmp',
+        '-'
+    ]
+    try:
+        result = subprocess.run(ffmpeg_command, capture_output=True)
+    except OSError as e:
+        print(f"Error executing ffmpeg for {filepath}: {e}")
+        return {}, None, None, None
+
+    meta, width, height = _parse_ffmpeg_input(result.stderr.decode('utf-8', errors='replace'))
+    poster = None
+    if result.returncode != 0 or not result.stdout:
+        print(f"Error reading video frame with ffmpeg for {filepath}: exit code {result.returncode}")
+        print(f"FFmpeg stderr: {result.stderr.decode('utf-8', errors='replace')[-1000:]}")
+    else:
+        try:
+            poster = PILImage.open(io.BytesIO(result.stdout))
+            poster.load()
+        except Exception as e:
+            print(f"Error decoding video frame from ffmpeg for {filepath}: {e}")
+            poster = None
+    return meta, width, height, poster
+
+# ffmpeg's description of its input, e.g. "  Duration: 00:01:02.50, start: ..." and
+# "  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, progressive), 1920x1080 [SAR 1:1 DAR 16:9], ..."
+_FFMPEG_DURATION = re.compile(r'^\s*Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', re.MULTILINE)
+_FFMPEG_VIDEO_STREAM = re.compile(r'^\s*Stream #\d+:\d+\S*: Video: (\w+).*?, (\d+)x(\d+)[\s,]', re.MULTILINE)
+
+def _parse_ffmpeg_input(stderr: str) -> Tuple[dict, Optional[int], Optional[int]]:
+    # Only the input section, the output section lists the scaled poster frame.
+    input_section = re.split(r'^Stream mapping:|^Output #0', stderr, maxsplit=1, flags=re.MULTILINE)[0]
+    meta = {}
+    width = height = None
+    stream = _FFMPEG_VIDEO_STREAM.search(input_section)
+    if stream:
+        meta['codec'] = stream.group(1)
+        width, height = int(stream.group(2)), int(stream.group(3))
+    duration = _FFMPEG_DURATION.search(input_section)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        meta['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    return meta, width, height
+
+def read_video_meta_and_thumbnail(filepath: str, output_filename_base: str, thumb_size: int) -> Tuple[dict, Optional[int], Optional[int]]:
+    """get_meta for a video that also writes its thumbnail, from the same ffmpeg process."""
+    meta, width, height, poster = read_video(filepath, thumb_size)
+    if poster is not None:
+        try:
+            save_thumbnail(poster, output_filename_base, thumb_size)
+        except Exception as e:
+            print(f"Error generating video thumbnail for {filepath}: {e}. It is generated when first requested instead.")
+        finally:
+            poster.close()
+    return meta, width, height
+
+def get_image_meta(image: PILImage.Image) -> Tuple[dict, int, int]:
+    """Metadata of an opened Pillow image, as get_meta returns it."""
+    return _sanitize_for_json(dict(image.info)), image.width, image.height
+
+def metadata_json(mime_type: Optional[str], meta: dict) -> Optional[str]:
+    """Builds the exif_data column from the mime type and metadata read by get_meta. Returns None if it is not serializable."""
+    combined_meta = {"mime_type": mime_type}
+    if meta:
+        combined_meta.update(meta)
+    # Sanitize the entire dictionary right before dumping to JSON.
+    # This ensures all values, including mime_type, are serializable.
+    try:
+        return json.dumps(_sanitize_for_json(combined_meta))
+    except TypeError:
+        return None
  
-def add_file_to_db(
-    db: Session,
+def stat_fingerprint(st: os.stat_result) -> dict:
+    """Returns the ImageLocation fingerprint columns for a stat result."""
+    return {
+        "file_size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "inode": st.st_ino,
+        "device": st.st_dev,
+    }
+
+def fingerprint_needs_rehash(location, fingerprint: dict) -> bool:
+    """
+    Decides whether a known location must be hashed again.
+    A different size or mtime means the content may have changed. A different inode or
+    device alone (copies with preserved mtimes, remounted network shares) does not, the
+    stored fingerprint is simply refreshed. Locations without a fingerprint predate it
+    and are trusted.
+    """
+    if location.file_size is None or location.mtime_ns is None:
+        return False
+    return location.file_size != fingerprint["file_size"] or location.mtime_ns != fingerprint["mtime_ns"]
+
+def fingerprint_matches(location, fingerprint: dict) -> bool:
+    """Returns True if every stored fingerprint column equals the current one."""
+    return all(getattr(location, key) == value for key, value in fingerprint.items())
+
+def prepare_file_record(
     file_full_path: str,
     existing_checksums: set,
-    image_path_entry: Optional[models.ImagePath] = None,
-    loop: Optional[asyncio.AbstractEventLoop] = None
-) -> Optional[models.ImageLocation]:
-    """Adds a single media file to the database using a provided session."""
-    root, f = os.path.split(file_full_path)
-    existing_location = db.query(models.ImageLocation).where(models.ImageLocation.path == root, models.ImageLocation.filename == f).first()
-
-    if existing_location:
-        # Entry exists for this file location, do nothing.
+    meta_executor: Optional[Executor] = None,
+    st: Optional[os.stat_result] = None,
+    location_id: Optional[int] = None,
+    candidates: Optional[List[Tuple[str, str]]] = None,
+    progress: Optional[ProgressTracker] = None,
+    thumb_size: Optional[int] = None
+) -> Optional[dict]:
+    """
+    Hashes a media file and, if its content is not already known, reads its metadata.
+    With DEFER_METADATA the metadata is left to metadata_enrichment instead, and the
+    content is marked with needs_metadata.
+
+    If thumb_size is given, images up to READ_ONCE_MAX_MB are read into memory once:
+    the buffer is hashed as it is read, and new content is decoded from it for its
+    metadata and its thumbnail, so the file is not opened again for either. New videos
+    get their metadata and thumbnail from one ffmpeg process.
+    This does not touch the database, so it is safe to run on scanner worker threads.
+    The returned record is handed to write_file_record. Pass location_id to re-hash a
+    file that is already in ImageLocation.
+
+    candidates are the known (content_hash, sample_hash) pairs with the file's size, from
+    find_content_candidates. If the file's sample hash matches exactly one of them and
+    TRUST_SAMPLE_HASH is enabled, the file is identified without reading it in full.
+    New content always needs the full hash, since it becomes the content's key.
+    If a progress tracker is given, hashing and metadata reads are timed as its stages.
+    """
+    if not is_supported_media(file_full_path):
+        print(f"Ignoring unsupported file: {file_full_path}")
         return None
 
-    else: # No entry found for this file location, add to database then generate checksum and check against checksum list.
-        new_image_content = None
-        existing_hash = None
-
-        if not is_supported_media(file_full_path):
-            print(f"Ignoring unsupported file: {file_full_path}")
+    if st is None:
+        try:
+            st = os.stat(file_full_path)
+        except OSError as e:
+            print(f"Error reading file status for {file_full_path}: {e}")
             return None
 
-        checksum = get_file_checksum(file_full_path)
-        if not checksum:
-            return None  # Error calculating checksum
+    stage = progress.stage if progress else (lambda name: nullcontext())
+    mime_type, _ = mimetypes.guess_type(file_full_path)
+    is_video = mime_type and mime_type.startswith('video/')
+    read_once = (
+        thumb_size is not None and not is_video
+        and 0 < st.st_size <= config.READ_ONCE_MAX_MB * 1024 * 1024
+    )
+    checksum = None
+    sample_hash = None
+    data = None
+    bytes_read = 0
+    with stage("hash"):
+        if candidates and config.TRUST_SAMPLE_HASH:
+            sample_hash = hashing.get_file_sample_hash(file_full_path, st.st_size)
+            bytes_read += min(st.st_size, 3 * hashing.SAMPLE_BLOCK_SIZE)
+            matches = {content_hash for content_hash, candidate_sample in candidates if candidate_sample == sample_hash}
+            if len(matches) == 1:
+                checksum = matches.pop()
+
+        identified_by_sample = checksum is not None
+        if not identified_by_sample:
+            if read_once:
+                checksum, sample_hash, data = hashing.read_file_checksums(file_full_path, st.st_size)
+            else:
+                checksum, sample_hash = hashing.get_file_checksums(file_full_path, st.st_size)
+            bytes_read += st.st_size
+    if not checksum:
+        return None  # Error calculating checksum
+
+    root, f = os.path.split(file_full_path)
+    record = {
+        "full_path": file_full_path,
+        "path": root,
+        "filename": f,
+        "checksum": checksum,
+        "file_size": st.st_size,
+        "sample_hash": sample_hash,
+        "identified_by_sample": identified_by_sample,
+        "bytes_read": bytes_read,
+        "fingerprint": stat_fingerprint(st),
+        "location_id": location_id,
+        "content": None,
+    }
+
+    # Content we already know about only needs a new location.
+    if checksum in existing_checksums:
+        return record
+
+    needs_metadata = False
+    if data is not None:
+        new_meta, width, height = _read_buffered_image(file_full_path, data, checksum, thumb_size, stage)
+        data = None
+    elif config.DEFER_METADATA:
+        new_meta, width, height = {}, None, None
+        needs_metadata = True
+    elif is_video and thumb_size is not None:
+        with stage("metadata"):
+            new_meta, width, height = read_video_meta_and_thumbnail(file_full_path, checksum, thumb_size)
+    else:
+        with stage("metadata"):
+            if meta_executor:
+                try:
+                    new_meta, width, height = meta_executor.submit(get_meta, file_full_path, False).result()
+                except Exception as e:
+                    # A broken worker process should not lose the file, read the metadata here instead.
+                    print(f"Metadata worker failed for {file_full_path}: {e}. Retrying in scanner thread.")
+                    new_meta, width, height = get_meta(file_full_path, check_exists=False)
+            else:
+                new_meta, width, height = get_meta(file_full_path, check_exists=False)
+
+    json_meta_string = metadata_json(mime_type, new_meta)
+    if json_meta_string is None:
+        print(f'Error in metadata for file: {file_full_path}. Skipping.')
+        return None # Prevent adding a record with bad metadata
+
+    record["content"] = {
+        "exif_data": json_meta_string,
+        "date_created": datetime.fromtimestamp(st.st_ctime, tz=timezone.utc), # This is OS-dependent, might be creation or last metadata change
+        "date_modified": datetime.fromtimestamp(st.st_mtime, tz=timezone.utc), # Last content modification
+        "is_video": is_video,
+        "width": width,
+        "height": height,
+        "file_size": st.st_size,
+        "sample_hash": sample_hash,
+        "hash_algorithm": config.CONTENT_HASH_ALGORITHM,
+        "needs_metadata": needs_metadata,
+    }
+    return record
+
+def _read_buffered_image(file_full_path: str, data: bytearray, checksum: str, thumb_size: int, stage) -> Tuple[dict, Optional[int], Optional[int]]:
+    # Metadata and thumbnail of a new image read into memory by prepare_file_record, from a single decode.
+    try:
+        with PILImage.open(io.BytesIO(data)) as image:
+            with stage("metadata"):
+                meta = get_image_meta(image)
+            with stage("thumbnail"):
+                try:
+                    save_thumbnail(image, checksum, thumb_size)
+                except Exception as e:
+                    print(f"Error generating thumbnail for {file_full_path}: {e}. It is generated when first requested instead.")
+            return meta
+    except Exception as e:
+        print(f"Error getting image metadata for {file_full_path}: {e}")
+        return {}, None, None
+
+def write_file_record(
+    db: Session,
+    record: dict,
+    existing_checksums: set,
+    image_path_entry: Optional[models.ImagePath] = None,
+    loop: Optional[asyncio.AbstractEventLoop] = None
+) -> Optional[models.ImageLocation]:
+    """
+    Writes a record produced by prepare_file_record to the database.
+    Content that was added by someone else since the record was prepared is not inserted twice.
+    Records for an existing location update its content hash and fingerprint instead.
+    """
+    checksum = record["checksum"]
+    new_image_content = None
 
-        # Check against the provided set first for performance
+    if record["content"]:
+        # Another file with the same content may have been written since this record was prepared.
         if checksum in existing_checksums:
             existing_hash = checksum
         else:
@@ -121,235 +393,567 @@ def add_file_to_db(
 
         if not existing_hash:
             # Content does not exist, add new image data
-            print(f"Found new media file: {file_full_path}")
-    
-            mime_type, _ = mimetypes.guess_type(file_full_path)
-            is_video = mime_type and mime_type.startswith('video/')
-
-            initial_meta = {
-                "mime_type": mime_type,
-            }
-
-            new_meta, width, height = get_meta(file_full_path)
-            if new_meta:
-                initial_meta.update(new_meta)
-            
-            # Sanitize the entire dictionary right before dumping to JSON.
-            # This ensures all values, including mime_type, are serializable.
-            sanitized_meta = _sanitize_for_json(initial_meta)
-
-            json_meta_string = "{}"
-            try:
-                json_meta_string = json.dumps(sanitized_meta)
-            except TypeError as e:
-                print(f'Error in metadata for file: {file_full_path}. Skipping.')
-                return None # Prevent adding a record with bad metadata
-
-            creation_timestamp = os.path.getctime(file_full_path) # This is OS-dependent, might be creation or last metadata change
-            modification_timestamp = os.path.getmtime(file_full_path) # Last content modification
-            date_created_dt = datetime.fromtimestamp(creation_timestamp, tz=timezone.utc)
-            date_modified_dt = datetime.fromtimestamp(modification_timestamp, tz=timezone.utc)
-
-            new_image_content = models.ImageContent(
-                content_hash=checksum,
-                exif_data=json_meta_string,
-                date_created=date_created_dt,
-                date_modified=date_modified_dt,
-                is_video=is_video,
-                width=width,
-                height=height
-            )
+            print(f"Found new media file: {record['full_path']}")
+            new_image_content = models.ImageContent(content_hash=checksum, **record["content"])
 
+    if record["location_id"]:
+        # Re-hashed file at a known location, point it at its current content.
+        new_location = db.query(models.ImageLocation).filter(models.ImageLocation.id == record["location_id"]).first()
+        if not new_location:
+            return None
+        if new_location.content_hash != checksum:
+            print(f"Content changed for {record['full_path']}")
+        new_location.content_hash = checksum
+        for key, value in record["fingerprint"].items():
+            setattr(new_location, key, value)
+    else:
         # Add location and reference content by hash.
         new_location = models.ImageLocation(
             content_hash=checksum,
-            filename=f,
-            path=root,
+            filename=record["filename"],
+            path=record["path"],
+            **record["fingerprint"]
         )
 
-        try:
-            if new_image_content:
-                db.add(new_image_content)
+    try:
+        if new_image_content:
+            db.add(new_image_content)
+        elif not record["identified_by_sample"] and record["sample_hash"]:
+            # Known content from before sample hashes were stored, fill them in now that they are free.
+            db.query(models.ImageContent).filter(
+                models.ImageContent.content_hash == checksum, models.ImageContent.file_size.is_(None)
+            ).update({"file_size": record["file_size"], "sample_hash": record["sample_hash"]}, synchronize_session=False)
+        if not record["location_id"]:
             db.add(new_location)
-            db.commit()
-            db.refresh(new_location) # Ensure the object is up-to-date after commit
-            existing_checksums.add(checksum) # Update the in-memory set
-
-            # After successfully adding, broadcast a websocket message if the loop is provided
-            if loop and image_path_entry:
-                # We need to construct the full image object to send to the client
-                image_content = db.query(models.ImageContent).options(
-                    joinedload(models.ImageContent.tags)
-                ).filter_by(content_hash=new_location.content_hash).first()
-
-                if image_content: # Just need to know if it exists to send a message
-                    message_payload = {
-                        "type": "refresh_images",
-                        "reason": "image_added"
-                    }
+        db.commit()
+        db.refresh(new_location) # Ensure the object is up-to-date after commit
+        existing_checksums.add(checksum) # Update the in-memory set
+        if new_image_content and new_image_content.needs_metadata:
+            metadata_enrichment.enricher.enqueue(checksum, record["full_path"], metadata_enrichment.PRIORITY_WATCHER)
+        if new_image_content and config.EAGER_THUMBNAILS and not (new_image_content.needs_metadata and new_image_content.is_video):
+            thumbnail_pregeneration.pregenerator.enqueue(checksum, record["full_path"])
+
+        # After successfully adding, broadcast a websocket message if the loop is provided
+        if loop and image_path_entry:
+            # We need to construct the full image object to send to the client
+            image_content = db.query(models.ImageContent).options(
+                joinedload(models.ImageContent.tags)
+            ).filter_by(content_hash=new_location.content_hash).first()
+
+            if image_content: # Just need to know if it exists to send a message
+                message_payload = {
+                    "type": "refresh_images",
+                    "reason": "image_added"
+                }
+
+                # Determine who to send the message to based on the folder's admin_only status
+                is_admin_only = image_path_entry.admin_only
+                if is_admin_only:
+                    asyncio.run_coroutine_threadsafe(manager.broadcast_to_admins_json(message_payload), loop)
+                else: # For public folders, broadcast to all users (including anonymous)
+                    asyncio.run_coroutine_threadsafe(manager.broadcast_json(message_payload), loop)
+                print(f"Sent 'refresh_images' (image_added) notification for image {new_location.id} (admin_only: {is_admin_only})")
+
+        return new_location
+    except IntegrityError:
+        # This error is expected in a concurrent environment if another thread
+        # has already added the same ImageContent or ImageLocation.
+        db.rollback()
+        return None
+    except Exception as e:
+        db.rollback()
+        print(f"Database error while adding '{record['full_path']}': {e}")
+        return None
 
-                    # Determine who to send the message to based on the folder's admin_only status
-                    is_admin_only = image_path_entry.admin_only
-                    if is_admin_only:
-                        asyncio.run_coroutine_threadsafe(manager.broadcast_to_admins_json(message_payload), loop)
-                    else: # For public folders, broadcast to all users (including anonymous)
-                        asyncio.run_coroutine_threadsafe(manager.broadcast_json(message_payload), loop)
-                    print(f"Sent 'refresh_images' (image_added) notification for image {new_location.id} (admin_only: {is_admin_only})")
-
-            return new_location
-        except IntegrityError:
-            # This error is expected in a concurrent environment if another thread
-            # has already added the same ImageContent or ImageLocation.
-            db.rollback()
-            return None
-        except Exception as e:
-            db.rollback()
-            print(f"Database error while adding '{file_full_path}': {e}")
+def add_file_to_db(
+    db: Session,
+    file_full_path: str,
+    existing_checksums: set,
+    image_path_entry: Optional[models.ImagePath] = None,
+    loop: Optional[asyncio.AbstractEventLoop] = None
+) -> Optional[models.ImageLocation]:
+    """
+    Adds a single media file to the database using a provided session.
+    A file that is already known is only hashed again if its stat fingerprint changed.
+    """
+    root, f = os.path.split(file_full_path)
+    try:
+        st = os.stat(file_full_path)
+    except OSError as e:
+        print(f"Error reading file status for {file_full_path}: {e}")
+        return None
+
+    existing_location = db.query(models.ImageLocation).where(models.ImageLocation.path == root, models.ImageLocation.filename == f).first()
+    location_id = None
+
+    if existing_location:
+        fingerprint = stat_fingerprint(st)
+        if not fingerprint_needs_rehash(existing_location, fingerprint):
+            # Entry exists for this unchanged file, only keep its fingerprint current.
+            if not fingerprint_matches(existing_location, fingerprint):
+                for key, value in fingerprint.items():
+                    setattr(existing_location, key, value)
+                db.commit()
             return None
+        location_id = existing_location.id
 
-def cleanup_orphaned_image_locations(db: Session):
+    # New or changed file, generate checksum and check against checksum list.
+    candidates = find_content_candidates(db, st.st_size)
+    record = prepare_file_record(
+        file_full_path, existing_checksums, st=st, location_id=location_id, candidates=candidates, thumb_size=get_thumbnail_size(db)
+    )
+    if not record:
+        return None
+    return write_file_record(db, record, existing_checksums, image_path_entry, loop)
+
+class ScanPipeline:
     """
-    Finds and removes ImageLocation entries where the path does not exist in the ImagePath table.
-    This is useful for cleaning up the database when image paths are removed.
+    Staged ingestion pipeline used by scan_paths.
+
+    The caller walks the directories and submits files. A bounded pool of threads hashes
+    them, and content that is not yet known is handed to a process pool for Pillow/ffprobe
+    metadata. With DEFER_METADATA, metadata is left to metadata_enrichment instead.
+    Finished records are queued on the IngestWriter from the calling thread, which is the
+    only one that uses the database session. With thumb_size, small new images also get
+    their thumbnail from the hashing read, see prepare_file_record.
+    Finished files and queue depths are reported to the progress tracker, if one is given.
     """
-    print("Checking for orphaned ImageLocation entries...")
-    
-    # Create a subquery to select all valid paths from the ImagePath table.
-    valid_paths_subquery = db.query(models.ImagePath.path).scalar_subquery()
 
-    # Find ImageLocation entries where the path is not in the subquery of valid paths.
-    orphaned_locations_query = db.query(models.ImageLocation).filter(
-        not_(models.ImageLocation.path.in_(valid_paths_subquery))
-    )
+    def __init__(
+        self,
+        writer: IngestWriter,
+        hash_workers: int = config.SCAN_HASH_WORKERS,
+        meta_workers: int = config.SCAN_META_WORKERS,
+        progress: Optional[ProgressTracker] = None,
+        thumb_size: Optional[int] = None
+    ):
+        self.writer = writer
+        self.progress = progress
+        self.thumb_size = thumb_size
+        self.existing_checksums = writer.existing_checksums
+        hash_workers = max(1, hash_workers)
+        # Keep a few files queued per hashing thread so the walker never runs far ahead.
+        self.max_pending = hash_workers * 4
+        self.hash_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="scan-hash")
+        self.meta_executor = None
+        if meta_workers > 0 and not config.DEFER_METADATA:
+            # Spawned workers avoid forking a process that already runs server threads.
+            self.meta_executor = ProcessPoolExecutor(max_workers=meta_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.pending = set()
+        if progress:
+            progress.watch_queue("hash", lambda: len(self.pending))
+            progress.watch_queue("write", writer.pending_rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(
+        self,
+        file_full_path: str,
+        st: Optional[os.stat_result] = None,
+        location_id: Optional[int] = None,
+        candidates: Optional[List[Tuple[str, str]]] = None
+    ):
+        """Queues a file for hashing, handing finished records to the writer first if the queue is full."""
+        while len(self.pending) >= self.max_pending:
+            self._write_finished(block=True)
+        future = self.hash_executor.submit(
+            prepare_file_record, file_full_path, self.existing_checksums, self.meta_executor, st, location_id, candidates, self.progress,
+            self.thumb_size
+        )
+        self.pending.add(future)
 
-    # Execute the delete operation.
-    num_deleted = orphaned_locations_query.delete(synchronize_session=False)
+    def drain(self):
+        """Waits for every submitted file and writes its record."""
+        while self.pending:
+            self._write_finished(block=True)
+        self.writer.flush()
 
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            self.hash_executor.shutdown(wait=True)
+            if self.meta_executor:
+                self.meta_executor.shutdown(wait=True)
+
+    def _write_finished(self, block: bool):
+        done, self.pending = wait(self.pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                record = future.result()
+            except Exception as e:
+                print(f"Error preparing file during scan: {e}")
+                record = None
+            if self.progress:
+                self.progress.add_files(1, record["bytes_read"] if record else 0)
+            if record:
+                self.writer.add_record(record)
+
+def cleanup_orphaned_image_locations(db: Session, path: Optional[str] = None):
+    """
+    Finds and removes ImageLocation entries where the path does not exist in the ImagePath table.
+    This is useful for cleaning up the database when image paths are removed.
+    Pass path to only check the locations in that directory, e.g. after its ImagePath was deleted.
+    """
+    print(f"Checking for orphaned ImageLocation entries{f' in {path}' if path else ''}...")
+    start_time = time.perf_counter()
+
+    # Compare directories rather than locations. The distinct paths are read from the
+    # (path, filename) index, so this is one pass over the index and one DELETE per missing path.
+    location_paths_query = db.query(models.ImageLocation.path).distinct()
+    if path is not None:
+        location_paths_query = location_paths_query.filter(models.ImageLocation.path == path)
+    location_paths = {row.path for row in location_paths_query}
+    valid_paths = {row.path for row in db.query(models.ImagePath.path)}
+    orphaned_paths = sorted(location_paths - valid_paths)
+
+    num_deleted = 0
+    for chunk_start in range(0, len(orphaned_paths), SQL_CHUNK_SIZE):
+        chunk = orphaned_paths[chunk_start:chunk_start + SQL_CHUNK_SIZE]
+        num_deleted += db.query(models.ImageLocation).filter(
+            models.ImageLocation.path.in_(chunk)
+        ).delete(synchronize_session=False)
+
+    duration = time.perf_counter() - start_time
     if num_deleted > 0:
         db.commit()
-        print(f"Deleted {num_deleted} orphaned ImageLocation entries.")
+        print(f"Deleted {num_deleted} orphaned ImageLocation entries in {len(orphaned_paths)} removed paths in {duration:.2f} seconds.")
     else:
-        print("No orphaned ImageLocation entries found.")
+        print(f"No orphaned ImageLocation entries found ({duration:.2f} seconds).")
+
+def apply_folder_tags(db: Session, folder_ids: List[int]) -> int:
+    """
+    Adds the tags of the given folders to every image located directly in them, with one
+    INSERT OR IGNORE ... SELECT per chunk of folders. Returns the number of tag links added.
+    The caller commits.
+    """
+    added = 0
+    for chunk_start in range(0, len(folder_ids), SQL_CHUNK_SIZE):
+        chunk = folder_ids[chunk_start:chunk_start + SQL_CHUNK_SIZE]
+        folder_image_tags = select(
+            models.ImageLocation.content_hash, models.imagepath_tags.c.tag_id
+        ).select_from(models.ImageLocation).join(
+            models.ImagePath, models.ImagePath.path == models.ImageLocation.path
+        ).join(
+            models.imagepath_tags, models.imagepath_tags.c.imagepath_id == models.ImagePath.id
+        ).where(models.ImagePath.id.in_(chunk)).distinct()
+        result = db.execute(
+            insert(models.image_tags).prefix_with("OR IGNORE").from_select(['image_id', 'tag_id'], folder_image_tags)
+        )
+        added += max(result.rowcount, 0)
+    return added
 
-def check_and_apply_folder_tags(db: Session):
+def check_and_apply_folder_tags(db: Session, scope: Optional[str] = None, recursive: bool = True):
     """
     Ensures all images within a folder have the tags assigned to that folder.
-    This acts as a data integrity check.
+    This acts as a data integrity check. Only tagged folders that changed since their last
+    check are reconciled: folders whose tags changed, and folders with locations scanned
+    since then. Pass scope to only check that folder, and its subfolders if recursive.
     """
     print("Checking for folder tag inheritance consistency...")
-    folders_with_tags = db.query(models.ImagePath).options(joinedload(models.ImagePath.tags)).filter(models.ImagePath.tags.any()).all()
+    start_time = time.perf_counter()
+    # Taken before reading, so locations written during the check are picked up next time.
+    checked_at = datetime.now(timezone.utc)
+
+    has_tags = exists().where(models.imagepath_tags.c.imagepath_id == models.ImagePath.id)
+    scanned_since_check = exists().where(
+        models.ImageLocation.path == models.ImagePath.path,
+        models.ImageLocation.date_scanned > models.ImagePath.tags_checked_at
+    )
+    folders_query = db.query(models.ImagePath.id).filter(
+        has_tags, or_(models.ImagePath.tags_checked_at.is_(None), scanned_since_check)
+    )
+    if scope is not None:
+        folders_query = folders_query.filter(_path_scope_filter(models.ImagePath.path, scope, recursive))
+    folder_ids = [row.id for row in folders_query]
 
-    if not folders_with_tags:
-        print("No folders with tags found. Skipping consistency check.")
+    if not folder_ids:
+        print(f"No tagged folders changed since the last check. Skipping consistency check ({time.perf_counter() - start_time:.2f} seconds).")
         return
 
-    for folder in folders_with_tags:
-        folder_tag_ids = {tag.id for tag in folder.tags}
-        if not folder_tag_ids:
-            continue
+    added = apply_folder_tags(db, folder_ids)
+    for chunk_start in range(0, len(folder_ids), SQL_CHUNK_SIZE):
+        db.query(models.ImagePath).filter(
+            models.ImagePath.id.in_(folder_ids[chunk_start:chunk_start + SQL_CHUNK_SIZE])
+        ).update({models.ImagePath.tags_checked_at: checked_at}, synchronize_session=False)
+    print(f"Applied {added} missing folder tags in {len(folder_ids)} changed folders in {time.perf_counter() - start_time:.2f} seconds.")
 
-        # Get all ImageContent objects for images in this folder
-        content_hashes_in_path = db.query(models.ImageLocation.content_hash).filter(models.ImageLocation.path == folder.path).distinct()
-        images_to_check = db.query(models.ImageContent).options(joinedload(models.ImageContent.tags)).filter(
-            models.ImageContent.content_hash.in_(content_hashes_in_path)
-        ).all()
+def _path_scope_filter(column, scope: str, recursive: bool = True):
+    """Filters a path column to scope, and with recursive to everything below it as well."""
+    if not recursive:
+        return column == scope
+    return or_(column == scope, column.startswith(scope.rstrip(os.sep) + os.sep, autoescape=True))
+
+class DirectoryListing:
+    """
+    Iterates the file entries of a directory, collecting subdirectory names as it goes.
+    Subdirectories that are not symlinks are also added to walk_into. complete is only
+    True once every entry was read without an error, so a caller can trust that a
+    file missing from the listing is really gone.
+    """
 
-        for image_content in images_to_check:
-            image_tag_ids = {tag.id for tag in image_content.tags}
-            missing_tags = [tag for tag in folder.tags if tag.id not in image_tag_ids]
-            if missing_tags:
-                print(f"Found image ID {image_content.content_hash} in '{folder.path}' missing {len(missing_tags)} folder tags. Applying them now.")
-                image_content.tags.extend(missing_tags)
+    def __init__(self, directory: str, subdirectories: List[str], walk_into: List[str]):
+        self.directory = directory
+        self.subdirectories = subdirectories
+        self.walk_into = walk_into
+        self.complete = False
 
-def scan_paths(db: Session):
+    def __iter__(self) -> Iterator[os.DirEntry]:
+        errors = False
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir():
+                            self.subdirectories.append(entry.name)
+                            if not entry.is_symlink():
+                                self.walk_into.append(entry.path)
+                        else:
+                            yield entry
+                    except OSError as e:
+                        errors = True
+                        print(f"Error reading directory entry {entry.path}: {e}")
+        except OSError as e:
+            print(f"Error reading directory {self.directory}: {e}")
+            return
+        self.complete = not errors
+
+def walk_directory_tree(top: str, resume_after: Optional[str] = None) -> Iterator[Tuple[str, List[str], DirectoryListing]]:
     """
-    Scans all configured paths for new subdirectories and files, committing each discovery immediately.
-    This function uses a provided database session to perform its operations.
+    Streaming replacement for os.walk built on os.scandir.
+
+    Yields (directory, subdirectory_names, file_entries) per directory, top-down. The
+    file entries are read lazily from scandir, so even a directory with hundreds of
+    thousands of files is never held in memory at once, and each DirEntry caches its
+    stat result for the rest of the pipeline. subdirectory_names is only complete
+    once file_entries has been exhausted, and file_entries.complete then tells whether
+    the directory was read without errors. Like os.walk, symlinked directories are
+    listed but not followed.
+
+    If resume_after is given, the walk continues after that directory. Directories
+    before it are not yielded, and only those on the way to it are listed at all.
     """
-    print(f"[{datetime.now().isoformat()}] Starting file scan...")
+    resume_key = walk_order_key(resume_after, top) if resume_after else None
+    pending = [top]
+    while pending:
+        directory = pending.pop()
+        subdirectories = []
+        walk_into = []
+        entries = DirectoryListing(directory, subdirectories, walk_into)
+        key = walk_order_key(directory, top) if resume_key is not None else None
+        if key is not None and key <= resume_key:
+            if key != resume_key[:len(key)]:
+                continue # Its whole subtree comes before the resume position
+            # Done already, but its later subdirectories are not
+            for _ in entries:
+                pass
+        else:
+            yield directory, subdirectories, entries
+        # Reverse-sorted so subdirectories are popped, and walked, in name order.
+        pending.extend(sorted(walk_into, reverse=True))
+
+def scan_paths(
+    db: Session,
+    image_path_id: Optional[int] = None,
+    recursive: bool = True,
+    on_directory: Optional[Callable[[str], None]] = None
+):
+    """
+    Scans all configured paths for new subdirectories and files.
+    If image_path_id is given, only that ImagePath is scanned, with its subdirectories unless
+    recursive is False. Orphaned locations are not cleaned up then, as no path was removed.
+    Files are hashed and read in parallel by a ScanPipeline, and new rows are written in batched
+    transactions by an IngestWriter using the provided session.
+    Progress is saved by ScanCheckpoints, so an interrupted scan resumes where it stopped,
+    and reported live by the 'scan' progress tracker. on_directory, if given, is called with each
+    directory the walk reaches, in the order of scan_checkpoints.path_order_key.
+    """
+    scope = None
+    if image_path_id is not None:
+        scope_entry = db.query(models.ImagePath).filter(models.ImagePath.id == image_path_id).first()
+        if scope_entry is None:
+            print(f"Scan requested for ImagePath ID {image_path_id}, which does not exist. Skipping.")
+            return
+        scope = scope_entry.path
+    scan_name = "Scoped file scan" if scope else "Full file scan"
+
+    if scope:
+        print(f"[{datetime.now().isoformat()}] Starting file scan of '{scope}'{'' if recursive else ' without subdirectories'}...")
+    else:
+        print(f"[{datetime.now().isoformat()}] Starting file scan...")
     scan_start = datetime.now()
 
     new_subdirectories_found = 0
     total_new_files = 0
+    total_changed_files = 0
+    total_removed_files = 0
     total_directories_found = 0
     total_files = 0
+    covered_paths = 0
+    progress = scan_progress.get_tracker("scan")
+    progress.start()
 
     try:
         # Before scanning, clean up any locations that point to now-deleted paths.
-        cleanup_orphaned_image_locations(db)
-
-        # Also, ensure folder tags are correctly inherited by all images.
-        check_and_apply_folder_tags(db)
-        db.commit() # Commit any changes from the tag consistency check
+        if scope is None:
+            cleanup_orphaned_image_locations(db)
 
         # Fetch all existing paths and checksums once at the start.
-        paths_to_scan = db.query(models.ImagePath).all()
-        existing_image_paths = {p.path for p in paths_to_scan}
-        existing_image_checksums = {row[0] for row in db.query(models.ImageContent.content_hash).all()}
-
-        for image_path_entry in paths_to_scan:
-            current_path = image_path_entry.path
-            if not os.path.isdir(current_path):
-                print(f"Warning: Configured path '{current_path}' does not exist or is not a directory. Skipping.")
-                continue
+        paths_query = db.query(models.ImagePath)
+        if scope is not None:
+            paths_query = paths_query.filter(_path_scope_filter(models.ImagePath.path, scope))
+        existing_image_paths = {p.path for p in paths_query}
+        # Known subdirectory names per directory, to notice directories removed from disk.
+        known_subdirectories = defaultdict(set)
+        for known_path in existing_image_paths:
+            parent_path, name = os.path.split(known_path)
+            known_subdirectories[parent_path].add(name)
+        # Sorted by path so a parent is walked before its subdirectories, which its walk covers.
+        paths_to_scan = [scope_entry] if scope is not None else sorted(paths_query, key=lambda p: path_order_key(p.path))
+        existing_image_checksums = checksum_index.get_checksum_index(db)
+        checkpoints = ScanCheckpoints(db, scope, recursive)
+        progress.set_total(checkpoints.expected_files(), estimated=True, files_done=checkpoints.run.files_done or 0)
+
+        pregenerator = thumbnail_pregeneration.pregenerator if config.EAGER_THUMBNAILS else None
+        writer = IngestWriter(db, existing_image_checksums, progress=progress, enricher=metadata_enrichment.enricher, pregenerator=pregenerator)
+        with writer, ScanPipeline(writer, progress=progress, thumb_size=get_thumbnail_size(db)) as pipeline:
+            for image_path_entry in paths_to_scan:
+                current_path = image_path_entry.path
+                if checkpoints.is_walked(current_path):
+                    covered_paths += 1
+                    continue
+                if not os.path.isdir(current_path):
+                    print(f"Warning: Configured path '{current_path}' does not exist or is not a directory. Skipping.")
+                    continue
             
-            print(f"Scanning directory: {current_path}")
-            path_time = datetime.now()
-            path_files_scanned = 0
+                print(f"Scanning directory: {current_path}")
+                path_time = datetime.now()
+                path_files_scanned = 0
+                path_new_files = writer.inserted_locations
+                path_changed_files = writer.updated_locations
+                path_removed_files = writer.deleted_locations
+                resume_after = checkpoints.start_path(current_path)
+                progress.set_path(current_path)
+                if on_directory and resume_after:
+                    on_directory(resume_after)
             
-            for root, dirs, files in os.walk(current_path):
-                # --- Discover and immediately commit subdirectories ---
-                for d in dirs:
-                    subdir_full_path = os.path.join(root, d)
-                    if subdir_full_path not in existing_image_paths:
+                for root, dirs, entries in walk_directory_tree(current_path, resume_after):
+                    if on_directory:
+                        on_directory(root)
+                    # --- Discover files, hashing only new ones and ones whose fingerprint changed ---
+                    known_locations = {
+                        row.filename: row for row in db.query(
+                            models.ImageLocation.id, models.ImageLocation.filename, models.ImageLocation.file_size,
+                            models.ImageLocation.mtime_ns, models.ImageLocation.inode, models.ImageLocation.device
+                        ).filter(models.ImageLocation.path == root)
+                    }
+
+                    listed_files = set()
+                    for entry in entries:
+                        path_files_scanned += 1
+                        f = entry.name
+                        listed_files.add(f)
+                        file_full_path = entry.path
+                        if not is_supported_media(file_full_path):
+                            print(f"Ignoring unsupported file: {file_full_path}")
+                            progress.add_files(1)
+                            continue
                         try:
+                            st = entry.stat() # Cached on the DirEntry and reused for hashing, metadata and the DB row
+                        except OSError as e:
+                            print(f"Error reading file status for {file_full_path}: {e}")
+                            progress.add_files(1)
+                            continue
+
+                        known_location = known_locations.get(f)
+                        if known_location:
+                            fingerprint = stat_fingerprint(st)
+                            if fingerprint_needs_rehash(known_location, fingerprint):
+                                pipeline.submit(file_full_path, st, known_location.id, find_content_candidates(db, st.st_size))
+                            else:
+                                if not fingerprint_matches(known_location, fingerprint):
+                                    writer.update_fingerprint({"id": known_location.id, **fingerprint})
+                                progress.add_files(1)
+                            continue
+                        pipeline.submit(file_full_path, st, None, find_content_candidates(db, st.st_size))
+
+                    # --- Remove locations of files that are gone, unless the listing may be incomplete ---
+                    if entries.complete:
+                        missing_ids = [row.id for name, row in known_locations.items() if name not in listed_files]
+                        if missing_ids:
+                            print(f"Found {len(missing_ids)} media files removed from '{root}'.")
+                            writer.delete_locations(missing_ids)
+                        # A removed subdirectory is never walked, so its locations, and those below it, go here.
+                        for d in known_subdirectories.get(root, set()) - set(dirs):
+                            removed_dir = os.path.join(root, d)
+                            removed_ids = [row.id for row in db.query(models.ImageLocation.id).filter(
+                                _path_scope_filter(models.ImageLocation.path, removed_dir)
+                            )]
+                            if removed_ids:
+                                print(f"Directory '{removed_dir}' was removed, removing its {len(removed_ids)} media files.")
+                                writer.delete_locations(removed_ids)
+
+                    # --- Discover subdirectories, written in batches by the IngestWriter ---
+                    # The list is complete now that every entry of this directory has been read.
+                    for d in dirs:
+                        subdir_full_path = os.path.join(root, d)
+                        if subdir_full_path not in existing_image_paths:
                             print(f"Found new subdirectory: {subdir_full_path}")
-                            new_image_path = models.ImagePath(
+                            writer.add_image_path(dict(
                                 path=subdir_full_path, parent=root, description=f"Auto-added: {d}",
                                 short_name=d, is_ignored=False, admin_only=True, basepath=False, built_in=False
-                            )
-                            db.add(new_image_path)
-                            db.commit()
+                            ))
                             existing_image_paths.add(subdir_full_path) # Update in-memory set
-                            new_subdirectories_found += 1
-                            print(f"Committed new subdirectory: {subdir_full_path}")
-                        except Exception as e:
-                            print(f"Error committing subdirectory {subdir_full_path}: {e}")
-                            db.rollback()
-
-                # --- Discover and immediately commit files ---
-                files.sort(key=lambda fn: os.path.getctime(os.path.join(root, fn)))
-                for f in files:
-                    path_files_scanned += 1
-                    file_full_path = os.path.join(root, f)
-                    # During the main scan, we don't have the asyncio loop, so we can't send websockets here.
-                    # The file watcher will handle real-time updates for newly created files.
-                    # We pass the image_path_entry for consistency, though the loop is None.
-                    newly_added_location = add_file_to_db(db, file_full_path, existing_image_checksums, image_path_entry, None)
-                    if newly_added_location:
-                        total_new_files += 1
-            
-            total_files += path_files_scanned
-            total_directories_found += 1
-            print(f"Scanned {path_files_scanned} files in '{current_path}' in {datetime.now() - path_time}.")
+
+                    if not recursive:
+                        break # Only the top directory, its subdirectories were recorded above
+
+                    if checkpoints.is_due():
+                        # Everything up to this directory must be written before it can be saved as the resume position.
+                        pipeline.drain()
+                        checkpoints.checkpoint(root, path_files_scanned)
+
+                # Finish this path before reporting on it.
+                pipeline.drain()
+                checkpoints.finish_path(path_files_scanned)
+                total_new_files += writer.inserted_locations - path_new_files
+                total_changed_files += writer.updated_locations - path_changed_files
+                total_removed_files += writer.deleted_locations - path_removed_files
+                total_files += path_files_scanned
+                total_directories_found += 1
+                print(f"Scanned {path_files_scanned} files in '{current_path}' in {datetime.now() - path_time}.")
+        checkpoints.finish()
+        new_subdirectories_found = writer.inserted_image_paths
+
+        # Ensure folder tags are inherited by all images, including the ones just found.
+        # Only folders with changed tags or new locations are checked.
+        check_and_apply_folder_tags(db, scope, recursive)
+        db.commit() # Commit any changes from the tag consistency check
+        if covered_paths:
+            print(f"Skipped {covered_paths} paths already covered by the walk of a parent path.")
     finally:
-        pass # The session is managed by the caller
+        progress.finish() # The session is managed by the caller
 
     scan_duration = datetime.now() - scan_start
-    print(f"[{datetime.now().isoformat()}] Full file scan of {total_directories_found} paths and {total_files} files finished in {scan_duration}.")
-    print(f"[{datetime.now().isoformat()}] Found {new_subdirectories_found} new subdirectories and {total_new_files} new media files.")
+    print(f"[{datetime.now().isoformat()}] {scan_name} of {total_directories_found} paths and {total_files} files finished in {scan_duration}.")
+    print(f"[{datetime.now().isoformat()}] Found {new_subdirectories_found} new subdirectories, {total_new_files} new, {total_changed_files} changed and {total_removed_files} removed media files.")
 
-def get_file_checksum(filepath: str, block_size=65536):
-    # Calculates the SHA256 checksum of a file.
-    sha256 = hashlib.sha256()
-    try:
-        with open(filepath, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                sha256.update(block)
-        return sha256.hexdigest()
-    except Exception as e:
-        print(f"Error calculating checksum for {filepath}: {e}")
-        return None
+def find_content_candidates(db: Session, file_size: int) -> List[Tuple[str, str]]:
+    """
+    Returns (content_hash, sample_hash) of known content with exactly this size, using the file_size index.
+    Without TRUST_SAMPLE_HASH they would never be used, so the database is not queried.
+    """
+    if not config.TRUST_SAMPLE_HASH:
+        return []
+    return [
+        (row.content_hash, row.sample_hash) for row in db.query(
+            models.ImageContent.content_hash, models.ImageContent.sample_hash
+        ).filter(models.ImageContent.file_size == file_size, models.ImageContent.sample_hash.isnot(None))
+    ]
 
 def is_supported_media(filepath: str):
     # Checks if a file is a supported image or video based on its MIME type.
@@ -361,23 +965,26 @@ def generate_thumbnail_in_background(
     image_checksum: str,
     original_filepath: str,
     loop: Optional[asyncio.AbstractEventLoop] = None, # Add loop parameter
-):
+) -> Optional[str]:
+    # Runs on a thumbnail_service worker. Returns the thumbnail path, or None if it could not be generated.
     thread_db = database.SessionLocal() # This session is for this background thread
+    thumb_filepath = None
     try:
         print(f"Background: Starting thumbnail generation for image ID {image_id}, checksum {image_checksum}")
 
-        thumb_size_setting = thread_db.query(models.Setting).filter_by(name='thumb_size').first()
-        # Fallback to config if setting is not in DB
-        thumb_size = config.THUMBNAIL_SIZE
-        if thumb_size_setting and thumb_size_setting.value:
-            thumb_size = int(thumb_size_setting.value)
-
-        generate_thumbnail(
-            image_id=image_id,
-            source_filepath=original_filepath,
-            output_filename_base=image_checksum,
-            thumb_size=thumb_size
-        )
+        thumb_size = get_thumbnail_size(thread_db)
+        preview_size = get_preview_size(thread_db)
+
+        # A user is waiting for this one, eager pre-generation holds back meanwhile.
+        with thumbnail_pregeneration.pregenerator.user_request():
+            thumb_filepath = generate_thumbnail(
+                image_id=image_id,
+                source_filepath=original_filepath,
+                output_filename_base=image_checksum,
+                thumb_size=thumb_size,
+                preview_size=preview_size,
+                ladder=True # Requested by a client, which may want any size
+            )
         print(f"Background: Finished thumbnail generation for image ID {image_id}")
         
         # Fetch the full image object to send to the frontend
@@ -410,18 +1017,132 @@ def generate_thumbnail_in_background(
         print(f"Background: Error generating thumbnail for image ID {image_id}: {e}")
     finally:
         thread_db.close()
+    return str(thumb_filepath) if thumb_filepath else None
+
+def get_thumbnail_size(db: Session) -> int:
+    """The 'thumb_size' setting, or THUMBNAIL_SIZE from the config if it is not set."""
+    thumb_size_setting = db.query(models.Setting).filter_by(name='thumb_size').first()
+    if thumb_size_setting and thumb_size_setting.value:
+        return int(thumb_size_setting.value)
+    return config.THUMBNAIL_SIZE
+
+def decode_scaled(image: PILImage.Image, size: int) -> PILImage.Image:
+    """
+    Decodes an opened image at the smallest cheap scale that still covers size x size.
+    JPEGs are decoded with DCT scaling at 1/2, 1/4 or 1/8 of their resolution, which is
+    only possible before the image is loaded. Other formats are decoded in full and shrunk
+    by an integer factor with reduce(). Either way the final resize has little left to do.
+    Read metadata and dimensions before calling this, a JPEG reports its scaled size after.
+    """
+    if image.format == "JPEG":
+        image.draft(image.mode, (size, size))
+        return image
+    factor = max(image.width, image.height) // size
+    if factor < 2 or image.mode in ("1", "P"):
+        return image # reduce() does not average palette or bilevel images
+    return image.reduce(factor)
+
+def get_preview_size(db: Session) -> Optional[int]:
+    """The 'preview_size' setting if previews are enabled, otherwise None."""
+    settings = {setting.name: setting.value for setting in db.query(models.Setting).filter(
+        models.Setting.name.in_(('enable_previews', 'preview_size'))
+    )}
+    if (settings.get('enable_previews') or '').lower() != 'true':
+        return None
+    return int(settings.get('preview_size') or config.PREVIEW_SIZE)
+
+def thumbnail_sizes(thumb_size: int) -> List[int]:
+    """All thumbnail sizes, ascending: thumb_size and the THUMBNAIL_LADDER sizes."""
+    return sorted(set(config.THUMBNAIL_LADDER) | {thumb_size})
+
+def thumbnail_filepath(output_filename_base: str, size: Optional[int] = None) -> str:
+    """Path of the thumbnail of size, or without size, of the thumbnail from before thumbnails were keyed by size."""
+    return derivative_index.path(output_filename_base, size)
+
+def find_thumbnail(output_filename_base: str, size: int) -> Tuple[Optional[str], Derivative]:
+    """
+    The existing thumbnail that best serves size: the smallest one at least that large, or
+    else the largest one, whether or not it was made at the current settings. Falls back to
+    a thumbnail from before thumbnails were keyed by size. Returns its path and derivative,
+    or (None, None) if there is none.
+    """
+    derivatives = derivative_index.derivatives(output_filename_base)
+    sizes = sorted(derivative for derivative in derivatives if isinstance(derivative, int))
+    if sizes:
+        best = next((s for s in sizes if s >= size), sizes[-1])
+        return thumbnail_filepath(output_filename_base, best), best
+    if THUMBNAIL in derivatives:
+        return thumbnail_filepath(output_filename_base), THUMBNAIL
+    return None, None
+
+def thumbnail_is_current(output_filename_base: str, thumb_size: int) -> bool:
+    """Whether the thumbnails were made at thumb_size, rather than at an earlier setting or not at all."""
+    return derivative_index.has(output_filename_base, thumb_size)
+
+def save_derivative(image: PILImage.Image, output_filename_base: str, derivative: Derivative):
+    """Writes an image as a derivative of output_filename_base, to the pack store if PACKED_THUMBNAILS is set."""
+    if config.PACKED_THUMBNAILS:
+        buffer = io.BytesIO()
+        image.save(buffer, DERIVATIVE_FORMAT, **DERIVATIVE_SAVE_OPTIONS)
+        if pack_store.put(output_filename_base, derivative, buffer.getbuffer()):
+            derivative_index.add(output_filename_base, derivative)
+            return
+    path = derivative_path(output_filename_base, derivative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    image.save(path, DERIVATIVE_FORMAT, **DERIVATIVE_SAVE_OPTIONS)
+    pack_store.delete(output_filename_base, derivative) # Packed derivatives are served first, drop an older one
+    derivative_index.add(output_filename_base, derivative)
+
+def save_thumbnail(
+    image: PILImage.Image,
+    output_filename_base: str,
+    thumb_size: int,
+    preview_size: Optional[int] = None,
+    ladder: bool = False
+) -> Path:
+    """
+    Writes the thumbnail for output_filename_base at thumb_size, with ladder the other ladder
+    sizes and, with preview_size, the preview, all from one decode of an opened image. The image is
+    decoded once at the largest size and each smaller one is scaled from the one above it.
+    Sizes at or above the image's own size would all repeat it, so only one of them is written.
+    Ingest only writes thumb_size, the other ladder sizes are written once a client asks for one.
+    Thumbnails are keyed by their size, so ones made at an earlier thumb_size are only
+    removed once these are written, and serve meanwhile. Returns the path of the thumb_size thumbnail.
+    """
+    sizes = thumbnail_sizes(thumb_size) if ladder else [thumb_size]
+    longest_side = max(image.size)
+    full_size = thumb_size if thumb_size >= longest_side else min(s for s in sizes if s >= longest_side or s == sizes[-1])
+    derivatives = [(size, size) for size in sizes if size < longest_side or size == full_size or size == thumb_size]
+    if preview_size:
+        derivatives.append((preview_size, PREVIEW))
+    derivatives.sort(key=lambda item: item[0], reverse=True)
+
+    written = {derivative for _, derivative in derivatives}
+    kept = written | set(config.THUMBNAIL_LADDER) # Ladder sizes stay valid whatever thumb_size is
+    superseded = [
+        derivative for derivative in derivative_index.derivatives(output_filename_base)
+        if derivative != PREVIEW and derivative not in kept
+    ]
+    image = decode_scaled(image, derivatives[0][0])
+    for size, derivative in derivatives:
+        image.thumbnail((size, size))
+        save_derivative(image, output_filename_base, derivative)
+    for derivative in superseded:
+        remove_derivative(output_filename_base, derivative)
+    return Path(derivative_path(output_filename_base, thumb_size))
 
 def generate_thumbnail(
     image_id: int,
     source_filepath: str,
     output_filename_base: str,
     thumb_size: int,
+    preview_size: Optional[int] = None,
+    ladder: bool = False,
 ) -> str:
 
     generated_urls = {}
     source_path_obj = source_filepath
     image_to_process = None
-    temp_image_path = None
 
     if not os.path.exists(source_filepath):
         print(f"Error: Source file not found: {source_filepath}")
@@ -431,53 +1152,22 @@ def generate_thumbnail(
     mime_type, _ = mimetypes.guess_type(source_filepath)
     is_video = mime_type and mime_type.startswith('video')
 
-    # FIX THIS
-    # Needs proper pathing
-    thumbnail_output_dir = Path(str(config.THUMBNAILS_DIR))
-    os.makedirs(thumbnail_output_dir, exist_ok=True)
-    thumb_filepath = os.path.join(thumbnail_output_dir, f"{output_filename_base}_thumb.webp")
+    # save_derivative creates the shard directory, or packs the thumbnail
+    thumb_filepath = derivative_path(output_filename_base, thumb_size)
 
     if is_video:
-        try:
-            temp_image_path = os.path.join(thumbnail_output_dir, f'{output_filename_base}_thumb.png')
-            # Use ffmpeg to generate thumbnail from video
-            # -ss 00:00:01: Take a screenshot at 1 second into the video
-            # -vframes 1: Take only one frame
-            # -vf scale='min(iw,{thumb_size}):min(ih,{thumb_size})': Scale to fit within thumb_size while maintaining aspect ratio
-            # -q:v 2: Output quality (2 is good, 1-31, lower is better)
-            # -y: Overwrite output file without asking
-            ffmpeg_command = [
-                'ffmpeg',
-                '-i', source_filepath,
-                '-ss', '00:00:00.001',
-                '-vframes', '1',
-                '-vf', f"scale='min({thumb_size},iw)':'min({thumb_size},ih)':force_original_aspect_ratio=decrease",
-                '-q:v', '2',
-                '-y',
-                str(temp_image_path)
-            ]
-            print(f"Running FFmpeg command: {' '.join(ffmpeg_command)}")
-            subprocess.run(ffmpeg_command, check=True, capture_output=True)
-            print(f"Generated video thumbnail: {thumb_filepath}")
-
-            image_to_process = PILImage.open(temp_image_path)
-        except subprocess.CalledProcessError as e:
-            print(f"Error generating video thumbnail with ffmpeg for {source_filepath}: {e}")
-            print(f"FFmpeg stdout: {e.stdout.decode()}")
-            print(f"FFmpeg stderr: {e.stderr.decode()}")
-        except Exception as e:
-            print(f"Error executing ffmpeg for {source_filepath}: {e}")
+        # The poster frame is piped from ffmpeg, already scaled down to the largest size needed.
+        sizes = thumbnail_sizes(thumb_size) if ladder else [thumb_size]
+        _, _, _, image_to_process = read_video(source_filepath, max(sizes + [preview_size or 0]))
+        if image_to_process is None:
+            return None
     else:
         image_to_process = PILImage.open(source_filepath)
 
     try:
 
         # Generate Thumbnail
-        thumb_img = image_to_process.copy()
-        thumb_img.thumbnail((thumb_size,thumb_size))
-        thumb_filepath = thumbnail_output_dir / f"{output_filename_base}_thumb.webp"
-        thumb_img.save(thumb_filepath, "webp")
-        thumb_img.close()
+        thumb_filepath = save_thumbnail(image_to_process, output_filename_base, thumb_size, preview_size, ladder)
         image_to_process.close()
         print(f"Generated thumbnail: {thumb_filepath}")
 
@@ -487,15 +1177,6 @@ def generate_thumbnail(
         print(f"Error generating image thumbnail for {source_filepath}: {e}")
         return None
 
-    if (temp_image_path):
-        if (os.path.exists(temp_image_path)):
-            try:
-                os.remove(temp_image_path)
-                print(f"Deleted temporary thumbnail file: {temp_image_path}")
-            except Exception as e:
-                print(f"Error deleting temporary file {temp_image_path}: {e}")
-                return None
-
     return thumb_filepath
 
 def generate_preview_in_background(
@@ -536,19 +1217,11 @@ def generate_preview(
     try:
         img = PILImage.open(source_filepath)
 
-        import config
-
-        # FIX THIS
-        # Needs proper pathing
-        preview_output_dir = Path(str(config.PREVIEWS_DIR))
-
-        os.makedirs(preview_output_dir, exist_ok=True)
-
         # Generate Preview
-        preview_img = img.copy()
+        preview_img = decode_scaled(img, preview_size)
         preview_img.thumbnail((preview_size,preview_size))
-        preview_filepath = preview_output_dir / f"{output_filename_base}_preview.webp"
-        preview_img.save(preview_filepath, "webp")
+        preview_filepath = derivative_path(output_filename_base, PREVIEW)
+        save_derivative(preview_img, output_filename_base, PREVIEW)
         print(f"Generated preview: {preview_filepath}")
 
     except PILImage.UnidentifiedImageError:
@@ -571,6 +1244,8 @@ def reprocess_metadata_task(db_session_factory, scope: str, identifier: Optional
             - For 'all', this is not used.
     """
     db = db_session_factory()
+    progress = scan_progress.get_tracker("metadata")
+    progress.start()
     try:
         print(f"[{datetime.now().isoformat()}] Starting metadata reprocessing task for scope: {scope}, identifier: {identifier}")
         start_time = time.time()
@@ -591,15 +1266,19 @@ def reprocess_metadata_task(db_session_factory, scope: str, identifier: Optional
 
         total_items = len(locations_to_process)
         print(f"Found {total_items} items to reprocess.")
+        progress.set_total(total_items)
 
         for index, location in enumerate(locations_to_process):
             full_path = os.path.join(location.path, location.filename)
+            progress.set_path(location.path)
             if not os.path.exists(full_path):
                 print(f"Skipping {full_path} (item {index + 1}/{total_items}): File not found.")
+                progress.add_files(1)
                 continue
 
             print(f"Reprocessing {full_path} (item {index + 1}/{total_items})...")
-            new_meta, width, height = get_meta(full_path)
+            with progress.stage("metadata"):
+                new_meta, width, height = get_meta(full_path)
 
             image_content = db.query(models.ImageContent).filter(models.ImageContent.content_hash == location.content_hash).first()
 
@@ -617,9 +1296,12 @@ def reprocess_metadata_task(db_session_factory, scope: str, identifier: Optional
                     pass # Ignore if old metadata is invalid
 
                 image_content.exif_data = json.dumps(_sanitize_for_json(new_meta))
-                db.commit()
+                with progress.stage("write"):
+                    db.commit()
+            progress.add_files(1)
 
         duration = time.time() - start_time
         print(f"[{datetime.now().isoformat()}] Finished metadata reprocessing task for {total_items} items in {duration:.2f} seconds.")
     finally:
+        progress.finish()
         db.close()
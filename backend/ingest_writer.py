@@ -0,0 +1,226 @@
+import asyncio
+import os
+import time
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+
+from sqlalchemy import insert, update, delete, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import config
+import database
+import models
+from scan_progress import ProgressTracker
+from websocket_manager import manager
+
+# Maximum number of IDs bound into one DELETE ... WHERE id IN (...).
+DELETE_CHUNK_SIZE = 500
+
+
+class IngestWriter:
+    """
+    Collects rows found by the scanner and writes them in batched transactions.
+
+    New ImageContent, ImageLocation and ImagePath rows are inserted with one
+    executemany per table, and re-hashed locations are updated in bulk. A batch is
+    flushed once it holds batch_size rows or flush_interval seconds have passed
+    since the last flush. If a batch hits an IntegrityError (for example the file
+    watcher added the same file meanwhile), only that table's batch is retried row
+    by row and the conflicting rows are skipped. Locations of removed files are
+    deleted in bulk, and clients are told with one 'images_deleted' message per
+    batch, and with one 'refresh_images' message per batch that added files. New
+    content that still needs metadata is handed to the enricher, and new content to
+    the thumbnail pregenerator, if they are given, once it is committed. Content
+    hashes join existing_checksums only once their batch is committed, so other
+    writers sharing the set never skip content that is not in the database yet.
+    Flushes are timed as the 'write' stage of the progress tracker, if one is given.
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        existing_checksums: set,
+        batch_size: int = config.INGEST_BATCH_SIZE,
+        flush_interval: float = config.INGEST_FLUSH_INTERVAL,
+        progress: Optional[ProgressTracker] = None,
+        enricher=None,
+        pregenerator=None
+    ):
+        self.db = db
+        self.progress = progress
+        self.enricher = enricher
+        self.pregenerator = pregenerator
+        self.existing_checksums = existing_checksums
+        # Content queued in this batch, added to existing_checksums once the batch is committed.
+        self.pending_checksums = set()
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.contents: List[dict] = []
+        self.locations: List[dict] = []
+        self.image_paths: List[dict] = []
+        self.location_updates: List[dict] = []
+        self.fingerprint_updates: List[dict] = []
+        self.content_samples: List[dict] = []
+        self.location_deletes: List[int] = []
+        self.enrichments: List[Tuple[str, str]] = [] # (content_hash, full_path) of contents needing metadata
+        self.new_contents: List[Tuple[str, str]] = [] # (content_hash, full_path) of new contents needing a thumbnail
+        self.last_flush = time.monotonic()
+
+        # Totals of rows actually written, across all flushes.
+        self.inserted_contents = 0
+        self.inserted_locations = 0
+        self.inserted_image_paths = 0
+        self.updated_locations = 0
+        self.refreshed_fingerprints = 0
+        self.deleted_locations = 0
+        self.skipped_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def pending_rows(self) -> int:
+        return (len(self.contents) + len(self.locations) + len(self.image_paths)
+                + len(self.location_updates) + len(self.fingerprint_updates) + len(self.content_samples)
+                + len(self.location_deletes))
+
+    def add_record(self, record: dict):
+        """Queues the rows for a record produced by image_processor.prepare_file_record."""
+        checksum = record["checksum"]
+
+        # Queue the content once, even if several files in this batch share it.
+        if record["content"] and checksum not in self.existing_checksums and checksum not in self.pending_checksums:
+            print(f"Found new media file: {record['full_path']}")
+            self.contents.append({"content_hash": checksum, **record["content"]})
+            self.pending_checksums.add(checksum)
+            if record["content"].get("needs_metadata"):
+                self.enrichments.append((checksum, record["full_path"]))
+            if not (record["content"].get("needs_metadata") and record["content"]["is_video"]):
+                # Videos still waiting for metadata get their thumbnail from the enricher's ffmpeg call.
+                self.new_contents.append((checksum, record["full_path"]))
+        elif not record["identified_by_sample"] and record["sample_hash"]:
+            # Known content may predate sample hashes, fill them in since the file was read anyway.
+            self.content_samples.append({
+                "b_content_hash": checksum, "b_file_size": record["file_size"], "b_sample_hash": record["sample_hash"]
+            })
+
+        if record["location_id"]:
+            self.location_updates.append({"id": record["location_id"], "content_hash": checksum, **record["fingerprint"]})
+        else:
+            self.locations.append({
+                "content_hash": checksum,
+                "filename": record["filename"],
+                "path": record["path"],
+                **record["fingerprint"],
+            })
+        self.maybe_flush()
+
+    def add_image_path(self, row: dict):
+        self.image_paths.append(row)
+        self.maybe_flush()
+
+    def update_fingerprint(self, row: dict):
+        """Queues a fingerprint refresh for an unchanged ImageLocation, keyed by its 'id'."""
+        self.fingerprint_updates.append(row)
+        self.maybe_flush()
+
+    def delete_locations(self, location_ids: List[int]):
+        """Queues ImageLocation rows of files that no longer exist for deletion."""
+        self.location_deletes.extend(location_ids)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.pending_rows() >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all queued rows in a single transaction."""
+        self.last_flush = time.monotonic()
+        if not self.pending_rows():
+            return
+        with self.progress.stage("write") if self.progress else nullcontext():
+            self._write_batch()
+
+    def _write_batch(self):
+        try:
+            # The whole batch commits or rolls back together, including the savepoints of _insert_rows.
+            database.begin_transaction(self.db)
+            inserted_image_paths = self._insert_rows(models.ImagePath, self.image_paths)
+            inserted_contents = self._insert_rows(models.ImageContent, self.contents)
+            inserted_locations = self._insert_rows(models.ImageLocation, self.locations)
+            if self.location_updates or self.fingerprint_updates:
+                self.db.bulk_update_mappings(models.ImageLocation, self.location_updates + self.fingerprint_updates)
+            if self.content_samples:
+                self.db.execute(
+                    update(models.ImageContent.__table__)
+                    .where(models.ImageContent.content_hash == bindparam("b_content_hash"), models.ImageContent.file_size.is_(None))
+                    .values(file_size=bindparam("b_file_size"), sample_hash=bindparam("b_sample_hash")),
+                    self.content_samples
+                )
+            for chunk_start in range(0, len(self.location_deletes), DELETE_CHUNK_SIZE):
+                self.db.execute(delete(models.ImageLocation.__table__).where(
+                    models.ImageLocation.id.in_(self.location_deletes[chunk_start:chunk_start + DELETE_CHUNK_SIZE])
+                ))
+            self.db.commit()
+            for checksum in self.pending_checksums:
+                self.existing_checksums.add(checksum)
+
+            self.inserted_image_paths += inserted_image_paths
+            self.inserted_contents += inserted_contents
+            self.inserted_locations += inserted_locations
+            self.updated_locations += len(self.location_updates)
+            self.refreshed_fingerprints += len(self.fingerprint_updates)
+            self.deleted_locations += len(self.location_deletes)
+            if self.location_deletes and database.main_event_loop:
+                message = {"type": "images_deleted", "image_ids": self.location_deletes}
+                asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), database.main_event_loop)
+            if inserted_locations and database.main_event_loop:
+                message = {"type": "refresh_images", "reason": "images_added"}
+                asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), database.main_event_loop)
+            if self.enricher:
+                for content_hash, full_path in self.enrichments:
+                    self.enricher.enqueue(content_hash, full_path)
+            if self.pregenerator:
+                for content_hash, full_path in self.new_contents:
+                    self.pregenerator.enqueue(content_hash, full_path)
+        except Exception as e:
+            self.db.rollback()
+            print(f"Database error while writing scan batch: {e}")
+        finally:
+            # Content from a failed batch was never written, so it must be hashed again next time.
+            self.pending_checksums = set()
+            self.contents = []
+            self.locations = []
+            self.image_paths = []
+            self.location_updates = []
+            self.fingerprint_updates = []
+            self.content_samples = []
+            self.location_deletes = []
+            self.enrichments = []
+            self.new_contents = []
+
+    def _insert_rows(self, model, rows: List[dict]) -> int:
+        """Inserts rows with one executemany, falling back to one row at a time on conflicts."""
+        if not rows:
+            return 0
+        try:
+            with self.db.begin_nested():
+                self.db.execute(insert(model), rows)
+            return len(rows)
+        except IntegrityError:
+            pass
+
+        inserted = 0
+        for row in rows:
+            try:
+                with self.db.begin_nested():
+                    self.db.execute(insert(model), [row])
+                inserted += 1
+            except IntegrityError as e:
+                self.skipped_rows += 1
+                label = os.path.join(row["path"], row["filename"]) if "filename" in row else row.get("path", row.get("content_hash"))
+                print(f"Skipping conflicting {model.__tablename__} row '{label}': {e.orig}")
+        return inserted
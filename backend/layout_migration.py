@@ -0,0 +1,133 @@
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, List, Set, Tuple
+
+import config
+from derivative_index import Derivative, derivative_index, derivative_path, parse_derivative_name
+from pack_store import pack_store
+
+# Only one migration may move files at a time.
+_migration_lock = threading.Lock()
+
+def _next_batch(directory: str, batch_size: int, failed: Set[str]) -> List[Tuple[str, str, Derivative]]:
+    # Moved files leave the directory, so each batch is simply the first flat files left in it.
+    batch = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name in failed or entry.is_dir(follow_symlinks=False):
+                continue
+            parsed = parse_derivative_name(entry.name, directory)
+            if parsed and derivative_path(*parsed) != entry.path: # Hashes too short to shard stay where they are
+                batch.append((entry.path, *parsed))
+                if len(batch) >= batch_size:
+                    break
+    return batch
+
+def move_to_shard(flat_path: str, content_hash: str, derivative: Derivative) -> str:
+    """
+    Moves one derivative from the flat layout into its shard. The file is linked into the
+    shard and the index is pointed there before the flat name is removed, so it can be
+    served from one of the two paths throughout. Returns the new path.
+    """
+    sharded_path = derivative_path(content_hash, derivative)
+    os.makedirs(os.path.dirname(sharded_path), exist_ok=True)
+    if not os.path.exists(sharded_path):
+        try:
+            os.link(flat_path, sharded_path)
+        except OSError:
+            shutil.copy2(flat_path, sharded_path)
+    derivative_index.add(content_hash, derivative)
+    os.remove(flat_path)
+    return sharded_path
+
+def pack_file(path: str, content_hash: str, derivative: Derivative) -> bool:
+    """
+    Moves one derivative file into the pack store. It is packed before the file is removed,
+    and packed derivatives are served first, so it stays available throughout. Returns False
+    if it is too large to pack and was left as a file.
+    """
+    if (content_hash, derivative) not in pack_store: # Otherwise the packed one was generated since
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not pack_store.put(content_hash, derivative, data):
+            return False
+    derivative_index.add(content_hash, derivative)
+    os.remove(path)
+    return True
+
+def _files(directory: str) -> Iterator[Tuple[str, str, Derivative]]:
+    # Every derivative file in the flat layout and in the shards below it.
+    for root, _, names in os.walk(directory):
+        for name in names:
+            parsed = parse_derivative_name(name, directory)
+            if parsed:
+                yield (os.path.join(root, name), *parsed)
+
+def _pack_directory(directory: str, batch_size: int, pause: float) -> Tuple[int, int]:
+    # Returns how many files were packed and how many were left as files.
+    packed = failed = 0
+    for path, content_hash, derivative in _files(directory):
+        try:
+            if pack_file(path, content_hash, derivative):
+                packed += 1
+            else:
+                failed += 1
+        except OSError as e:
+            print(f"Layout migration: Could not pack {path}: {e}")
+            failed += 1
+        if packed and not packed % batch_size:
+            print(f"Layout migration: {packed} files in {directory} packed so far.")
+            time.sleep(pause) # Leave the disk to the requests being served
+    return packed, failed
+
+def migrate_derivative_layout_task(batch_size: int = 500, pause: float = 0.05):
+    """
+    A background task that moves thumbnails and previews from the flat layout into the
+    sharded one, batch_size files at a time with a pause in between, while the server
+    keeps serving them from whichever layout they are in. With PACKED_THUMBNAILS set it
+    moves every derivative file, flat or sharded, into the pack store instead. Safe to
+    run again: once all files are moved it only lists the top level of each directory,
+    or in the packed layout the shards, which are then empty.
+    """
+    if not _migration_lock.acquire(blocking=False):
+        print("Layout migration: A migration is already running.")
+        return
+
+    try:
+        start_time = time.time()
+        moved = 0
+        failed: Set[str] = set()
+        failed_count = 0
+        for directory in (str(config.THUMBNAILS_DIR), str(config.PREVIEWS_DIR)):
+            if not os.path.isdir(directory):
+                continue
+            if config.PACKED_THUMBNAILS:
+                packed, not_packed = _pack_directory(directory, batch_size, pause)
+                moved += packed
+                failed_count += not_packed
+                continue
+            while True:
+                batch = _next_batch(directory, batch_size, failed)
+                if not batch:
+                    break
+                if not moved:
+                    print(f"[{datetime.now().isoformat()}] Layout migration: Moving generated media into sharded directories...")
+                for flat_path, content_hash, derivative in batch:
+                    try:
+                        move_to_shard(flat_path, content_hash, derivative)
+                        moved += 1
+                    except OSError as e:
+                        print(f"Layout migration: Could not move {flat_path}: {e}")
+                        failed.add(os.path.basename(flat_path))
+                        failed_count += 1
+                print(f"Layout migration: {moved} files moved so far.")
+                time.sleep(pause) # Leave the disk to the requests being served
+
+        if moved or failed_count:
+            duration = time.time() - start_time
+            print(f"[{datetime.now().isoformat()}] Layout migration finished: {moved} moved, {failed_count} failed in {duration:.2f} seconds.")
+    finally:
+        _migration_lock.release()
@@ -12,6 +12,14 @@ import config
 import models
 import database
 import image_processor
+import hash_migration
+import layout_migration
+from scan_coordinator import coordinator
+from metadata_enrichment import enricher
+from derivative_index import derivative_index
+from pack_store import pack_store
+from thumbnail_rerender import rerenderer
+from view_counts import view_counter
 import auth
 from websocket_manager import manager
 from file_watcher import start_file_watcher
@@ -42,6 +50,7 @@ async def lifespan(app: FastAPI):
     database.main_event_loop = asyncio.get_running_loop()
     print("Main event loop captured.")
     models.Base.metadata.create_all(bind=database.engine)
+    database.add_missing_columns(models.Base.metadata)
     print("Database tables checked/created.")
 
     # Initialize a database session for initial data population
@@ -152,19 +161,33 @@ async def lifespan(app: FastAPI):
             db.commit()
             print("Default admin user created.")
 
-        # Run the initial file scan during startup
+        # Open the thumbnail packs and learn which thumbnails and previews exist from one pass over their directories
+        pack_store.load_in_background()
+        derivative_index.load_in_background()
+
+        # Move thumbnails and previews still in the flat layout into their shards, or with PACKED_THUMBNAILS into packs, a batch at a time
+        layout_thread = threading.Thread(target=layout_migration.migrate_derivative_layout_task, daemon=True)
+        layout_thread.start()
+
+        # Re-render thumbnails made at another thumb_size, or before thumbnails were keyed by size
+        rerenderer.start()
+
+        # Run the initial file scan during startup, on the scan coordinator's background thread
         print("Running initial file scan...")
-        def run_initial_scan_in_thread():
-            thread_db = database.SessionLocal()
-            try:
-                image_processor.scan_paths(thread_db)
-            finally:
-                thread_db.close()
+        coordinator.request_scan(reason="startup")
+
+        # Read metadata for content added just before the last shutdown
+        requeued = enricher.requeue_pending(db)
+        if requeued:
+            print(f"Queued {requeued} items still missing metadata.")
 
-        # Start the thread for the initial scan
-        initial_scan_thread = threading.Thread(target=run_initial_scan_in_thread)
-        initial_scan_thread.daemon = True # Allow the program to exit even if this thread is running
-        initial_scan_thread.start()
+        # Re-key content hashed with a previous CONTENT_HASH_ALGORITHM
+        if hash_migration.contents_needing_migration(db):
+            print(f"Content hashed with another algorithm than '{config.CONTENT_HASH_ALGORITHM}' found. Starting hash migration...")
+            migration_thread = threading.Thread(
+                target=hash_migration.migrate_content_hashes_task, args=(database.SessionLocal,), daemon=True
+            )
+            migration_thread.start()
 
     finally:
         db.close()
@@ -180,6 +203,7 @@ async def lifespan(app: FastAPI):
 
     # Shutdown Events
     print("Application shutdown initiated.")
+    view_counter.flush() # Views still held in memory
 
 
 # --- Initialize FastAPI app with the lifespan context manager ---
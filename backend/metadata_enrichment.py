@@ -0,0 +1,177 @@
+import asyncio
+import heapq
+import itertools
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.orm import Session
+
+import config
+import database
+import image_processor
+import models
+import scan_progress
+from websocket_manager import manager
+
+# Queue priorities, lower runs first.
+PRIORITY_WATCHER = 0 # Single files that just appeared
+PRIORITY_SCAN = 1 # New files found by a scan
+PRIORITY_BACKLOG = 2 # Left over from before a restart
+
+# Files read and written per transaction. Small, so higher priority files never wait long.
+METADATA_BATCH_SIZE = 50
+
+
+class MetadataEnricher:
+    """
+    Second phase of ingestion: reads metadata for content added without it.
+
+    The scanner and the file watcher insert new content right away from its hash
+    and stat data with needs_metadata set, so it shows up in the grid within
+    seconds, and queue it here. A dispatcher thread takes the queue in priority
+    order, reads metadata on its own pool of worker threads (videos get their
+    thumbnail from the same ffmpeg process), writes it back in
+    batches and tells clients to refresh, at most once per refresh_interval. Like
+    the scan coordinator, the dispatcher exits when the queue is empty and is
+    started again by the next file.
+    """
+
+    def __init__(
+        self,
+        session_factory=database.SessionLocal,
+        workers: int = config.METADATA_WORKERS,
+        refresh_interval: float = config.METADATA_REFRESH_INTERVAL
+    ):
+        self.session_factory = session_factory
+        self.workers = max(1, workers)
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[int, int, str, str]] = []
+        self._queued: Dict[str, int] = {} # content_hash -> priority of its queue entry
+        self._order = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.last_refresh = 0.0
+        self.refresh_pending = False
+        self.enriched = 0
+
+    def enqueue(self, content_hash: str, full_path: str, priority: int = PRIORITY_SCAN):
+        """Queues content for a metadata read from full_path. Queued content is only moved up, never down."""
+        with self._lock:
+            queued_priority = self._queued.get(content_hash)
+            if queued_priority is not None and queued_priority <= priority:
+                return
+            self._queued[content_hash] = priority
+            heapq.heappush(self._heap, (priority, next(self._order), content_hash, full_path))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="metadata-enrichment", daemon=True)
+                self._thread.start()
+
+    def pending(self) -> int:
+        return len(self._queued)
+
+    def requeue_pending(self, db: Session) -> int:
+        """Queues all content that still needs metadata, e.g. after a restart, from its first location."""
+        first_locations = select(func.min(models.ImageLocation.id)).join(models.ImageContent).where(
+            models.ImageContent.needs_metadata.is_(True)
+        ).group_by(models.ImageLocation.content_hash)
+        rows = db.query(models.ImageLocation.content_hash, models.ImageLocation.path, models.ImageLocation.filename).filter(
+            models.ImageLocation.id.in_(first_locations)
+        ).all()
+        for row in rows:
+            self.enqueue(row.content_hash, os.path.join(row.path, row.filename), PRIORITY_BACKLOG)
+        return len(rows)
+
+    def _next_batch(self) -> List[Tuple[str, str]]:
+        # Called with the lock held. Entries whose content was moved up since are stale and skipped.
+        batch = []
+        while self._heap and len(batch) < METADATA_BATCH_SIZE:
+            priority, _, content_hash, full_path = heapq.heappop(self._heap)
+            if self._queued.get(content_hash) != priority:
+                continue
+            del self._queued[content_hash]
+            batch.append((content_hash, full_path))
+        return batch
+
+    def _run(self):
+        progress = scan_progress.get_tracker("enrichment")
+        progress.start()
+        progress.watch_queue("metadata", self.pending)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="metadata")
+        db = self.session_factory()
+        try:
+            while True:
+                with self._lock:
+                    batch = self._next_batch()
+                    if not batch:
+                        self._thread = None
+                        progress.finish()
+                        return
+                progress.set_total(progress.files_done + len(batch) + self.pending())
+                try:
+                    thumb_size = image_processor.get_thumbnail_size(db)
+                    rows = [row for row in self._executor.map(lambda item: _read_metadata(item, thumb_size, progress), batch) if row]
+                    progress.add_files(len(batch))
+                    if rows:
+                        self._write(db, rows)
+                    self._maybe_refresh(force=not self.pending())
+                except Exception as e:
+                    # Only this batch is lost, its content still needs metadata and is queued again on the next start.
+                    db.rollback()
+                    print(f"Error during metadata enrichment of {len(batch)} items: {e}")
+        finally:
+            db.close()
+
+    def _write(self, db: Session, rows: List[dict]):
+        try:
+            db.execute(
+                update(models.ImageContent.__table__)
+                .where(models.ImageContent.content_hash == bindparam("b_content_hash"), models.ImageContent.needs_metadata.is_(True))
+                .values(exif_data=bindparam("b_exif_data"), width=bindparam("b_width"), height=bindparam("b_height"), needs_metadata=False),
+                rows
+            )
+            db.commit()
+            self.enriched += len(rows)
+            self.refresh_pending = True
+        except Exception as e:
+            db.rollback()
+            print(f"Database error while writing metadata: {e}")
+
+    def _maybe_refresh(self, force: bool = False):
+        # Clients refetch the grid on refresh_images, so a long backlog must not send one per batch.
+        if not self.refresh_pending or database.main_event_loop is None:
+            return
+        if not force and time.monotonic() - self.last_refresh < self.refresh_interval:
+            return
+        self.refresh_pending = False
+        self.last_refresh = time.monotonic()
+        message = {"type": "refresh_images", "reason": "metadata_updated"}
+        asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), database.main_event_loop)
+
+def _read_metadata(item: Tuple[str, str], thumb_size: int, progress: scan_progress.ProgressTracker) -> Optional[dict]:
+    content_hash, full_path = item
+    if not os.path.isfile(full_path):
+        # Moved or deleted meanwhile, requeue_pending picks it up from another location later.
+        return None
+    mime_type, _ = mimetypes.guess_type(full_path)
+    with progress.stage("metadata"):
+        if mime_type and mime_type.startswith('video/'):
+            # The ffmpeg process that reads the metadata writes the thumbnail as well.
+            meta, width, height = image_processor.read_video_meta_and_thumbnail(full_path, content_hash, thumb_size)
+        else:
+            meta, width, height = image_processor.get_meta(full_path, check_exists=False)
+    exif_data = image_processor.metadata_json(mime_type, meta)
+    if exif_data is None:
+        print(f"Error in metadata for file: {full_path}. Keeping the mime type only.")
+        exif_data = image_processor.metadata_json(mime_type, {})
+    return {"b_content_hash": content_hash, "b_exif_data": exif_data, "b_width": width, "b_height": height}
+
+
+# The one enricher the scanner, the file watcher and startup queue content on
+enricher = MetadataEnricher()
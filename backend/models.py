@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Text, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Index, Table, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
@@ -73,6 +73,8 @@ class ImagePath(Base):
     basepath = Column(Boolean, default=False)
     built_in = Column(Boolean, default=False)
     parent = Column(String)
+    # When folder tags were last applied to the folder's images. NULL means they must be (re)applied.
+    tags_checked_at = Column(DateTime(timezone=True))
 
     tags = relationship("Tag", secondary=imagepath_tags, back_populates="image_paths")
 
@@ -87,8 +89,21 @@ class ImageContent(Base):
     date_modified = Column(DateTime(timezone=True))
     date_indexed = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), server_default=func.now())
     orphaned = Column(Boolean, default=False)
+    # File size and a hash of its head, middle and tail, used to identify known content without a full read.
+    file_size = Column(BigInteger, index=True)
+    sample_hash = Column(String)
+    # Algorithm that produced content_hash, see config.CONTENT_HASH_ALGORITHM.
+    hash_algorithm = Column(String, default='sha256')
+    # Added before its metadata was read, metadata_enrichment fills in exif_data, width and height.
+    needs_metadata = Column(Boolean, default=False, index=True)
+    # Times the image was opened, thumbnail_rerender redoes the most viewed thumbnails first.
+    view_count = Column(Integer, default=0)
     locations = relationship("ImageLocation", back_populates="content")
     tags = relationship("Tag", secondary=image_tags, back_populates="images")
+    __table_args__ = (
+        # Most viewed, then newest first: the order thumbnail_rerender works in.
+        Index('ix_image_content_view_order', view_count.desc(), date_created.desc(), content_hash.desc()),
+    )
 
 class ImageLocation(Base):
     __tablename__ = "image_location"
@@ -98,6 +113,11 @@ class ImageLocation(Base):
     path = Column(String, nullable=False)
     date_scanned = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), server_default=func.now())
     deleted = Column(Boolean, default=False)
+    # Stat fingerprint of the file when it was last hashed, used to skip re-hashing unchanged files.
+    file_size = Column(BigInteger)
+    mtime_ns = Column(BigInteger)
+    inode = Column(BigInteger)
+    device = Column(BigInteger)
     content = relationship("ImageContent", back_populates="locations")
     __table_args__ = (
         UniqueConstraint('path', 'filename', name='uq_path_filename'),
@@ -146,3 +166,34 @@ class Filter(Base):
 
     tags = relationship("Tag", secondary=filter_tags, back_populates="filters_positive")
     neg_tags = relationship("Tag", secondary=filter_neg_tags, back_populates="filters_negative")
+
+
+class ScanRun(Base):
+    __tablename__ = "scan_runs"
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String, default='running', index=True) # 'running' until every path has been walked, then 'finished'
+    scope = Column(String) # Path of the ImagePath a scoped scan was limited to, None for a full scan
+    recursive = Column(Boolean, default=True) # Whether a scoped scan included the subdirectories
+    started_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime(timezone=True))
+    files_done = Column(Integer, default=0)
+
+    cursors = relationship("ScanCursor", back_populates="run", cascade="all, delete-orphan")
+
+
+class ScanCursor(Base):
+    __tablename__ = "scan_cursors"
+    id = Column(Integer, primary_key=True, index=True)
+    run_id = Column(Integer, ForeignKey("scan_runs.id"), nullable=False, index=True)
+    path = Column(String, nullable=False) # Root of the walk, the ImagePath's path
+    status = Column(String, default='running') # 'running' or 'done'
+    # Last directory of the walk whose files are all written. The walk is ordered, so a resumed walk skips up to here.
+    position = Column(String)
+    files_done = Column(Integer, default=0)
+    started_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    finished_at = Column(DateTime(timezone=True))
+
+    run = relationship("ScanRun", back_populates="cursors")
+    __table_args__ = (
+        UniqueConstraint('run_id', 'path', name='uq_scan_cursor_run_path'),
+    )
@@ -0,0 +1,337 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Callable, Dict, Iterator, Optional, Tuple, Union
+
+import config
+from derivative_index import PREVIEW, THUMBNAIL, Derivative, derivative_index
+
+# Every record is a header, its key "{content_hash}/{derivative}" and its data. The
+# header holds a magic number, the record kind, the key and data lengths and a CRC
+# of the key and data, so the index can be rebuilt from the packs alone and a record torn by
+# a crash is recognised and written over.
+_HEADER = struct.Struct('>4sBxHII')
+_MAGIC = b'PTPK'
+_RECORD_DATA = 0
+_RECORD_DELETE = 1
+
+_PACK_NAME = re.compile(r'^pack-(\d+)\.pack$')
+
+# Index values pack the pack number, data offset and data length into one integer.
+_OFFSET_BITS = 40
+_LENGTH_BITS = 24
+MAX_RECORD_DATA = (1 << _LENGTH_BITS) - 1
+
+# Packs whose live records take up less than this share of them are rewritten by compact.
+COMPACT_LIVE_RATIO = 0.5
+
+
+def _record_key(content_hash: str, derivative: Derivative) -> str:
+    return f"{content_hash}/{'thumb' if derivative is None else derivative}"
+
+def _parse_record_key(record_key: str) -> Tuple[str, Derivative]:
+    content_hash, _, name = record_key.rpartition('/')
+    if name == 'thumb':
+        return content_hash, THUMBNAIL
+    if name == PREVIEW:
+        return content_hash, PREVIEW
+    return content_hash, int(name)
+
+def _index_key(record_key: str) -> bytes:
+    # Hex digests are kept as bytes, half the size of the string, anything else as it is.
+    content_hash, _, name = record_key.rpartition('/')
+    try:
+        return b'h' + bytes.fromhex(content_hash) + b'/' + name.encode()
+    except ValueError:
+        return b's' + record_key.encode()
+
+def _record_key_from_index(index_key: bytes) -> str:
+    if index_key[:1] == b's':
+        return index_key[1:].decode()
+    hash_bytes, _, name = index_key[1:].rpartition(b'/')
+    return f"{hash_bytes.hex()}/{name.decode()}"
+
+def _pack_value(pack_id: int, offset: int, length: int) -> int:
+    return (((pack_id << _OFFSET_BITS) | offset) << _LENGTH_BITS) | length
+
+def _unpack_value(value: int) -> Tuple[int, int, int]:
+    length = value & MAX_RECORD_DATA
+    location = value >> _LENGTH_BITS
+    return location >> _OFFSET_BITS, location & ((1 << _OFFSET_BITS) - 1), length
+
+def _record_size(key_length: int, data_length: int) -> int:
+    return _HEADER.size + key_length + data_length
+
+
+class _Pack:
+    def __init__(self, pack_id: int, path: str, capacity: int):
+        self.id = pack_id
+        self.path = path
+        self.file = open(path, 'r+b', buffering=0)
+        # The active pack is extended to its full size up front, sparsely, so one map covers every later append.
+        if os.fstat(self.file.fileno()).st_size < capacity:
+            self.file.truncate(capacity)
+        self.capacity = capacity
+        self.map = mmap.mmap(self.file.fileno(), capacity, access=mmap.ACCESS_READ) if capacity else None
+        self.end = 0
+        self.live = 0
+
+    def resize(self, capacity: int):
+        # Trims the unused tail of a closed pack, or extends the pack that is appended to next.
+        if self.map:
+            self.map.close()
+        self.file.truncate(capacity)
+        self.capacity = capacity
+        self.map = mmap.mmap(self.file.fileno(), capacity, access=mmap.ACCESS_READ) if capacity else None
+
+    def records(self) -> Iterator[Tuple[int, int, str, int, int]]:
+        """Yields (offset, kind, key, data offset, data length) up to the first missing or damaged record."""
+        offset = 0
+        while offset + _HEADER.size <= self.capacity:
+            magic, kind, key_length, data_length, crc = _HEADER.unpack_from(self.map, offset)
+            data_offset = offset + _HEADER.size + key_length
+            if magic != _MAGIC or data_offset + data_length > self.capacity:
+                break
+            key = self.map[offset + _HEADER.size:data_offset]
+            if zlib.crc32(self.map[data_offset:data_offset + data_length], zlib.crc32(key)) != crc:
+                break
+            yield offset, kind, key.decode(), data_offset, data_length
+            offset = data_offset + data_length
+
+    def close(self):
+        if self.map:
+            self.map.close()
+        self.file.close()
+
+
+class PackStore:
+    """
+    Thumbnails and previews packed into a few large append-only files.
+
+    With PACKED_THUMBNAILS set, generated derivatives are appended to the active
+    pack instead of being written as a file each. A pack is closed once it reaches
+    THUMBNAIL_PACK_SIZE_MB and the next one started. Every pack is memory-mapped, so
+    serving a thumbnail is a dictionary lookup and a copy out of the page cache
+    rather than an open, stat, read and close. Replaced and deleted derivatives stay
+    in their pack until compact rewrites packs that are mostly dead. The index of
+    where each derivative lives is rebuilt from the packs on load, so it cannot
+    disagree with them. Packs that exist are read whether or not new derivatives
+    are packed. Loading checks every record, so it runs on a background thread at
+    startup. Until it is done nothing is served from the packs, and writers wait for it.
+    """
+
+    def __init__(self, directory: str = str(config.PACKS_DIR), pack_size: int = config.THUMBNAIL_PACK_SIZE_MB * 1024 * 1024):
+        self.directory = directory
+        self.pack_size = pack_size
+        self._lock = threading.Lock()
+        self._index: Dict[bytes, int] = {}
+        self._packs: Dict[int, _Pack] = {}
+        self._active: Optional[_Pack] = None
+        self._thread: Optional[threading.Thread] = None
+        self.loaded = False
+
+    def load(self):
+        """Opens the existing packs and rebuilds the index from their records."""
+        with self._lock:
+            if self.loaded:
+                return
+            start_time = time.perf_counter()
+            pack_ids = []
+            if os.path.isdir(self.directory):
+                pack_ids = sorted(int(match.group(1)) for match in map(_PACK_NAME.match, os.listdir(self.directory)) if match)
+            for pack_id in pack_ids:
+                path = os.path.join(self.directory, f"pack-{pack_id:06d}.pack")
+                pack = _Pack(pack_id, path, os.path.getsize(path))
+                self._packs[pack_id] = pack
+                for offset, kind, record_key, data_offset, data_length in pack.records():
+                    index_key = _index_key(record_key)
+                    self._forget(index_key)
+                    if kind == _RECORD_DATA:
+                        self._index[index_key] = _pack_value(pack_id, data_offset, data_length)
+                        pack.live += _record_size(data_offset - offset - _HEADER.size, data_length)
+                    pack.end = data_offset + data_length
+                if pack.end < pack.capacity:
+                    pack.resize(pack.end) # Drops a record torn by a crash
+            if pack_ids and self._packs[pack_ids[-1]].end < self.pack_size:
+                # Appending continues in the last pack
+                self._active = self._packs[pack_ids[-1]]
+                self._active.resize(self.pack_size)
+            self.loaded = True
+            if pack_ids:
+                print(f"Pack store loaded: {len(self._index)} derivatives in {len(pack_ids)} packs in {time.perf_counter() - start_time:.2f} seconds.")
+
+    def load_in_background(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.load, name="pack-store", daemon=True)
+            self._thread.start()
+
+    def wait(self):
+        """Blocks until the packs are loaded, loading them on this thread if no load was started."""
+        if self._thread is not None:
+            self._thread.join()
+        if not self.loaded:
+            self.load()
+
+    def _forget(self, index_key: bytes):
+        # Called with the lock held. Drops a record from the index and from its pack's live bytes.
+        value = self._index.pop(index_key, None)
+        if value is not None:
+            pack_id, _, length = _unpack_value(value)
+            key_length = len(_record_key_from_index(index_key).encode())
+            self._packs[pack_id].live -= _record_size(key_length, length)
+
+    def _append(self, kind: int, record_key: str, data: Union[bytes, memoryview] = b'') -> Tuple[int, int]:
+        # Called with the lock held. Returns the pack and data offset of the new record.
+        key = record_key.encode()
+        size = _record_size(len(key), len(data))
+        pack = self._active
+        if pack is None or pack.end + size > pack.capacity:
+            pack = self._start_pack(size)
+        pack.file.seek(pack.end)
+        pack.file.write(_HEADER.pack(_MAGIC, kind, len(key), len(data), zlib.crc32(data, zlib.crc32(key))) + key + data)
+        data_offset = pack.end + _HEADER.size + len(key)
+        pack.end += size
+        return pack.id, data_offset
+
+    def _start_pack(self, min_size: int) -> _Pack:
+        if self._active is not None:
+            self._active.resize(self._active.end)
+        os.makedirs(self.directory, exist_ok=True)
+        pack_id = max(self._packs, default=0) + 1
+        path = os.path.join(self.directory, f"pack-{pack_id:06d}.pack")
+        open(path, 'ab').close()
+        self._active = self._packs[pack_id] = _Pack(pack_id, path, max(self.pack_size, min_size))
+        return self._active
+
+    def put(self, content_hash: str, derivative: Derivative, data: Union[bytes, memoryview]) -> bool:
+        """Appends a derivative, replacing any earlier version. Returns False if it is too large to pack."""
+        if len(data) > MAX_RECORD_DATA:
+            return False
+        self.wait() # Packs must be open before the first append
+        record_key = _record_key(content_hash, derivative)
+        index_key = _index_key(record_key)
+        with self._lock:
+            pack_id, data_offset = self._append(_RECORD_DATA, record_key, data)
+            self._forget(index_key)
+            self._index[index_key] = _pack_value(pack_id, data_offset, len(data))
+            self._packs[pack_id].live += _record_size(len(record_key.encode()), len(data))
+        return True
+
+    def delete(self, content_hash: str, derivative: Derivative):
+        self.wait() # Otherwise the record would only be found by the load
+        record_key = _record_key(content_hash, derivative)
+        index_key = _index_key(record_key)
+        with self._lock:
+            if index_key not in self._index:
+                return
+            self._append(_RECORD_DELETE, record_key)
+            self._forget(index_key)
+
+    def get(self, content_hash: str, derivative: Derivative) -> Optional[bytes]:
+        """
+        The derivative's data, copied out of its pack's memory map, or None if it is not packed
+        or the packs are still loading, in which case callers fall back to files or regeneration.
+        """
+        if not self.loaded:
+            return None
+        index_key = _index_key(_record_key(content_hash, derivative))
+        with self._lock:
+            # Under the lock, so compaction cannot close the pack between lookup and copy
+            value = self._index.get(index_key)
+            if value is None:
+                return None
+            pack_id, offset, length = _unpack_value(value)
+            return self._packs[pack_id].map[offset:offset + length]
+
+    def __contains__(self, item: Tuple[str, Derivative]) -> bool:
+        return _index_key(_record_key(*item)) in self._index
+
+    def derivatives(self) -> Iterator[Tuple[str, Derivative]]:
+        """Every packed (content_hash, derivative)."""
+        with self._lock:
+            keys = list(self._index)
+        for index_key in keys:
+            yield _parse_record_key(_record_key_from_index(index_key))
+
+    def compact(self, keep: Optional[Callable[[str], bool]] = None) -> dict:
+        """
+        Deletes the derivatives of content for which keep returns False, then rewrites every
+        closed pack whose live records are less than COMPACT_LIVE_RATIO of it into the active
+        pack and removes it. Records are moved one at a time, so serving is never held up
+        for long. Returns what was done.
+        """
+        self.wait()
+        dropped = 0
+        if keep is not None:
+            for content_hash, derivative in list(self.derivatives()):
+                if not keep(content_hash):
+                    self.delete(content_hash, derivative)
+                    derivative_index.discard(content_hash, derivative)
+                    dropped += 1
+
+        with self._lock:
+            candidates = sorted(
+                pack.id for pack in self._packs.values()
+                if pack is not self._active and pack.live < pack.end * COMPACT_LIVE_RATIO
+            )
+        reclaimed = 0
+        for pack_id in candidates:
+            with self._lock:
+                pack = self._packs[pack_id]
+                records = list(pack.records())
+                # Deletions only matter while an older pack may still hold what they delete.
+                keep_deletions = any(other < pack_id for other in self._packs)
+            for offset, kind, record_key, data_offset, data_length in records:
+                with self._lock:
+                    index_key = _index_key(record_key)
+                    if kind == _RECORD_DATA:
+                        if self._index.get(index_key) != _pack_value(pack_id, data_offset, data_length):
+                            continue # Replaced or deleted since
+                        data = pack.map[data_offset:data_offset + data_length]
+                        new_pack_id, new_offset = self._append(_RECORD_DATA, record_key, data)
+                        self._index[index_key] = _pack_value(new_pack_id, new_offset, data_length)
+                        self._packs[new_pack_id].live += _record_size(len(record_key.encode()), data_length)
+                    elif keep_deletions and index_key not in self._index:
+                        self._append(_RECORD_DELETE, record_key)
+            with self._lock:
+                reclaimed += pack.end
+                del self._packs[pack_id]
+                pack.close()
+                os.remove(pack.path)
+        return {"dropped": dropped, "packs_compacted": len(candidates), "bytes_reclaimed": reclaimed}
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "packs": len(self._packs),
+                "derivatives": len(self._index),
+                "bytes": sum(pack.end for pack in self._packs.values()),
+                "live_bytes": sum(pack.live for pack in self._packs.values()),
+            }
+
+
+def compact_packs_task(db_session_factory):
+    """A background task that compacts the pack store, dropping derivatives of content no longer in the library."""
+    import checksum_index # The checksum index imports models, which the pack store otherwise does not need
+    db = db_session_factory()
+    try:
+        start_time = time.time()
+        print(f"[{datetime.now().isoformat()}] Pack compaction: Starting...")
+        known = checksum_index.get_checksum_index(db)
+        result = pack_store.compact(keep=lambda content_hash: content_hash in known)
+        print(
+            f"[{datetime.now().isoformat()}] Pack compaction finished: {result['dropped']} derivatives of removed content dropped, "
+            f"{result['packs_compacted']} packs rewritten, {result['bytes_reclaimed'] / 1024 / 1024:.1f} MB freed "
+            f"in {time.time() - start_time:.2f} seconds."
+        )
+    finally:
+        db.close()
+
+
+# The one pack store derivatives are written to and served from
+pack_store = PackStore()
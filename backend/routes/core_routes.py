@@ -1,10 +1,17 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.orm import Session
 import threading
 from typing import Dict, Any, Optional
 
 import database
 import image_processor
+import hash_migration
+import layout_migration
+from pack_store import compact_packs_task, pack_store
+import scan_progress
+from scan_coordinator import coordinator
+from thumbnail_rerender import rerenderer
+from thumbnail_service import thumbnail_service
 import auth
 import models
 from schemas import ReprocessRequest
@@ -15,24 +22,34 @@ router = APIRouter()
 # --- Core API Endpoints ---
 
 @router.post("/scan-files/", summary="Trigger File System Scan", response_model=Dict[str, str])
-def trigger_file_scan(current_user: models.User = Depends(auth.get_current_admin_user)):
+def trigger_file_scan(
+    path_id: Optional[int] = Query(None, description="Only scan this ImagePath."),
+    recursive: bool = Query(True, description="With path_id, also scan its subdirectories."),
+    db: Session = Depends(database.get_db),
+    current_user: models.User = Depends(auth.get_current_admin_user)
+):
     # Triggers a manual scan of configured image paths for new images/videos and subdirectories.
+    # With path_id, only that ImagePath (and by default its subtree) is scanned.
+    # Scans run one at a time, a request the running scan already covers joins it.
 
-    print("Manual file scan triggered via API. Starting in background thread...")
+    if path_id is not None and not db.query(models.ImagePath.id).filter(models.ImagePath.id == path_id).first():
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="ImagePath not found")
 
-    def run_scan_in_thread():
-        # Create a new database session specifically for this background thread
-        db_session = database.SessionLocal()
-        try:
-            image_processor.scan_paths(db=db_session)
-        finally:
-            db_session.close()
+    print("Manual file scan triggered via API.")
+    outcome = coordinator.request_scan(path_id, recursive, reason="manual")
 
-    scan_thread = threading.Thread(target=run_scan_in_thread)
-    scan_thread.daemon = True
-    scan_thread.start()
+    scope = "" if path_id is None else f" of ImagePath {path_id}"
+    if outcome == "coalesced":
+        return {"message": f"File scan{scope} is already covered by a running or queued scan. Check /scan-status/ for its state."}
+    return {"message": f"File scan{scope} queued in the background. Check server logs or /scan-status/ for progress."}
 
-    return {"message": "File scan successfully initiated in the background. Check server logs for progress."}
+@router.get("/scan-status/", summary="Get Scan Job State", response_model=Dict[str, Any])
+def get_scan_status(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """
+    Returns the state of the scan coordinator: the running scan, queued follow-up scans,
+    the last finished one and how many requests were coalesced. This is an admin-only endpoint.
+    """
+    return coordinator.status()
 
 @router.post("/reprocess-metadata/", summary="Trigger Metadata Reprocessing", response_model=Dict[str, str])
 def trigger_metadata_reprocessing(
@@ -59,4 +76,73 @@ def trigger_metadata_reprocessing(
     reprocess_thread.daemon = True
     reprocess_thread.start()
 
-    return {"message": f"Metadata reprocessing for scope '{request.scope}' initiated in the background. Check server logs for progress."}
\ No newline at end of file
+    return {"message": f"Metadata reprocessing for scope '{request.scope}' initiated in the background. Check server logs for progress."}
+
+@router.get("/scan-progress/", summary="Get Scan Progress", response_model=Dict[str, Dict[str, Any]])
+def get_scan_progress(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """
+    Returns live progress of the file scan and metadata reprocessing: files and bytes per
+    second, queue depths and time spent per pipeline stage, ETA and the current path.
+    The same snapshots are pushed to admin WebSocket clients as 'scan_progress' messages.
+    This is an admin-only endpoint.
+    """
+    return scan_progress.snapshot_all()
+
+@router.get("/thumbnail-status/", summary="Get Thumbnail Worker State", response_model=Dict[str, Any])
+def get_thumbnail_status(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """
+    Returns the state of the thumbnail worker pool: queued and running thumbnails, how many
+    requests were deduplicated or refused because the queue was full, and the average
+    generation time, the size of the pack store and the progress of re-rendering after a
+    thumb_size change. This is an admin-only endpoint.
+    """
+    return {**thumbnail_service.status(), "packs": pack_store.status(), "rerender": rerenderer.status()}
+
+@router.post("/migrate-content-hashes/", summary="Trigger Content Hash Migration", response_model=Dict[str, str])
+def trigger_content_hash_migration(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """
+    Triggers a background task that re-keys media hashed with another algorithm than
+    the configured CONTENT_HASH_ALGORITHM. This is an admin-only endpoint.
+    """
+    print("Manual content hash migration triggered via API. Starting in background thread...")
+
+    migration_thread = threading.Thread(
+        target=hash_migration.migrate_content_hashes_task,
+        args=(database.SessionLocal,)
+    )
+    migration_thread.daemon = True
+    migration_thread.start()
+
+    return {"message": "Content hash migration initiated in the background. Check server logs for progress."}
+
+@router.post("/migrate-thumbnail-layout/", summary="Trigger Thumbnail Layout Migration", response_model=Dict[str, str])
+def trigger_thumbnail_layout_migration(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """
+    Triggers a background task that moves thumbnails and previews from the flat directory
+    layout into sharded subdirectories. They stay available while it runs. This is an admin-only endpoint.
+    """
+    print("Manual thumbnail layout migration triggered via API. Starting in background thread...")
+
+    migration_thread = threading.Thread(target=layout_migration.migrate_derivative_layout_task)
+    migration_thread.daemon = True
+    migration_thread.start()
+
+    return {"message": "Thumbnail layout migration initiated in the background. Check server logs for progress."}
+
+@router.post("/compact-thumbnail-packs/", summary="Trigger Thumbnail Pack Compaction", response_model=Dict[str, str])
+def trigger_thumbnail_pack_compaction(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """
+    Triggers a background task that drops packed thumbnails and previews of content no longer
+    in the library and rewrites packs that are mostly replaced or deleted data, freeing their
+    space. Thumbnails keep being served while it runs. This is an admin-only endpoint.
+    """
+    print("Manual thumbnail pack compaction triggered via API. Starting in background thread...")
+
+    compaction_thread = threading.Thread(
+        target=compact_packs_task,
+        args=(database.SessionLocal,)
+    )
+    compaction_thread.daemon = True
+    compaction_thread.start()
+
+    return {"message": "Thumbnail pack compaction initiated in the background. Check server logs for progress."}
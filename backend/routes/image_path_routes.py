@@ -1,33 +1,19 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session, joinedload
 from typing import List
-import threading
 import os, asyncio
+from datetime import datetime, timezone
 
 import auth
 import database
 import models
 import schemas
 import image_processor
+from scan_coordinator import coordinator
 from websocket_manager import manager
 
 router = APIRouter()
 
-def _run_scan_in_background():
-    """Helper to run the image_processor.scan_paths in a background thread."""
-    print("Change in ImagePaths detected. Starting file scan in background thread...")
-
-    def run_scan_in_thread():
-        db_session = database.SessionLocal()
-        try:
-            image_processor.scan_paths(db=db_session)
-        finally:
-            db_session.close()
-
-    scan_thread = threading.Thread(target=run_scan_in_thread)
-    scan_thread.daemon = True
-    scan_thread.start()
-
 # --- ImagePath Endpoints ---
 
 @router.post("/imagepaths/", response_model=schemas.ImagePath, status_code=status.HTTP_201_CREATED)
@@ -38,7 +24,7 @@ def create_image_path(path: schemas.ImagePathCreate, db: Session = Depends(datab
     db.add(db_image_path)
     db.commit()
     db.refresh(db_image_path)
-    _run_scan_in_background()
+    coordinator.request_scan(db_image_path.id, reason="path created") # Only the new path needs scanning
     return db_image_path
 
 @router.get("/imagepaths/", response_model=List[schemas.ImagePath])
@@ -98,19 +84,10 @@ def update_image_path(path_id: int, path: schemas.ImagePathUpdate, db: Session =
         newly_added_tag_ids = set(path.tag_ids) - old_tag_ids
         if newly_added_tag_ids:
             print(f"Folder '{db_image_path.path}' has new tags. Applying to existing images.")
-            # Get all ImageContent objects for images in this folder
-            content_hashes_in_path = db.query(models.ImageLocation.content_hash).filter(models.ImageLocation.path == db_image_path.path).distinct()
-            images_to_update = db.query(models.ImageContent).options(joinedload(models.ImageContent.tags)).filter(
-                models.ImageContent.content_hash.in_(content_hashes_in_path)
-            ).all()
-
-            tags_to_add = db.query(models.Tag).filter(models.Tag.id.in_(newly_added_tag_ids)).all()
-
-            for image_content in images_to_update:
-                for tag in tags_to_add:
-                    if tag not in image_content.tags:
-                        image_content.tags.append(tag)
-            print(f"Applied {len(tags_to_add)} new tags to {len(images_to_update)} images in folder.")
+            db.flush() # The set-based insert reads the folder's new tags from imagepath_tags
+            added = image_processor.apply_folder_tags(db, [db_image_path.id])
+            db_image_path.tags_checked_at = datetime.now(timezone.utc)
+            print(f"Applied {added} new tag links to images in folder.")
 
     db.commit()
     db.refresh(db_image_path)
@@ -129,7 +106,9 @@ def delete_image_path(path_id: int, db: Session = Depends(database.get_db), curr
     db_image_path = db.query(models.ImagePath).filter(models.ImagePath.id == path_id).first()
     if db_image_path is None:
         raise HTTPException(status_code=404, detail="ImagePath not found")
+    deleted_path = db_image_path.path
     db.delete(db_image_path)
     db.commit()
-    _run_scan_in_background()
+    # Nothing new can be found by removing a path, only its locations need cleaning up.
+    image_processor.cleanup_orphaned_image_locations(db, path=deleted_path)
     return
\ No newline at end of file
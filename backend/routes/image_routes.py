@@ -1,11 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import func, and_, or_, not_, select
 from typing import List, Optional
 from pathlib import Path
 from datetime import datetime
-import os, json, threading, mimetypes, asyncio
+import os, json, mimetypes, asyncio
 from search_constructor import generate_image_search_filter
 from websocket_manager import manager # Import the WebSocket manager
 
@@ -15,13 +16,24 @@ import models
 import schemas
 import config
 import image_processor
+from derivative_index import derivative_index
+from pack_store import pack_store
+from thumbnail_service import thumbnail_service
+from view_counts import view_counter
 
 router = APIRouter()
 
+# Seconds get_thumbnail waits for a missing thumbnail before serving the placeholder.
+THUMBNAIL_WAIT_SECONDS = 2.0
+
 # --- Image Endpoints ---
 
 @router.get("/thumbnails/{image_id}", response_class=FileResponse)
-async def get_thumbnail(image_id: int, db: Session = Depends(database.get_db)):
+async def get_thumbnail(
+    image_id: int,
+    size: Optional[int] = Query(None, description="Ladder size in pixels. The closest generated size is served."),
+    db: Session = Depends(database.get_db)
+):
     
     # Serves thumbnails. If a thumbnail doesn't exist, it triggers generation and returns a placeholder.
 
@@ -30,37 +42,70 @@ async def get_thumbnail(image_id: int, db: Session = Depends(database.get_db)):
         print(f"Image with ID {image_id} not found")
         raise HTTPException(status_code=404, detail="Image not found")
 
-    expected_thumbnail_path = os.path.join(config.THUMBNAILS_DIR, f"{db_image.content_hash}_thumb.webp")
-
-    if os.path.exists(expected_thumbnail_path):
-        return FileResponse(expected_thumbnail_path, media_type="image/webp")
+    thumb_size = image_processor.get_thumbnail_size(db)
+    # Reading a pack can fault its pages in from disk, which must not hold up the event loop.
+    response = await run_in_threadpool(_thumbnail_response, db_image, size or thumb_size, thumb_size, fill_ladder=True)
+    if response:
+        return response
     else:
-        # Trigger background generation
-        original_filepath = os.path.join(db_image.path, db_image.filename)
-
-        thumb_size_setting = db.query(models.Setting).filter_by(name='thumb_size').first()
-        config_thumbnail_size = config.THUMBNAIL_SIZE
-
-        if thumb_size_setting and thumb_size_setting.value:
-            thumb_size = int(thumb_size_setting.value)
-        else:
-            thumb_size = config_thumbnail_size
-
-        if original_filepath and Path(original_filepath).is_file():
-            loop = asyncio.get_running_loop()
-            thread = threading.Thread(
-                target=image_processor.generate_thumbnail_in_background,
-                args=(image_id, db_image.content_hash, original_filepath, loop)
-            )
-            thread.daemon = True
-            thread.start()
-        else:
-            print(f"Could not trigger thumbnail generation for {db_image.filename}: original_filepath not found or invalid.")
+        # Queue generation, shared with every other request for the same content
+        future = _request_thumbnail(db_image, db_image.content_hash)
+        if future is not None:
+            try:
+                # Small images are done in well under a second, so wait a little before falling back to the placeholder.
+                if await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), THUMBNAIL_WAIT_SECONDS):
+                    response = await run_in_threadpool(_thumbnail_response, db_image, size or thumb_size, thumb_size)
+                    if response:
+                        return response
+            except asyncio.TimeoutError:
+                pass
 
         # Return a placeholder image or a loading indicator
         placeholder_path = os.path.join(config.STATIC_DIR, "placeholder.png")  # Or a loading animation
         return FileResponse(placeholder_path, media_type="image/png")
 
+def _thumbnail_response(location: models.ImageLocation, size: int, thumb_size: int, fill_ladder: bool = False):
+    # The thumbnail that best serves size, from the pack store or from its file, or None if there is none yet.
+    content_hash = location.content_hash
+    thumbnail_path, derivative = image_processor.find_thumbnail(content_hash, size)
+    if not thumbnail_path:
+        return None
+    content = location.content
+    if (fill_ladder and derivative is not None and derivative < size and content.width
+            and max(content.width, content.height or 0) > derivative
+            and image_processor.thumbnail_is_current(content_hash, thumb_size)):
+        # Generated before this size was on the ladder, serve the closest one while the ladder is filled in.
+        # Thumbnails made at an earlier thumb_size are left to the re-renderer instead of being redone on view.
+        _request_thumbnail(location, content_hash)
+
+    data = pack_store.get(content_hash, derivative)
+    if data is not None:
+        return Response(content=data, media_type="image/webp")
+    try:
+        # FileResponse stats the file anyway, this hands it the result instead.
+        thumbnail_stat = os.stat(thumbnail_path)
+    except FileNotFoundError:
+        # Moved to its shard meanwhile, or removed outside of the application
+        thumbnail_path = derivative_index.relocate(content_hash, derivative)
+        if not thumbnail_path:
+            return None
+        thumbnail_stat = os.stat(thumbnail_path)
+    return FileResponse(thumbnail_path, media_type="image/webp", stat_result=thumbnail_stat)
+
+def _request_thumbnail(location: models.ImageLocation, content_hash: str):
+    # Submits a missing thumbnail to the thumbnail service. Returns its Future, or None if it was not queued.
+    original_filepath = os.path.join(location.path, location.filename)
+    if not Path(original_filepath).is_file():
+        print(f"Could not trigger thumbnail generation for {location.filename}: original_filepath not found or invalid.")
+        return None
+    future = thumbnail_service.submit(content_hash, original_filepath, location.id)
+    if future is None:
+        print(f"Thumbnail queue is full, not queueing {location.filename} (ID: {location.id}) for now.")
+    return future
+
+def _thumbnail_urls(image_id: int) -> dict:
+    return {size: f"/api/thumbnails/{image_id}?size={size}" for size in config.THUMBNAIL_LADDER}
+
 @router.get("/images/", response_model=List[schemas.ImageContent])
 def read_images(
     limit: int = 100,
@@ -151,20 +196,9 @@ def read_images(
     for location in images:
         img = location.content
         # Check if thumbnail exists, if not, trigger generation in background
-        expected_thumbnail_path = os.path.join(config.THUMBNAILS_DIR, f"{img.content_hash}_thumb.webp")
-        if not os.path.exists(expected_thumbnail_path):
+        if not derivative_index.has_thumbnail(img.content_hash):
             print(f"Thumbnail for {location.filename} (ID: {location.id}) not found. Triggering background generation.")
-
-            original_filepath = os.path.join(location.path, location.filename)
-            if original_filepath and Path(original_filepath).is_file():
-                thread = threading.Thread(
-                    target=image_processor.generate_thumbnail_in_background,
-                    args=(location.id, img.content_hash, original_filepath, database.main_event_loop)
-                )
-                thread.daemon = True
-                thread.start()
-            else:
-                print(f"Could not trigger thumbnail generation for {location.filename}: original_filepath not found or invalid.")
+            _request_thumbnail(location, img.content_hash)
 
         if isinstance(img.exif_data, str):
             try:
@@ -176,6 +210,7 @@ def read_images(
             id=location.id,
             filename=location.filename,
             path=location.path,
+            thumbnail_urls=_thumbnail_urls(location.id),
             **img.__dict__
         ))
     return response_images
@@ -198,20 +233,13 @@ def read_image(
     if db_image is None:
         raise HTTPException(status_code=404, detail="Image content not found")
 
+    # Opening an image counts as a view, the re-renderer redoes the most viewed thumbnails first.
+    view_counter.record(db_image.content_hash)
+
     # Check if thumbnail exists, if not, trigger generation in background
-    expected_thumbnail_path = os.path.join(config.THUMBNAILS_DIR, f"{db_image.content_hash}_thumb.webp")
-    if not os.path.exists(expected_thumbnail_path):
+    if not derivative_index.has_thumbnail(db_image.content_hash):
         print(f"Thumbnail for {location_image.filename} (ID: {location_image.id}) not found. Triggering background generation.")
-        original_filepath = os.path.join(location_image.path, location_image.filename)
-        if original_filepath and Path(original_filepath).is_file():
-            thread = threading.Thread(
-                target=image_processor.generate_thumbnail_in_background,
-                args=(location_image.id, db_image.content_hash, original_filepath, database.main_event_loop)
-            )
-            thread.daemon = True
-            thread.start()
-        else:
-            print(f"Could not trigger thumbnail generation for {location_image.filename}: original_filepath not found or invalid.")
+        _request_thumbnail(location_image, db_image.content_hash)
 
     if isinstance(db_image.exif_data, str):
         try:
@@ -223,6 +251,7 @@ def read_image(
         id=location_image.id,
         filename=location_image.filename,
         path=location_image.path,
+        thumbnail_urls=_thumbnail_urls(location_image.id),
         **db_image.__dict__
     )
 
@@ -6,6 +6,7 @@ import auth
 import database
 import models
 import schemas
+from thumbnail_rerender import rerenderer
 
 router = APIRouter()
 
@@ -79,10 +80,14 @@ def update_setting(setting_id: int, setting: schemas.SettingUpdate, db: Session
     if db_setting is None:
         raise HTTPException(status_code=404, detail="Setting not found")
 
+    previous_value = db_setting.value
     for key, value in setting.dict(exclude_unset=True).items():
         setattr(db_setting, key, value)
     db.commit()
     db.refresh(db_setting)
+    if db_setting.name == 'thumb_size' and db_setting.value != previous_value:
+        # Existing thumbnails keep being served until they are re-rendered at the new size
+        rerenderer.start()
     return db_setting
 
 # --- DeviceSetting Endpoints ---
@@ -0,0 +1,145 @@
+import os
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import config
+import models
+
+# Finished runs kept in scan_runs, older ones are deleted when a new run starts.
+SCAN_RUN_HISTORY = 20
+
+def is_within(path: str, root: str) -> bool:
+    """Whether path is root itself or somewhere below it."""
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def walk_order_key(directory: str, top: str) -> Tuple[str, ...]:
+    """
+    Position of a directory in image_processor.walk_directory_tree(top). The walk is
+    depth first with subdirectories in name order, so it visits directories in the
+    order of their path components.
+    """
+    relative = os.path.relpath(directory, top)
+    return () if relative == os.curdir else tuple(relative.split(os.sep))
+
+def path_order_key(path: str) -> Tuple[str, ...]:
+    """
+    Position of a directory in a full scan, which walks the paths in this order, each
+    like walk_directory_tree. Every directory below a path comes after the path itself.
+    """
+    return tuple(os.path.normpath(path).split(os.sep))
+
+
+class ScanCheckpoints:
+    """
+    Persists the progress of scan_paths in ScanRun/ScanCursor rows.
+
+    A run stays 'running' until every path has been walked. scan_paths resumes
+    the most recent running run with the same scope, so a scan interrupted by a
+    restart skips the paths it finished and continues the others from the last
+    saved directory. Each walk is recursive, so paths below a finished walk are
+    skipped as well.
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        scope: Optional[str] = None,
+        recursive: bool = True,
+        checkpoint_interval: float = config.SCAN_CHECKPOINT_INTERVAL
+    ):
+        self.db = db
+        self.scope = scope
+        self.recursive = recursive
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.monotonic()
+        self.cursor: Optional[models.ScanCursor] = None
+        self.cursor_files_base = 0
+
+        self.run = self._runs().filter(models.ScanRun.status == 'running').order_by(models.ScanRun.id.desc()).first()
+        self.resumed = self.run is not None
+        if self.run is None:
+            self._prune_history()
+            self.run = models.ScanRun(status='running', files_done=0, scope=scope, recursive=recursive)
+            db.add(self.run)
+            db.commit()
+        else:
+            print(f"Resuming scan run {self.run.id} started at {self.run.started_at}.")
+        self.walked_roots: List[str] = [
+            c.path for c in self.run.cursors if c.status == 'done'
+        ]
+
+    def _runs(self):
+        # Runs with the same scope as this one. Runs from before scoped scans have a NULL recursive.
+        query = self.db.query(models.ScanRun).filter(
+            models.ScanRun.scope.is_(None) if self.scope is None else models.ScanRun.scope == self.scope
+        )
+        if self.scope is not None:
+            query = query.filter(models.ScanRun.recursive == self.recursive)
+        return query
+
+    def _prune_history(self):
+        old_runs = self.db.query(models.ScanRun).filter(models.ScanRun.status == 'finished').order_by(
+            models.ScanRun.id.desc()
+        ).offset(SCAN_RUN_HISTORY).all()
+        for run in old_runs:
+            self.db.delete(run)
+
+    def expected_files(self) -> Optional[int]:
+        """Number of files the last finished run with this scope walked, as an estimate for this one."""
+        last_run = self._runs().filter(models.ScanRun.status == 'finished').order_by(
+            models.ScanRun.id.desc()
+        ).first()
+        return last_run.files_done if last_run else None
+
+    def is_walked(self, path: str) -> bool:
+        """Whether path was covered by a finished walk of this run."""
+        return any(is_within(path, root) for root in self.walked_roots)
+
+    def start_path(self, path: str) -> Optional[str]:
+        """Opens the cursor for a path and returns the directory to resume after, if any."""
+        self.cursor = next((c for c in self.run.cursors if c.path == path), None)
+        if self.cursor is None:
+            self.cursor = models.ScanCursor(path=path, status='running', files_done=0)
+            self.run.cursors.append(self.cursor)
+            self.db.commit()
+        elif self.cursor.position:
+            print(f"Resuming '{path}' after '{self.cursor.position}' ({self.cursor.files_done} files already done).")
+        self.cursor_files_base = self.cursor.files_done or 0
+        self.last_checkpoint = time.monotonic()
+        return self.cursor.position
+
+    def is_due(self) -> bool:
+        return time.monotonic() - self.last_checkpoint >= self.checkpoint_interval
+
+    def checkpoint(self, directory: str, files_done: int):
+        """
+        Saves directory as the resume position of the current path. All files up to and
+        including it must already be written, so callers drain the scan pipeline first.
+        """
+        self._set_files_done(files_done)
+        self.cursor.position = directory
+        self.db.commit()
+        self.last_checkpoint = time.monotonic()
+
+    def finish_path(self, files_done: int):
+        self._set_files_done(files_done)
+        self.cursor.status = 'done'
+        self.cursor.position = None
+        self.cursor.finished_at = datetime.now(timezone.utc)
+        self.db.commit()
+        self.walked_roots.append(self.cursor.path)
+        self.cursor = None
+
+    def finish(self):
+        self.run.status = 'finished'
+        self.run.finished_at = datetime.now(timezone.utc)
+        self.db.commit()
+
+    def _set_files_done(self, files_done: int):
+        # files_done counts this process' files, the cursor also holds those of earlier attempts.
+        total = self.cursor_files_base + files_done
+        self.run.files_done = (self.run.files_done or 0) + total - (self.cursor.files_done or 0)
+        self.cursor.files_done = total
@@ -0,0 +1,177 @@
+import threading
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+from sqlalchemy import func
+
+import database
+import image_processor
+import models
+from scan_checkpoints import path_order_key
+
+
+class ScanRequest:
+    """A requested scan: the whole library, or one ImagePath with or without its subdirectories."""
+
+    def __init__(
+        self,
+        image_path_id: Optional[int] = None,
+        recursive: bool = True,
+        reason: str = "manual",
+        path: Optional[str] = None
+    ):
+        self.image_path_id = image_path_id
+        self.path = path # Of the ImagePath, if it exists
+        self.recursive = recursive if image_path_id is not None else True
+        self.reasons = [reason]
+        self.requested_at = datetime.now(timezone.utc)
+        self.started_at = None
+        self.finished_at = None
+        # Highest ImagePath ID when a full scan started, paths created later are not in its walk.
+        self.max_path_id = None
+        # path_order_key of the directory a running full scan has reached, None until it reaches one.
+        self.position: Optional[Tuple[str, ...]] = None
+
+    @property
+    def is_full(self) -> bool:
+        return self.image_path_id is None
+
+    def covers(self, other: "ScanRequest") -> bool:
+        """
+        Whether this scan also does everything other would do. A running full scan only
+        covers paths its walk has not reached yet, as files may have changed behind it.
+        """
+        if self.is_full:
+            if self.position is None:
+                return self.max_path_id is None or other.is_full or other.image_path_id <= self.max_path_id
+            return (
+                not other.is_full and other.path is not None and other.image_path_id <= self.max_path_id
+                and path_order_key(other.path) > self.position
+            )
+        return other.image_path_id == self.image_path_id and (self.recursive or not other.recursive)
+
+    def to_dict(self) -> dict:
+        return {
+            "image_path_id": self.image_path_id,
+            "recursive": self.recursive,
+            "reasons": self.reasons,
+            "requested_at": self.requested_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class ScanCoordinator:
+    """
+    Runs scan_paths on a single worker thread, so scans never overlap.
+
+    A request that the running scan already covers, e.g. for a path its walk has not
+    reached yet, is coalesced into it. Anything else is queued as a follow-up, merged
+    with the queue: a queued full scan absorbs every other request, and requests for
+    the same ImagePath become one. The worker thread runs the queue dry and exits,
+    and is started again by the next request.
+    """
+
+    def __init__(self, session_factory=database.SessionLocal):
+        self.session_factory = session_factory
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.running: Optional[ScanRequest] = None
+        self.queued: List[ScanRequest] = []
+        self.last_finished: Optional[ScanRequest] = None
+        self.last_error: Optional[str] = None
+        self.coalesced_requests = 0
+
+    def request_scan(self, image_path_id: Optional[int] = None, recursive: bool = True, reason: str = "manual") -> str:
+        """
+        Asks for a scan and returns what happened to the request: 'coalesced' into the
+        running or a queued scan, or 'queued' to run after the current one.
+        """
+        path = None
+        if image_path_id is not None:
+            db = self.session_factory()
+            try:
+                path = db.query(models.ImagePath.path).filter(models.ImagePath.id == image_path_id).scalar()
+            finally:
+                db.close()
+        request = ScanRequest(image_path_id, recursive, reason, path)
+        with self._lock:
+            outcome = self._enqueue(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="scan-coordinator", daemon=True)
+                self._thread.start()
+        print(f"Scan requested ({reason}, path ID {image_path_id}, recursive={request.recursive}): {outcome}.")
+        return outcome
+
+    def _enqueue(self, request: ScanRequest) -> str:
+        # Called with the lock held.
+        if self.running and self.running.covers(request):
+            self.running.reasons.append(request.reasons[0])
+            self.coalesced_requests += 1
+            return "coalesced"
+        for queued in self.queued:
+            if queued.covers(request):
+                queued.reasons.extend(request.reasons)
+                self.coalesced_requests += 1
+                return "coalesced"
+        # The new request may cover queued ones, e.g. a full scan after scoped ones.
+        absorbed = [queued for queued in self.queued if request.covers(queued)]
+        for queued in absorbed:
+            request.reasons.extend(queued.reasons)
+            self.queued.remove(queued)
+        self.coalesced_requests += len(absorbed)
+        self.queued.append(request)
+        return "queued"
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.queued:
+                    # Cleared under the lock, so a request made from now on starts a new thread.
+                    self.running = None
+                    self._thread = None
+                    return
+                request = self.queued.pop(0)
+                request.started_at = datetime.now(timezone.utc)
+                self.running = request
+
+            db = self.session_factory()
+            try:
+                if request.is_full:
+                    request.max_path_id = db.query(func.max(models.ImagePath.id)).scalar() or 0
+                image_processor.scan_paths(
+                    db, image_path_id=request.image_path_id, recursive=request.recursive,
+                    on_directory=lambda directory: self._reached(request, directory)
+                )
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error during scan: {e}")
+            finally:
+                db.close()
+
+            with self._lock:
+                request.finished_at = datetime.now(timezone.utc)
+                self.last_finished = request
+                self.running = None
+
+    def _reached(self, request: ScanRequest, directory: str):
+        # Called by the scan for every directory it walks.
+        position = path_order_key(directory)
+        with self._lock:
+            request.position = position
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "state": "running" if self.running else "idle",
+                "running": self.running.to_dict() if self.running else None,
+                "queued": [request.to_dict() for request in self.queued],
+                "last_finished": self.last_finished.to_dict() if self.last_finished else None,
+                "last_error": self.last_error,
+                "coalesced_requests": self.coalesced_requests,
+            }
+
+
+# The one coordinator every scan goes through
+coordinator = ScanCoordinator()
@@ -0,0 +1,188 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+import config
+import database
+from websocket_manager import manager
+
+# Rates are averaged over this many seconds of samples.
+RATE_WINDOW_SECONDS = 10
+
+
+class ProgressTracker:
+    """
+    Live progress of a long-running task such as a scan or metadata reprocessing.
+
+    The task reports finished files and times its stages, and registers callables
+    that return its queue depths. While the task runs, a timer thread samples the
+    counters every SCAN_PROGRESS_INTERVAL seconds and pushes a snapshot to admin
+    WebSocket clients. Comparing the busy stages, the queue depths and cpu_percent
+    shows whether a scan is waiting on the disk or on the CPU.
+    """
+
+    def __init__(self, task: str):
+        self.task = task
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._publisher: Optional[threading.Thread] = None
+        self._reset()
+        self.state = 'idle'
+
+    def _reset(self):
+        self.state = 'running'
+        self.started_at = datetime.now(timezone.utc)
+        self.finished_at = None
+        self.current_path = None
+        self.files_done = 0
+        self.files_total = None
+        self.files_total_estimated = False
+        self.bytes_read = 0
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.queues: Dict[str, Callable[[], int]] = {}
+        self.samples = deque()
+
+    def start(self):
+        """Resets the counters for a new run and starts pushing snapshots."""
+        # Each run has a publisher and stop event of its own, so a publisher still on its way out
+        # after finish() cannot be mistaken for the one of this run.
+        stop = threading.Event()
+        with self._lock:
+            self._reset()
+            self._sample()
+            previous_stop, self._stop = self._stop, stop
+        previous_stop.set()
+        self._publisher = threading.Thread(target=self._publish_loop, args=(stop,), name=f"{self.task}-progress", daemon=True)
+        self._publisher.start()
+
+    def finish(self):
+        with self._lock:
+            self.state = 'finished'
+            self.finished_at = datetime.now(timezone.utc)
+            self.current_path = None
+            self.queues = {}
+            stop = self._stop
+        stop.set()
+        self.publish()
+
+    def set_total(self, files_total: Optional[int], estimated: bool = False, files_done: int = 0):
+        """Sets the expected number of files, which enables the ETA, and the files already done by an earlier attempt."""
+        with self._lock:
+            self.files_total = files_total
+            self.files_total_estimated = estimated
+            self.files_done = files_done
+            self.samples.clear()
+            self._sample()
+
+    def set_path(self, path: Optional[str]):
+        self.current_path = path
+
+    def add_files(self, count: int = 1, bytes_read: int = 0):
+        with self._lock:
+            self.files_done += count
+            self.bytes_read += bytes_read
+
+    def watch_queue(self, name: str, depth: Callable[[], int]):
+        """Registers a callable that returns the current depth of a queue."""
+        self.queues[name] = depth
+
+    @contextmanager
+    def stage(self, name: str):
+        """Times a block of work as part of a stage, and counts it as active while it runs."""
+        with self._lock:
+            stage = self.stages.setdefault(name, {"active": 0, "seconds": 0.0, "items": 0})
+            stage["active"] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                stage["active"] -= 1
+                stage["items"] += 1
+                stage["seconds"] += time.perf_counter() - start
+
+    def _sample(self):
+        # Called with the lock held.
+        now = time.monotonic()
+        self.samples.append((now, self.files_done, self.bytes_read, time.process_time()))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= RATE_WINDOW_SECONDS:
+            self.samples.popleft()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            files_per_second = bytes_per_second = cpu_percent = None
+            if self.samples and self.state == 'running':
+                since, files, bytes_read, cpu = self.samples[0]
+                elapsed = now - since
+                if elapsed > 0:
+                    files_per_second = (self.files_done - files) / elapsed
+                    bytes_per_second = (self.bytes_read - bytes_read) / elapsed
+                    cpu_percent = 100 * (time.process_time() - cpu) / elapsed
+
+            eta_seconds = None
+            if self.files_total and files_per_second:
+                eta_seconds = max(0, self.files_total - self.files_done) / files_per_second
+
+            queues = {}
+            for name, depth in self.queues.items():
+                try:
+                    queues[name] = depth()
+                except Exception:
+                    queues[name] = None
+
+            end = self.finished_at or datetime.now(timezone.utc)
+            return {
+                "task": self.task,
+                "state": self.state,
+                "started_at": self.started_at.isoformat() if self.state != 'idle' else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                "elapsed_seconds": (end - self.started_at).total_seconds() if self.state != 'idle' else 0,
+                "current_path": self.current_path,
+                "files_done": self.files_done,
+                "files_total": self.files_total,
+                "files_total_estimated": self.files_total_estimated,
+                "bytes_read": self.bytes_read,
+                "files_per_second": files_per_second,
+                "bytes_per_second": bytes_per_second,
+                "cpu_percent": cpu_percent,
+                "eta_seconds": eta_seconds,
+                "queues": queues,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+            }
+
+    def publish(self):
+        """Pushes a snapshot to admin clients, if the server's event loop is available."""
+        if database.main_event_loop is None:
+            return
+        message = {"type": "scan_progress", "progress": self.snapshot()}
+        asyncio.run_coroutine_threadsafe(manager.broadcast_to_admins_json(message), database.main_event_loop)
+
+    def _publish_loop(self, stop: threading.Event):
+        while not stop.wait(config.SCAN_PROGRESS_INTERVAL):
+            with self._lock:
+                self._sample()
+            try:
+                self.publish()
+            except Exception as e:
+                print(f"Error publishing {self.task} progress: {e}")
+
+
+_trackers: Dict[str, ProgressTracker] = {}
+_trackers_lock = threading.Lock()
+
+def get_tracker(task: str) -> ProgressTracker:
+    """Returns the tracker for a task ('scan', 'metadata'), creating it on first use."""
+    with _trackers_lock:
+        if task not in _trackers:
+            _trackers[task] = ProgressTracker(task)
+        return _trackers[task]
+
+def snapshot_all() -> Dict[str, dict]:
+    with _trackers_lock:
+        trackers = list(_trackers.values())
+    return {tracker.task: tracker.snapshot() for tracker in trackers}
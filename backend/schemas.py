@@ -116,6 +116,8 @@ class ImageContent(ImageBase):
     path: Optional[str] = None
     width: Optional[int] = None
     height: Optional[int] = None
+    needs_metadata: Optional[bool] = False # Width, height and EXIF are still being read
+    thumbnail_urls: Dict[int, str] = {} # Thumbnail URL per ladder size, in pixels
     tags: List[Tag] = []
     locations: List[ImageLocationSchema] = []
 
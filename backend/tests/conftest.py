@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+# The backend modules import each other as top-level modules.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import models
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A session on an empty database of its own, set up like database.engine."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", lambda dbapi_connection, _: dbapi_connection.create_function("regexp", 2, database.regexp))
+    models.Base.metadata.create_all(bind=engine)
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
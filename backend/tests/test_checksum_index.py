@@ -0,0 +1,65 @@
+import hashlib
+
+import checksum_index
+from checksum_index import ChecksumIndex, _BloomFilter, _to_key
+
+
+def _digest(i: int) -> str:
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+
+def test_lookups_after_build():
+    index = ChecksumIndex(use_bloom_filter=False)
+    index.build([_digest(i) for i in range(100)] + ["not-a-digest"])
+    assert len(index) == 101
+    assert all(_digest(i) in index for i in range(100))
+    assert _digest(100) not in index
+    assert "not-a-digest" in index
+
+
+def test_short_digests_are_padded():
+    index = ChecksumIndex(use_bloom_filter=False)
+    short = hashlib.md5(b"xxh3 sized").hexdigest()
+    index.build([short])
+    assert short in index
+    assert hashlib.md5(b"other").hexdigest() not in index
+
+
+def test_add_and_discard():
+    index = ChecksumIndex(use_bloom_filter=False)
+    index.build(_digest(i) for i in range(10))
+    index.add(_digest(10))
+    index.discard(_digest(0))
+    index.discard(_digest(99)) # Unknown, ignored
+    assert _digest(10) in index and _digest(0) not in index
+    assert len(index) == 10
+    index.add(_digest(0))
+    assert _digest(0) in index
+
+
+def test_pending_changes_are_merged(monkeypatch):
+    monkeypatch.setattr(checksum_index, "MERGE_THRESHOLD", 4)
+    index = ChecksumIndex(use_bloom_filter=False)
+    index.build(_digest(i) for i in range(0, 20, 2))
+    for i in range(1, 20, 2):
+        index.add(_digest(i))
+    for i in range(0, 10):
+        index.discard(_digest(i))
+    assert [i for i in range(20) if _digest(i) in index] == list(range(10, 20))
+    assert len(index) == 10
+
+
+def test_bloom_filter_has_no_false_negatives():
+    index = ChecksumIndex(use_bloom_filter=True)
+    index.build(_digest(i) for i in range(1000))
+    index.add(_digest(1000))
+    assert all(_digest(i) in index for i in range(1001))
+    assert _digest(1001) not in index
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom = _BloomFilter(1000)
+    for i in range(1000):
+        bloom.add(_to_key(_digest(i)))
+    false_positives = sum(bloom.might_contain(_to_key(_digest(i))) for i in range(1000, 11000))
+    assert false_positives < 300 # About 1% expected
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+import config
+import pack_store
+from derivative_index import PREVIEW, THUMBNAIL, DerivativeIndex, derivative_path, flat_derivative_path, parse_derivative_name
+
+HASH_A = "ab" * 32
+HASH_B = "cd" * 32
+
+
+@pytest.fixture
+def media_dirs(tmp_path, monkeypatch):
+    """Empty thumbnail and preview directories, and an empty pack store."""
+    monkeypatch.setattr(config, "THUMBNAILS_DIR", str(tmp_path / "thumbnails"))
+    monkeypatch.setattr(config, "PREVIEWS_DIR", str(tmp_path / "previews"))
+    store = pack_store.PackStore(directory=str(tmp_path / "packs"))
+    monkeypatch.setattr(pack_store, "pack_store", store)
+    return store
+
+def _touch(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "wb").close()
+
+
+def test_paths_and_names(media_dirs):
+    path = derivative_path(HASH_A, 400)
+    assert path == os.path.join(config.THUMBNAILS_DIR, "ab", "ab", f"{HASH_A}_thumb_400.webp")
+    assert parse_derivative_name(os.path.basename(path), config.THUMBNAILS_DIR) == (HASH_A, 400)
+    assert parse_derivative_name(f"{HASH_A}_thumb.webp", config.THUMBNAILS_DIR) == (HASH_A, THUMBNAIL)
+    assert parse_derivative_name(f"{HASH_A}_preview.webp", config.PREVIEWS_DIR) == (HASH_A, PREVIEW)
+    assert parse_derivative_name("notes.txt", config.THUMBNAILS_DIR) is None
+
+
+def test_load_finds_sharded_flat_and_packed_derivatives(media_dirs):
+    _touch(derivative_path(HASH_A, 400))
+    _touch(derivative_path(HASH_A, PREVIEW))
+    _touch(flat_derivative_path(HASH_B, THUMBNAIL))
+    media_dirs.load()
+    media_dirs.put(HASH_B, 200, b"packed")
+
+    index = DerivativeIndex()
+    index.load()
+    assert sorted(index.derivatives(HASH_A), key=str) == [400, PREVIEW]
+    assert index.has(HASH_B, 200) and index.has(HASH_B, THUMBNAIL)
+    assert index.has_thumbnail(HASH_A) and index.has_thumbnail(HASH_B)
+    assert index.path(HASH_B, THUMBNAIL) == flat_derivative_path(HASH_B, THUMBNAIL)
+    assert index.path(HASH_A, 400) == derivative_path(HASH_A, 400)
+
+
+def test_add_and_discard_after_load(media_dirs):
+    index = DerivativeIndex()
+    index.load()
+    assert not index.has_thumbnail(HASH_A)
+    index.add(HASH_A, 800)
+    index.add(HASH_A, PREVIEW)
+    assert index.has(HASH_A, 800) and index.has_thumbnail(HASH_A)
+    index.discard(HASH_A, 800)
+    assert not index.has_thumbnail(HASH_A)
+    assert index.derivatives(HASH_A) == [PREVIEW]
+
+
+def test_lookups_fall_back_to_the_filesystem_until_loaded(media_dirs):
+    _touch(derivative_path(HASH_A, config.THUMBNAIL_LADDER[0]))
+    index = DerivativeIndex()
+    assert index.has(HASH_A, config.THUMBNAIL_LADDER[0])
+    assert index.has_thumbnail(HASH_A)
+    assert not index.has(HASH_B, config.THUMBNAIL_LADDER[0])
+
+
+def test_relocate_corrects_a_stale_entry(media_dirs):
+    _touch(flat_derivative_path(HASH_A, 400))
+    index = DerivativeIndex()
+    index.load()
+    # Moved into its shard behind the index's back
+    os.makedirs(os.path.dirname(derivative_path(HASH_A, 400)))
+    os.rename(flat_derivative_path(HASH_A, 400), derivative_path(HASH_A, 400))
+    assert index.relocate(HASH_A, 400) == derivative_path(HASH_A, 400)
+    assert index.path(HASH_A, 400) == derivative_path(HASH_A, 400)
+    os.remove(derivative_path(HASH_A, 400))
+    assert index.relocate(HASH_A, 400) is None
+    assert not index.has(HASH_A, 400)
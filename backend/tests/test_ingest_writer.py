@@ -0,0 +1,110 @@
+import pytest
+from sqlalchemy.orm import Session
+
+import models
+from checksum_index import ChecksumIndex
+from ingest_writer import IngestWriter
+
+
+def _record(checksum: str, filename: str, location_id=None) -> dict:
+    # A record as image_processor.prepare_file_record produces it for a new file.
+    return {
+        "checksum": checksum,
+        "full_path": f"/library/{filename}",
+        "filename": filename,
+        "path": "/library",
+        "file_size": 100,
+        "content": {"is_video": False, "width": 10, "height": 10, "file_size": 100, "sample_hash": "s" + checksum},
+        "identified_by_sample": False,
+        "sample_hash": "s" + checksum,
+        "location_id": location_id,
+        "fingerprint": {"file_size": 100, "mtime_ns": 1, "inode": 1, "device": 1},
+    }
+
+def _counts(db: Session):
+    return db.query(models.ImageContent).count(), db.query(models.ImageLocation).count()
+
+
+def test_batch_is_written_in_one_flush(db):
+    checksums = set()
+    with IngestWriter(db, checksums, batch_size=100) as writer:
+        writer.add_record(_record("a" * 64, "a.jpg"))
+        writer.add_record(_record("b" * 64, "b.jpg"))
+        writer.add_record(_record("a" * 64, "copy_of_a.jpg"))
+    assert _counts(db) == (2, 3)
+    assert writer.inserted_contents == 2 and writer.inserted_locations == 3
+    assert checksums == {"a" * 64, "b" * 64}
+
+
+def test_conflicting_rows_are_skipped(db):
+    with IngestWriter(db, set(), batch_size=100) as writer:
+        writer.add_record(_record("a" * 64, "a.jpg"))
+    # The same file added again, e.g. by the file watcher, with content the writer does not know about.
+    with IngestWriter(db, set(), batch_size=100) as writer:
+        writer.add_record(_record("a" * 64, "a.jpg"))
+        writer.add_record(_record("b" * 64, "b.jpg"))
+    assert _counts(db) == (2, 2)
+    assert writer.inserted_contents == 1 and writer.inserted_locations == 1
+    assert writer.skipped_rows == 2
+
+
+def test_failed_batch_writes_nothing(db, monkeypatch):
+    with IngestWriter(db, set(), batch_size=100) as writer:
+        writer.add_record(_record("a" * 64, "a.jpg"))
+    location_id = db.query(models.ImageLocation.id).scalar()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(db, "bulk_update_mappings", fail)
+
+    checksums = {"a" * 64}
+    writer = IngestWriter(db, checksums, batch_size=100)
+    writer.add_record(_record("b" * 64, "b.jpg"))
+    writer.add_record(_record("c" * 64, "c.jpg"))
+    writer.add_record(_record("a" * 64, "a.jpg", location_id=location_id)) # Fails after the inserts
+    writer.flush()
+
+    db.rollback()
+    assert _counts(db) == (1, 1)
+    assert writer.inserted_contents == 0 and writer.inserted_locations == 0
+    assert checksums == {"a" * 64}
+
+
+def test_failed_batch_after_conflicts_writes_nothing(db, monkeypatch):
+    with IngestWriter(db, set(), batch_size=100) as writer:
+        writer.add_record(_record("a" * 64, "a.jpg"))
+    location_id = db.query(models.ImageLocation.id).scalar()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(db, "bulk_update_mappings", fail)
+
+    # The conflicting content sends the inserts down the row by row path before the failure.
+    writer = IngestWriter(db, set(), batch_size=100)
+    writer.add_record(_record("a" * 64, "other.jpg"))
+    writer.add_record(_record("b" * 64, "b.jpg"))
+    writer.add_record(_record("a" * 64, "a.jpg", location_id=location_id))
+    writer.flush()
+
+    db.rollback()
+    assert _counts(db) == (1, 1)
+
+
+def test_checksums_are_shared_once_committed(db):
+    checksums = set()
+    writer = IngestWriter(db, checksums, batch_size=100)
+    writer.add_record(_record("a" * 64, "a.jpg"))
+    writer.add_record(_record("a" * 64, "copy_of_a.jpg"))
+    assert checksums == set() # Queued, but not in the database yet
+    writer.flush()
+    assert _counts(db) == (1, 2)
+    assert checksums == {"a" * 64}
+
+
+def test_checksums_are_added_to_a_checksum_index(db):
+    # The scanner shares a ChecksumIndex rather than a set.
+    checksums = ChecksumIndex(use_bloom_filter=True)
+    with IngestWriter(db, checksums, batch_size=100) as writer:
+        writer.add_record(_record("a" * 64, "a.jpg"))
+    assert _counts(db) == (1, 1)
+    assert "a" * 64 in checksums
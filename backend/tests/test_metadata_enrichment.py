@@ -0,0 +1,29 @@
+import threading
+
+import image_processor
+import metadata_enrichment
+from metadata_enrichment import MetadataEnricher
+
+
+def test_failed_batch_does_not_strand_the_queue(db, monkeypatch):
+    monkeypatch.setattr(metadata_enrichment, "METADATA_BATCH_SIZE", 1)
+    both_queued = threading.Event()
+    calls = []
+
+    def thumbnail_size(session):
+        calls.append(len(calls))
+        if len(calls) == 1:
+            both_queued.wait(5) # The second item is queued while the first batch runs
+            raise RuntimeError("database is locked")
+        return 400
+    monkeypatch.setattr(image_processor, "get_thumbnail_size", thumbnail_size)
+
+    enricher = MetadataEnricher(session_factory=lambda: db, workers=1)
+    enricher.enqueue("a" * 64, "/missing/a.jpg")
+    thread = enricher._thread
+    enricher.enqueue("b" * 64, "/missing/b.jpg")
+    both_queued.set()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert len(calls) == 2 # The same dispatcher went on after the first batch failed
+    assert enricher.pending() == 0 and enricher._thread is None
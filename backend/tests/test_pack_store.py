@@ -0,0 +1,91 @@
+import os
+
+from derivative_index import PREVIEW, THUMBNAIL
+from pack_store import PackStore
+
+HASH_A = "a" * 64
+HASH_B = "b" * 64
+
+
+def _store(tmp_path, pack_size: int = 4096) -> PackStore:
+    store = PackStore(directory=str(tmp_path / "packs"), pack_size=pack_size)
+    store.load()
+    return store
+
+def _pack_paths(tmp_path):
+    return sorted(os.listdir(tmp_path / "packs"))
+
+
+def test_put_get_and_delete(tmp_path):
+    store = _store(tmp_path)
+    assert store.put(HASH_A, 200, b"thumbnail")
+    assert store.put(HASH_A, PREVIEW, b"preview")
+    assert store.put(HASH_A, 200, b"newer thumbnail")
+    assert store.get(HASH_A, 200) == b"newer thumbnail"
+    assert store.get(HASH_A, PREVIEW) == b"preview"
+    assert store.get(HASH_A, THUMBNAIL) is None
+    assert (HASH_A, PREVIEW) in store
+    store.delete(HASH_A, PREVIEW)
+    assert store.get(HASH_A, PREVIEW) is None
+    assert sorted(store.derivatives(), key=str) == [(HASH_A, 200)]
+
+
+def test_get_returns_none_until_loaded(tmp_path):
+    _store(tmp_path).put(HASH_A, 200, b"thumbnail")
+    store = PackStore(directory=str(tmp_path / "packs"))
+    assert store.get(HASH_A, 200) is None
+    store.load_in_background()
+    store.wait()
+    assert store.get(HASH_A, 200) == b"thumbnail"
+
+
+def test_index_is_rebuilt_from_the_packs(tmp_path):
+    store = _store(tmp_path, pack_size=64)
+    store.put(HASH_A, 200, b"a" * 40)
+    store.put(HASH_B, 200, b"b" * 40) # Starts a second pack
+    store.put(HASH_A, THUMBNAIL, b"legacy")
+    store.delete(HASH_B, 200)
+    assert len(_pack_paths(tmp_path)) >= 2
+
+    reloaded = _store(tmp_path, pack_size=64)
+    assert reloaded.get(HASH_A, 200) == b"a" * 40
+    assert reloaded.get(HASH_A, THUMBNAIL) == b"legacy"
+    assert reloaded.get(HASH_B, 200) is None
+
+
+def test_torn_record_is_dropped_and_written_over(tmp_path):
+    store = _store(tmp_path)
+    store.put(HASH_A, 200, b"complete")
+    store.put(HASH_B, 200, b"torn by a crash")
+    pack_path = tmp_path / "packs" / _pack_paths(tmp_path)[-1]
+    end = store.status()["bytes"]
+    for pack in store._packs.values():
+        pack.close()
+    with open(pack_path, "r+b") as f:
+        f.truncate(end - 4)
+
+    reloaded = _store(tmp_path)
+    assert reloaded.get(HASH_A, 200) == b"complete"
+    assert reloaded.get(HASH_B, 200) is None
+    reloaded.put(HASH_B, 200, b"again")
+    assert _store(tmp_path).get(HASH_B, 200) == b"again"
+
+
+def test_compaction_drops_removed_content_and_rewrites_dead_packs(tmp_path):
+    store = _store(tmp_path, pack_size=128)
+    for i in range(6):
+        store.put(HASH_A, 200 + i, bytes([i]) * 40) # Two records per pack
+    store.put(HASH_B, 200, b"removed content")
+    for i in range(5):
+        store.delete(HASH_A, 200 + i)
+    packs_before = len(_pack_paths(tmp_path))
+
+    result = store.compact(keep=lambda content_hash: content_hash != HASH_B)
+    assert result["dropped"] == 1
+    assert result["packs_compacted"] > 0 and result["bytes_reclaimed"] > 0
+    assert len(_pack_paths(tmp_path)) < packs_before
+    assert store.get(HASH_A, 205) == bytes([5]) * 40
+    assert store.get(HASH_B, 200) is None
+
+    reloaded = _store(tmp_path, pack_size=128)
+    assert sorted(reloaded.derivatives(), key=str) == [(HASH_A, 205)]
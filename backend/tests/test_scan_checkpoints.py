@@ -0,0 +1,75 @@
+import os
+
+import models
+from image_processor import walk_directory_tree
+from scan_checkpoints import ScanCheckpoints, is_within, walk_order_key
+
+
+def _tree(tmp_path) -> str:
+    # library/{a/{a1,a2},b/b1,c}, with one file in each directory.
+    top = tmp_path / "library"
+    for directory in ["a/a1", "a/a2", "b/b1", "c"]:
+        (top / directory).mkdir(parents=True)
+    for root, _, _ in os.walk(top):
+        open(os.path.join(root, "image.jpg"), "wb").close()
+    return str(top)
+
+def _walk(top: str, resume_after=None) -> list:
+    walked = []
+    for directory, _, entries in walk_directory_tree(top, resume_after):
+        for _ in entries:
+            pass
+        walked.append(os.path.relpath(directory, top))
+    return walked
+
+
+def test_walk_order_matches_walk_order_key(tmp_path):
+    top = _tree(tmp_path)
+    walked = _walk(top)
+    assert walked == [".", "a", "a/a1", "a/a2", "b", "b/b1", "c"]
+    keys = [walk_order_key(os.path.join(top, directory), top) for directory in walked]
+    assert keys == sorted(keys)
+
+
+def test_walk_resumes_after_a_directory(tmp_path):
+    top = _tree(tmp_path)
+    assert _walk(top, os.path.join(top, "a", "a2")) == ["b", "b/b1", "c"]
+    assert _walk(top, os.path.join(top, "a")) == ["a/a1", "a/a2", "b", "b/b1", "c"]
+
+
+def test_interrupted_run_is_resumed(db, tmp_path):
+    top = _tree(tmp_path)
+    other = str(tmp_path / "other")
+    checkpoints = ScanCheckpoints(db, checkpoint_interval=0)
+    checkpoints.start_path(other)
+    checkpoints.finish_path(3)
+    assert checkpoints.start_path(top) is None
+    checkpoints.checkpoint(os.path.join(top, "a", "a2"), 4)
+    run_id = checkpoints.run.id
+    db.expunge_all() # The scanner was interrupted here
+
+    resumed = ScanCheckpoints(db)
+    assert resumed.resumed and resumed.run.id == run_id
+    assert resumed.is_walked(other) and resumed.is_walked(os.path.join(other, "sub"))
+    assert not resumed.is_walked(top)
+    resume_after = resumed.start_path(top)
+    assert resume_after == os.path.join(top, "a", "a2")
+    assert _walk(top, resume_after) == ["b", "b/b1", "c"]
+
+    resumed.finish_path(3) # The files after the resume position
+    resumed.finish()
+    run = db.query(models.ScanRun).one()
+    assert run.status == "finished" and run.files_done == 10
+
+
+def test_scoped_runs_are_resumed_separately(db, tmp_path):
+    top = _tree(tmp_path)
+    ScanCheckpoints(db, scope=top, recursive=True)
+    assert not ScanCheckpoints(db).resumed
+    assert not ScanCheckpoints(db, scope=top, recursive=False).resumed
+    assert ScanCheckpoints(db, scope=top, recursive=True).resumed
+
+
+def test_is_within():
+    assert is_within("/library/a", "/library")
+    assert not is_within("/library-old", "/library")
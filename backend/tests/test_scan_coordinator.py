@@ -0,0 +1,32 @@
+from scan_checkpoints import path_order_key
+from scan_coordinator import ScanRequest
+
+
+def _running_full_scan(max_path_id: int, position=None) -> ScanRequest:
+    request = ScanRequest()
+    request.max_path_id = max_path_id
+    request.position = path_order_key(position) if position else None
+    return request
+
+
+def test_full_scan_before_its_walk_covers_known_paths():
+    running = _running_full_scan(10)
+    assert running.covers(ScanRequest(3, path="/library/a"))
+    assert running.covers(ScanRequest())
+    assert not running.covers(ScanRequest(11, path="/library/new")) # Created after the scan started
+
+
+def test_full_scan_only_covers_paths_it_has_not_reached():
+    running = _running_full_scan(10, "/library/m/x")
+    assert running.covers(ScanRequest(4, path="/library/z"))
+    assert running.covers(ScanRequest(5, path="/library/m/y"))
+    assert not running.covers(ScanRequest(6, path="/library/a")) # Walked already
+    assert not running.covers(ScanRequest(7, path="/library/m")) # Partly walked
+    assert not running.covers(ScanRequest(8, path="/library/m/x")) # Being walked
+    assert not running.covers(ScanRequest())
+
+
+def test_scoped_scan_covers_same_path():
+    running = ScanRequest(3, recursive=True, path="/library/a")
+    assert running.covers(ScanRequest(3, recursive=False, path="/library/a"))
+    assert not ScanRequest(3, recursive=False, path="/library/a").covers(running)
@@ -0,0 +1,18 @@
+import config
+from scan_progress import ProgressTracker
+
+
+def test_restart_right_after_finish_gets_a_publisher(monkeypatch):
+    monkeypatch.setattr(config, "SCAN_PROGRESS_INTERVAL", 60)
+    tracker = ProgressTracker("test")
+    tracker.start()
+    first = tracker._publisher
+    tracker.finish()
+    tracker.start() # Before the first publisher has exited
+    assert tracker._publisher is not first and tracker._publisher.is_alive()
+    first.join(timeout=5)
+    assert not first.is_alive()
+    assert tracker._publisher.is_alive() # The new run is still published
+    tracker.finish()
+    tracker._publisher.join(timeout=5)
+    assert not tracker._publisher.is_alive()
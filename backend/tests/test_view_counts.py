@@ -0,0 +1,19 @@
+import models
+from view_counts import ViewCounter
+
+
+def test_views_are_written_in_one_flush_without_touching_date_indexed(db):
+    db.add(models.ImageContent(content_hash="a" * 64, is_video=False))
+    db.add(models.ImageContent(content_hash="b" * 64, is_video=False, view_count=2))
+    db.commit()
+    date_indexed = db.query(models.ImageContent.date_indexed).filter_by(content_hash="a" * 64).scalar()
+
+    counter = ViewCounter(session_factory=lambda: db, flush_interval=3600)
+    for content_hash in ["a" * 64, "b" * 64, "a" * 64]:
+        counter.record(content_hash)
+    assert db.query(models.ImageContent.view_count).filter_by(content_hash="a" * 64).scalar() == 0
+    counter.flush()
+
+    counts = dict(db.query(models.ImageContent.content_hash, models.ImageContent.view_count))
+    assert counts == {"a" * 64: 2, "b" * 64: 3}
+    assert db.query(models.ImageContent.date_indexed).filter_by(content_hash="a" * 64).scalar() == date_indexed
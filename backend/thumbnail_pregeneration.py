@@ -0,0 +1,142 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, List, Set, Tuple
+
+import config
+import database
+from derivative_index import derivative_index
+import image_processor
+import scan_progress
+import thumbnail_service
+from websocket_manager import manager
+
+# Pre-generation waits until no user-driven thumbnail was requested for this many seconds.
+USER_IDLE_SECONDS = 1.0
+
+# Niceness added to the pre-generation threads, where the OS supports it per thread.
+THREAD_NICENESS = 10
+
+# Minimum seconds between refreshes pushed to clients while thumbnails are generated.
+REFRESH_INTERVAL = 10.0
+
+
+class ThumbnailPregenerator:
+    """
+    Generates thumbnails for new content ahead of time, when EAGER_THUMBNAILS is set.
+
+    The scanner and the file watcher queue each new item whose thumbnail was not
+    already written while it was read. A few worker threads with a raised niceness
+    work through the queue, pause after every thumbnail and wait whenever users are
+    waiting for thumbnails, so the grid's own requests always come first. Clients
+    are told to refresh at most once per REFRESH_INTERVAL, and once the queue is
+    empty. Like the metadata enricher, workers exit when the queue is empty and are
+    started again by the next item.
+    """
+
+    def __init__(self, workers: int = config.THUMBNAIL_PREGEN_WORKERS, delay: float = config.THUMBNAIL_PREGEN_DELAY):
+        self.workers = max(1, workers)
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._queue: Deque[Tuple[str, str]] = deque()
+        self._queued: Set[str] = set()
+        self._threads: List[threading.Thread] = []
+        self.user_requests = 0
+        self.last_user_request = 0.0
+        self.last_refresh = 0.0
+        self.refresh_pending = False
+        self.generated = 0
+
+    def enqueue(self, content_hash: str, full_path: str):
+        """Queues new content for a thumbnail, unless it has one already."""
+        if derivative_index.has_thumbnail(content_hash):
+            return
+        with self._lock:
+            if content_hash in self._queued:
+                return
+            self._queued.add(content_hash)
+            self._queue.append((content_hash, full_path))
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            if len(self._threads) < min(self.workers, len(self._queue)):
+                if not self._threads:
+                    progress = scan_progress.get_tracker("thumbnails")
+                    progress.start()
+                    progress.watch_queue("thumbnails", self.pending)
+                thread = threading.Thread(target=self._run, name="thumbnail-pregeneration", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def pending(self) -> int:
+        return len(self._queued)
+
+    @contextmanager
+    def user_request(self):
+        """Marks a thumbnail generation a user is waiting for, pre-generation pauses while any run."""
+        with self._lock:
+            self.user_requests += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.user_requests -= 1
+                self.last_user_request = time.monotonic()
+
+    def wait_for_users(self):
+        while self.user_requests or time.monotonic() - self.last_user_request < USER_IDLE_SECONDS:
+            time.sleep(USER_IDLE_SECONDS)
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), THREAD_NICENESS)
+        except (AttributeError, OSError):
+            pass # Per-thread priorities are a Linux feature
+        progress = scan_progress.get_tracker("thumbnails")
+        db = database.SessionLocal()
+        try:
+            while True:
+                with self._lock:
+                    if not self._queue:
+                        self._threads = [thread for thread in self._threads if thread is not threading.current_thread()]
+                        if not self._threads:
+                            progress.finish()
+                            self._maybe_refresh(force=True)
+                        return
+                    content_hash, full_path = self._queue.popleft()
+                self.wait_for_users()
+                thumb_size = image_processor.get_thumbnail_size(db)
+                preview_size = image_processor.get_preview_size(db)
+                db.rollback() # Do not hold a read transaction while generating
+                try:
+                    # Skipped if a user request is generating it on the thumbnail service right now
+                    if not derivative_index.has_thumbnail(content_hash) and not thumbnail_service.thumbnail_service.is_in_flight(content_hash) and os.path.isfile(full_path):
+                        with progress.stage("thumbnail"):
+                            if image_processor.generate_thumbnail(None, full_path, content_hash, thumb_size, preview_size):
+                                self.generated += 1
+                                self.refresh_pending = True
+                except Exception as e:
+                    print(f"Error pre-generating thumbnail for {full_path}: {e}")
+                finally:
+                    with self._lock:
+                        self._queued.discard(content_hash)
+                    progress.add_files(1)
+                self._maybe_refresh()
+                time.sleep(self.delay)
+        finally:
+            db.close()
+
+    def _maybe_refresh(self, force: bool = False):
+        if not self.refresh_pending or database.main_event_loop is None:
+            return
+        if not force and time.monotonic() - self.last_refresh < REFRESH_INTERVAL:
+            return
+        self.refresh_pending = False
+        self.last_refresh = time.monotonic()
+        message = {"type": "refresh_images", "reason": "thumbnails_generated"}
+        asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), database.main_event_loop)
+
+
+# The one pre-generator new content is queued on
+pregenerator = ThumbnailPregenerator()
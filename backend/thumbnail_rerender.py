@@ -0,0 +1,213 @@
+import asyncio
+import io
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Tuple
+
+from PIL import Image as PILImage
+from sqlalchemy import and_, func, true, tuple_
+from sqlalchemy.orm import Session
+
+import config
+import database
+from derivative_index import THUMBNAIL, derivative_index, derivative_path, remove_derivative
+import image_processor
+import models
+from pack_store import pack_store
+import scan_progress
+import thumbnail_pregeneration
+import thumbnail_service
+from websocket_manager import manager
+
+# Content read from the database per query, in re-rendering order.
+BATCH_SIZE = 500
+
+
+def next_batch(db: Session, last: Optional[Tuple[int, Optional[datetime], str]], limit: int = BATCH_SIZE) -> list:
+    """
+    The next (view_count, date_created, content_hash, width, height) rows after last, most
+    viewed, then newest first, where a missing date_created sorts last. The rows after last
+    are read as up to three ranges of ix_image_content_view_order, each of which SQLite can
+    seek to, so a pass over the library does not re-read the index from the start for each batch.
+    """
+    content = models.ImageContent
+    if last is None:
+        ranges = [true()]
+    else:
+        view_count, date_created, content_hash = last
+        if date_created is not None:
+            ranges = [
+                and_(content.view_count == view_count, tuple_(content.date_created, content.content_hash) < tuple_(date_created, content_hash)),
+                and_(content.view_count == view_count, content.date_created.is_(None)),
+            ]
+        else:
+            ranges = [and_(content.view_count == view_count, content.date_created.is_(None), content.content_hash < content_hash)]
+        ranges.append(content.view_count < view_count)
+    batch = []
+    for condition in ranges:
+        batch += db.query(content.view_count, content.date_created, content.content_hash, content.width, content.height).filter(
+            condition
+        ).order_by(content.view_count.desc(), content.date_created.desc(), content.content_hash.desc()).limit(limit - len(batch)).all()
+        if len(batch) >= limit:
+            break
+    return batch
+
+def adopt_legacy_thumbnail(content_hash: str, thumb_size: int, longest_side: int) -> bool:
+    """
+    Keys a thumbnail from before thumbnails were keyed by size under thumb_size, if it was
+    made at that size, which is what it would be re-rendered as. longest_side is the longest
+    side of the content, unknown if 0. Returns whether it was adopted.
+    """
+    if not longest_side:
+        return False
+    data = pack_store.get(content_hash, THUMBNAIL)
+    path = derivative_index.path(content_hash, THUMBNAIL)
+    try:
+        with PILImage.open(io.BytesIO(data) if data is not None else path) as image:
+            if max(image.size) != min(thumb_size, longest_side):
+                return False
+        if data is not None:
+            if not pack_store.put(content_hash, thumb_size, data):
+                return False
+        else:
+            sized_path = derivative_path(content_hash, thumb_size)
+            os.makedirs(os.path.dirname(sized_path), exist_ok=True)
+            os.link(path, sized_path)
+    except (OSError, PILImage.UnidentifiedImageError) as e:
+        print(f"Thumbnail re-render: Could not adopt the thumbnail of {content_hash}: {e}")
+        return False
+    derivative_index.add(content_hash, thumb_size)
+    remove_derivative(content_hash, THUMBNAIL)
+    return True
+
+
+class ThumbnailRerenderer:
+    """
+    Re-renders thumbnails made at an earlier thumb_size setting.
+
+    Thumbnails are keyed by their size, so changing thumb_size leaves the existing
+    ones in place, and they are served as the closest size there is until their
+    replacement is written. A pass works through the library most viewed first,
+    then newest first, which is also the grid's default order. It runs on a single
+    thread with a raised niceness, pauses after every thumbnail and waits whenever
+    users are waiting for thumbnails, like the pre-generator. Content already at
+    the current size costs an index lookup. A thumbnail from before thumbnails were
+    keyed by size is renamed rather than re-rendered if it has the current size.
+    Starting a pass while one runs restarts it with the current settings.
+    """
+
+    def __init__(self, delay: float = config.THUMBNAIL_PREGEN_DELAY):
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._restart = False
+        self.rendered = 0
+        self.adopted = 0
+        self.failed = 0
+
+    def start(self):
+        """Starts a pass over the library, e.g. after thumb_size changed, or restarts the running one."""
+        with self._lock:
+            self._restart = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="thumbnail-rerender", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), thumbnail_pregeneration.THREAD_NICENESS)
+        except (AttributeError, OSError):
+            pass # Per-thread priorities are a Linux feature
+        db = database.SessionLocal()
+        try:
+            derivative_index.wait() # Which thumbnails are current is read from the index
+            while True:
+                with self._lock:
+                    if not self._restart:
+                        self._thread = None
+                        return
+                    self._restart = False
+                self._pass(db)
+        except Exception as e:
+            print(f"Thumbnail re-render: Error: {e}")
+            with self._lock:
+                self._thread = None
+        finally:
+            db.close()
+
+    def _pass(self, db: Session):
+        thumb_size = image_processor.get_thumbnail_size(db)
+        preview_size = image_processor.get_preview_size(db)
+        content = models.ImageContent
+        progress = scan_progress.get_tracker("rerender")
+        progress.start()
+        progress.set_total(db.query(func.count(content.content_hash)).scalar())
+        db.rollback()
+        start_time = time.time()
+        rendered = adopted = 0
+        last = None
+        try:
+            while not self._restart:
+                batch = next_batch(db, last)
+                db.rollback() # Do not hold a read transaction while rendering
+                if not batch:
+                    break
+                last = batch[-1][:3]
+                for _, _, content_hash, width, height in batch:
+                    if self._restart:
+                        break
+                    progress.add_files(1)
+                    # Missing thumbnails are left to requests and the pre-generator
+                    if not derivative_index.has_thumbnail(content_hash) or image_processor.thumbnail_is_current(content_hash, thumb_size):
+                        continue
+                    if THUMBNAIL in derivative_index.derivatives(content_hash) and adopt_legacy_thumbnail(content_hash, thumb_size, max(width or 0, height or 0)):
+                        adopted += 1
+                        continue
+                    thumbnail_pregeneration.pregenerator.wait_for_users()
+                    if thumbnail_service.thumbnail_service.is_in_flight(content_hash):
+                        continue # A user request is generating it at the current size right now
+                    if self._render(db, content_hash, thumb_size, preview_size, progress):
+                        rendered += 1
+                    time.sleep(self.delay)
+        finally:
+            progress.finish()
+            with self._lock:
+                self.rendered += rendered
+                self.adopted += adopted
+
+        if rendered or adopted:
+            duration = time.time() - start_time
+            print(f"[{datetime.now().isoformat()}] Thumbnail re-render: {rendered} re-rendered and {adopted} renamed at {thumb_size} px in {duration:.2f} seconds.")
+            if database.main_event_loop is not None:
+                message = {"type": "refresh_images", "reason": "thumbnails_rerendered"}
+                asyncio.run_coroutine_threadsafe(manager.broadcast_json(message), database.main_event_loop)
+
+    def _render(self, db: Session, content_hash: str, thumb_size: int, preview_size: Optional[int], progress: scan_progress.ProgressTracker) -> bool:
+        locations = db.query(models.ImageLocation.path, models.ImageLocation.filename).filter(
+            models.ImageLocation.content_hash == content_hash, models.ImageLocation.deleted == False
+        ).all()
+        db.rollback()
+        for path, filename in locations:
+            full_path = os.path.join(path, filename)
+            if not os.path.isfile(full_path):
+                continue
+            try:
+                with progress.stage("thumbnail"):
+                    if image_processor.generate_thumbnail(None, full_path, content_hash, thumb_size, preview_size):
+                        return True
+            except Exception as e:
+                print(f"Thumbnail re-render: Error re-rendering {full_path}: {e}")
+            break
+        with self._lock:
+            self.failed += 1
+        return False
+
+    def status(self) -> dict:
+        with self._lock:
+            return {"running": self._thread is not None, "rendered": self.rendered, "adopted": self.adopted, "failed": self.failed}
+
+
+# The one re-renderer thumb_size changes are handed to
+rerenderer = ThumbnailRerenderer()
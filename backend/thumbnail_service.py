@@ -0,0 +1,104 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+import config
+import database
+import image_processor
+
+
+class ThumbnailService:
+    """
+    Generates the thumbnails users are waiting for, on a fixed pool of worker threads.
+
+    Every request for a missing thumbnail goes through submit. Requests are keyed
+    by content hash: while a thumbnail is queued or being generated, further
+    requests for it get the same Future, so each one is generated once and every
+    waiter is notified when it is done. At most max_pending thumbnails are queued
+    or running. Beyond that, submit refuses new work and returns None, and the
+    caller serves the placeholder, so a burst of page loads cannot queue more
+    work than the pool can finish.
+    """
+
+    def __init__(self, workers: int = config.THUMBNAIL_WORKERS, max_pending: int = config.THUMBNAIL_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="thumbnail")
+        self._in_flight: Dict[str, Future] = {}
+        self.running = 0
+        # Totals since startup
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.generated = 0
+        self.failed = 0
+        self.generation_seconds = 0.0
+
+    def submit(self, content_hash: str, source_filepath: str, image_id: Optional[int] = None) -> Optional[Future]:
+        """
+        Queues a thumbnail for content_hash, generated from source_filepath. Returns a Future
+        that resolves to the thumbnail path, or None on failure, and None instead of a Future
+        if the queue is full.
+        """
+        with self._lock:
+            future = self._in_flight.get(content_hash)
+            if future is not None:
+                self.deduplicated += 1
+                return future
+            if len(self._in_flight) >= self.max_pending:
+                self.rejected += 1
+                return None
+            self.submitted += 1
+            future = self._executor.submit(self._generate, content_hash, source_filepath, image_id)
+            self._in_flight[content_hash] = future
+        future.add_done_callback(lambda _: self._forget(content_hash))
+        return future
+
+    def is_in_flight(self, content_hash: str) -> bool:
+        return content_hash in self._in_flight
+
+    def _forget(self, content_hash: str):
+        with self._lock:
+            self._in_flight.pop(content_hash, None)
+
+    def _generate(self, content_hash: str, source_filepath: str, image_id: Optional[int]):
+        with self._lock:
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            thumbnail_path = image_processor.generate_thumbnail_in_background(
+                image_id, content_hash, source_filepath, database.main_event_loop
+            )
+        except Exception as e:
+            print(f"Error generating thumbnail for {source_filepath}: {e}")
+            thumbnail_path = None
+        with self._lock:
+            self.running -= 1
+            self.generation_seconds += time.perf_counter() - start
+            if thumbnail_path:
+                self.generated += 1
+            else:
+                self.failed += 1
+        return thumbnail_path
+
+    def status(self) -> dict:
+        with self._lock:
+            finished = self.generated + self.failed
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "running": self.running,
+                "queued": len(self._in_flight) - self.running,
+                "submitted": self.submitted,
+                "deduplicated": self.deduplicated,
+                "rejected": self.rejected,
+                "generated": self.generated,
+                "failed": self.failed,
+                "average_seconds": self.generation_seconds / finished if finished else None,
+            }
+
+
+# The one service every user-driven thumbnail request goes through
+thumbnail_service = ThumbnailService()
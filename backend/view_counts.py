@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import bindparam, func, update
+from sqlalchemy.exc import OperationalError
+
+import database
+import models
+
+# Seconds views are collected before they are written, in one transaction.
+FLUSH_INTERVAL = 30.0
+
+
+class ViewCounter:
+    """
+    Counts image views in memory and adds them to ImageContent.view_count in batches.
+
+    Opening an image only bumps a counter. A background thread writes the views
+    every flush_interval seconds with one executemany, so a request never waits
+    for the database lock just to count itself. The thread exits once no views
+    are left and is started again by the next one. Views that cannot be written
+    are kept for the next flush. date_indexed is left as it is, a view does not
+    change the content.
+    """
+
+    def __init__(self, session_factory=database.SessionLocal, flush_interval: float = FLUSH_INTERVAL):
+        self.session_factory = session_factory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = Counter()
+
+    def record(self, content_hash: str):
+        with self._lock:
+            self._pending[content_hash] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="view-counter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+
+    def flush(self):
+        """Writes the views counted so far, e.g. at shutdown."""
+        with self._lock:
+            views, self._pending = self._pending, Counter()
+        if not views:
+            return
+        content = models.ImageContent
+        db = self.session_factory()
+        try:
+            db.execute(
+                update(content.__table__)
+                .where(content.content_hash == bindparam("b_content_hash"))
+                .values(view_count=func.coalesce(content.view_count, 0) + bindparam("b_views"), date_indexed=content.date_indexed),
+                [{"b_content_hash": content_hash, "b_views": count} for content_hash, count in views.items()]
+            )
+            db.commit()
+        except OperationalError as e:
+            db.rollback()
+            print(f"Could not write the view counts of {len(views)} images, retrying later: {e}")
+            with self._lock:
+                self._pending.update(views)
+        finally:
+            db.close()
+
+
+# The one counter image views are recorded with
+view_counter = ViewCounter()
@@ -10,8 +10,14 @@ import React, { useState, useEffect, useRef, forwardRef } from 'react';
 const ImageCard = forwardRef(({ image, onClick, onContextMenu, refreshKey, isSelected, isFocused }, ref) => {
   const [isLoading, setIsLoading] = useState(true);
   const [thumbnailUrl, setThumbnailUrl] = useState(null);
+  const [cacheBuster, setCacheBuster] = useState(null);
   const retryTimeoutRef = useRef(null);
 
+  // One entry per thumbnail ladder size, so the browser picks the smallest file that is sharp on this screen.
+  const thumbnailSrcSet = Object.entries(image.thumbnail_urls || {})
+    .map(([size, url]) => `${url}${cacheBuster ? `&t=${cacheBuster}` : ''} ${size}w`)
+    .join(', ');
+
   const handleImageLoad = () => {
     setIsLoading(false);
     // Clear any existing retry timeout
@@ -29,7 +35,9 @@ const ImageCard = forwardRef(({ image, onClick, onContextMenu, refreshKey, isSel
     }
     retryTimeoutRef.current = setTimeout(() => {
       // Appending a timestamp to the URL forces the browser to reload the image.
-      setThumbnailUrl(`/api/thumbnails/${image.id}?t=${new Date().getTime()}`);
+      const timestamp = new Date().getTime();
+      setCacheBuster(timestamp);
+      setThumbnailUrl(`/api/thumbnails/${image.id}?t=${timestamp}`);
     }, 2000); // Retry after 2 seconds
   };
 
@@ -42,7 +50,9 @@ const ImageCard = forwardRef(({ image, onClick, onContextMenu, refreshKey, isSel
   useEffect(() => {
     // When the refreshKey changes, it means a new thumbnail might be available.
     // Appending a timestamp to the URL forces the browser to reload the image.
-    setThumbnailUrl(`/api/thumbnails/${image.id}?t=${new Date().getTime()}`);
+    const timestamp = new Date().getTime();
+    setCacheBuster(timestamp);
+    setThumbnailUrl(`/api/thumbnails/${image.id}?t=${timestamp}`);
 
     // Cleanup the timeout when the component unmounts or the image changes
     return () => {
@@ -65,6 +75,8 @@ const ImageCard = forwardRef(({ image, onClick, onContextMenu, refreshKey, isSel
         {thumbnailUrl && (
           <img
             src={thumbnailUrl}
+            srcSet={thumbnailSrcSet || undefined}
+            sizes="200px"
             alt={image.filename}
             onLoad={handleImageLoad}
             style={{ display: isLoading ? 'none' : 'block' }} // Hide image while loading